@@ -1,6 +1,8 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from app.config import Config
+from app.cache import BalanceCache, IdempotencyCache, ReportCache
+from app import admission, events, metrics, storage
 from flask_migrate import Migrate
 
 
@@ -11,22 +13,53 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
-    # Configuration
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///wallet.db'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-    db.init_app(app)
+    # Storage profile (engine options, PRAGMAs, reader engine), then Flask-SQLAlchemy itself
+    storage.init_app(app, db)
+    if app.config['METRICS_ENABLED']:
+        with app.app_context():
+            engines = [engine for engine in (db.engine, storage.reader_engine()) if engine is not None]
+        metrics.init_app(app, engines)
+    app.extensions['balance_cache'] = BalanceCache(app.config['BALANCE_CACHE_SIZE'], app.config['BALANCE_CACHE_TTL'])
+    app.extensions['idempotency_cache'] = IdempotencyCache(
+        app.config['IDEMPOTENCY_CACHE_SIZE'], app.config['IDEMPOTENCY_KEY_TTL'])
+    app.extensions['analytics_cache'] = ReportCache(app.config['ANALYTICS_CACHE_SIZE'], app.config['ANALYTICS_CACHE_TTL'])
+    if app.config['ADMISSION_ENABLED']:
+        admission.init_app(app)
+    events.init_app(app)
     migrate.init_app(app, db)  # Initialize Flask-Migrate
 
-    with app.app_context():
-        from . import routes
-        db.create_all()  # Create sql tables for our data models
-
+    # The schema is created by `flask init-db`, never as a side effect of booting a worker
     from app.routes import wallet_bp
     app.register_blueprint(wallet_bp)
 
+    from app import commands
+    commands.init_app(app)
+
+    _start_write_pipeline(app)
     return app
 
 
+def _start_write_pipeline(app):
+    if app.config['WRITE_PIPELINE_ENABLED']:
+        from app.services import WritePipeline
+        app.extensions['write_pipeline'] = WritePipeline(
+            app, app.config['WRITE_PIPELINE_SHARDS'], app.config['WRITE_PIPELINE_MAX_BATCH'])
+
+
+def init_worker(app):
+    """
+    Per-process setup for a worker forked from an app loaded once in the parent (see gunicorn.conf.py).
+
+    Pooled database connections inherited from the parent are dropped without closing them, since the
+    parent still owns the sockets, and threads do not survive a fork, so the write pipeline is started
+    again in the child.
+    """
+    with app.app_context():
+        for engine in (db.engine, storage.reader_engine()):
+            if engine is not None:
+                engine.dispose(close=False)
+    _start_write_pipeline(app)
+
+
 
 
@@ -0,0 +1,147 @@
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, has_app_context
+
+ADMISSION = 'admission'
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted before its deadline; maps to 429 Too Many Requests."""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+        Bounds concurrent write requests per wallet and per process.
+
+        A request holds one global slot and one slot for each wallet it writes to while it runs. Without a
+        free slot it waits up to ``queue_timeout`` seconds; if the wallet's queue is already full, or the
+        deadline passes, it is rejected with Overloaded right away instead of occupying a worker thread in
+        the compare-and-swap retry loop. A hot wallet can therefore hold at most ``max_per_wallet`` of the
+        ``max_in_flight`` slots, and requests for other wallets keep flowing.
+        """
+
+    def __init__(self, max_in_flight=64, max_per_wallet=4, max_queued=128, max_queued_per_wallet=16,
+                 queue_timeout=0.25, retry_after=1):
+        self.max_in_flight = max_in_flight
+        self.max_per_wallet = max_per_wallet
+        self.max_queued = max_queued
+        self.max_queued_per_wallet = max_queued_per_wallet
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = Counter()  # reason -> count
+        self._wallet_in_flight = Counter()
+        self._wallet_waiting = Counter()
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def admit(self, wallet_ids=()):
+        """Holds a global slot and a slot per wallet for the duration of the block."""
+        wallet_ids = sorted(_wallet_keys(wallet_ids))
+        self._acquire(wallet_ids)
+        try:
+            yield
+        finally:
+            self._release(wallet_ids)
+
+    def _has_room(self, wallet_ids):
+        return self.in_flight < self.max_in_flight and all(
+            self._wallet_in_flight[wallet_id] < self.max_per_wallet for wallet_id in wallet_ids)
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        raise Overloaded(self.retry_after, reason)
+
+    def _acquire(self, wallet_ids):
+        with self._cond:
+            if not self._has_room(wallet_ids):
+                if self.waiting >= self.max_queued or any(
+                        self._wallet_waiting[wallet_id] >= self.max_queued_per_wallet for wallet_id in wallet_ids):
+                    self._reject('queue_full')
+                self._queue(wallet_ids, 1)
+                try:
+                    admitted = self._cond.wait_for(lambda: self._has_room(wallet_ids), self.queue_timeout)
+                finally:
+                    self._queue(wallet_ids, -1)
+                if not admitted:
+                    self._reject('timeout')
+            self.in_flight += 1
+            self.admitted += 1
+            for wallet_id in wallet_ids:
+                self._wallet_in_flight[wallet_id] += 1
+
+    def _queue(self, wallet_ids, step):
+        self.waiting += step
+        for wallet_id in wallet_ids:
+            self._wallet_waiting[wallet_id] += step
+            if not self._wallet_waiting[wallet_id]:
+                del self._wallet_waiting[wallet_id]
+
+    def _release(self, wallet_ids):
+        with self._cond:
+            self.in_flight -= 1
+            for wallet_id in wallet_ids:
+                self._wallet_in_flight[wallet_id] -= 1
+                if not self._wallet_in_flight[wallet_id]:
+                    del self._wallet_in_flight[wallet_id]
+            self._cond.notify_all()
+
+    def stats(self, top=10):
+        """:return: Current queue depths and totals, with the ``top`` wallets that have the most waiters."""
+        with self._cond:
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'hot_wallets': [
+                    {'wallet_id': wallet_id, 'waiting': waiting, 'in_flight': self._wallet_in_flight[wallet_id]}
+                    for wallet_id, waiting in self._wallet_waiting.most_common(top)
+                ],
+            }
+
+
+def _wallet_keys(wallet_ids):
+    # Ids that are not integers cannot name a wallet; the write itself reports them
+    keys = set()
+    for wallet_id in wallet_ids:
+        try:
+            keys.add(int(wallet_id))
+        except (TypeError, ValueError):
+            pass
+    return keys
+
+
+def controller():
+    """:return: The app's AdmissionController, or None when admission control is disabled."""
+    return current_app.extensions.get(ADMISSION) if has_app_context() else None
+
+
+@contextmanager
+def admit(*wallet_ids):
+    """Admits the enclosed write through the app's controller; a no-op when admission control is disabled."""
+    instance = controller()
+    if instance is None:
+        yield
+        return
+    with instance.admit(wallet_ids):
+        yield
+
+
+def init_app(app):
+    app.extensions[ADMISSION] = AdmissionController(
+        max_in_flight=app.config['ADMISSION_MAX_IN_FLIGHT'],
+        max_per_wallet=app.config['ADMISSION_MAX_PER_WALLET'],
+        max_queued=app.config['ADMISSION_MAX_QUEUED'],
+        max_queued_per_wallet=app.config['ADMISSION_MAX_QUEUED_PER_WALLET'],
+        queue_timeout=app.config['ADMISSION_QUEUE_TIMEOUT'],
+        retry_after=app.config['ADMISSION_RETRY_AFTER'],
+    )
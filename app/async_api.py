@@ -0,0 +1,210 @@
+import asyncio
+import re
+from urllib.parse import parse_qsl
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from app.events import format_event, parse_since_version, parse_timeout
+from app.routes import balance_etag, history_etag
+from app.services import balance_plan, events_plan, history_plan, run_plan_async, totals_plan, version_plan
+from app.storage import create_async_reader
+
+
+class AsyncReadAPI:
+    """
+        ASGI app that serves the balance and history reads on asyncio and hands everything else to Flask.
+
+        ``GET /wallet/balance/<id>`` and ``GET /wallet/transactions`` run the same read plans as the Flask
+        views on a read-only AsyncEngine (aiosqlite for SQLite), with the same JSON, status codes and ETags.
+        A request waiting on the database or on a slow client only holds a coroutine, so one process can
+        keep thousands of reads in flight. ``GET /wallet/<id>/events`` (long poll and server-sent events) is
+        served here too, so an idle subscriber costs a coroutine and a hub subscription instead of a worker
+        thread. All other requests, writes included, go to the wrapped Flask app through asgiref's
+        WsgiToAsgi adapter, so the blueprint keeps working unchanged next to it.
+        """
+
+    def __init__(self, flask_app, engine=None):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.engine = engine or create_async_reader(flask_app)
+        self.balance_cache = flask_app.extensions['balance_cache']
+        self.hub = flask_app.extensions['events']
+        self.events_path = re.compile(r'/wallet/(\d+)/events')
+        self.routes = [
+            (re.compile(r'/wallet/balance/(\d+)'), self.balance),
+            (re.compile(r'/wallet/transactions'), self.transactions),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            match = self.events_path.fullmatch(scope['path'])
+            if match:
+                await self.events(scope, receive, send, int(match.group(1)))
+                return
+            for pattern, handler in self.routes:
+                match = pattern.fullmatch(scope['path'])
+                if match:
+                    status, payload, etag = await handler(scope, *match.groups())
+                    await self._respond(send, scope, status, payload, etag)
+                    return
+        await self.wsgi(scope, receive, send)
+
+    async def balance(self, scope, wallet_id):
+        wallet_id = int(wallet_id)
+        try:
+            balance, version = await run_plan_async(balance_plan(wallet_id, self.balance_cache), self.engine)
+        except ValueError as e:
+            return 400, {'error': str(e)}, None
+        return 200, {'balance': balance}, balance_etag(wallet_id, version)
+
+    async def transactions(self, scope):
+        pairs, args = _query(scope)
+        wallet_id = args.get('wallet_id')
+        if not wallet_id:
+            return 400, {'error': "Wallet ID is required"}, None
+        config = self.flask_app.config
+        try:
+            limit = int(args.get('limit', config['HISTORY_PAGE_SIZE']))
+        except ValueError:
+            limit = config['HISTORY_PAGE_SIZE']
+
+        version = await run_plan_async(version_plan(wallet_id), self.engine)
+        etag = history_etag(wallet_id, version, pairs) if version is not None else None
+        try:
+            if args.get('totals_only', 'false').lower() == 'true':
+                plan = totals_plan(wallet_id, args.get('start_date'), args.get('end_date'))
+            elif not 0 < limit <= config['HISTORY_MAX_PAGE_SIZE']:
+                return 400, {'error': f"Limit must be between 1 and {config['HISTORY_MAX_PAGE_SIZE']}"}, None
+            else:
+                plan = history_plan(wallet_id, args.get('start_date'), args.get('end_date'), limit, args.get('after'))
+            if etag is not None and _not_modified(scope, etag):
+                plan.close()
+                return 304, None, etag
+            return 200, await run_plan_async(plan, self.engine), etag
+        except ValueError as e:
+            return 400, {'error': str(e)}, None
+
+    async def events(self, scope, receive, send, wallet_id):
+        config = self.flask_app.config
+        _, args = _query(scope)
+        try:
+            since_version = parse_since_version(args.get('since_version', _header(scope, b'last-event-id')))
+            timeout = parse_timeout(args.get('timeout'), config['EVENTS_LONG_POLL_TIMEOUT'])
+        except ValueError as e:
+            await self._respond(send, scope, 400, {'error': str(e)}, None)
+            return
+
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+
+        def notify():  # called on the publishing thread
+            loop.call_soon_threadsafe(woken.set)
+
+        self.hub.subscribe(wallet_id, notify)
+        try:
+            try:
+                events, cursor = await self._wallet_events(wallet_id, since_version)
+            except ValueError as e:
+                await self._respond(send, scope, 400, {'error': str(e)}, None)
+                return
+            accept = parse_accept_header(_header(scope, b'accept'), MIMEAccept)
+            if accept.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+                await self._stream_events(receive, send, wallet_id, woken, events, cursor)
+                return
+            # A notification that arrives after the read leaves ``woken`` set, so no write is missed
+            deadline = loop.time() + timeout
+            while not events and loop.time() < deadline:
+                await _wait(woken, deadline - loop.time())
+                woken.clear()
+                events, cursor = await self._wallet_events(wallet_id, since_version)
+            await self._respond(send, scope, 200, {'events': events, 'version': cursor}, None)
+        finally:
+            self.hub.unsubscribe(wallet_id, notify)
+
+    async def _wallet_events(self, wallet_id, since_version):
+        plan = events_plan(wallet_id, since_version, self.flask_app.config['EVENTS_REPLAY_LIMIT'])
+        return await run_plan_async(plan, self.engine)
+
+    async def _stream_events(self, receive, send, wallet_id, woken, events, cursor):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+        disconnected = asyncio.ensure_future(_disconnect(receive))
+        heartbeat = self.flask_app.config['EVENTS_HEARTBEAT']
+        try:
+            while True:
+                if events:
+                    body = ''.join(format_event(event, self.flask_app.json.dumps) for event in events)
+                else:
+                    body = ': keep-alive\n\n'
+                await send({'type': 'http.response.body', 'body': body.encode(), 'more_body': True})
+                waiter = asyncio.ensure_future(woken.wait())
+                await asyncio.wait({waiter, disconnected}, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if disconnected.done():
+                    return
+                woken.clear()
+                events, cursor = await self._wallet_events(wallet_id, cursor)
+        finally:
+            disconnected.cancel()
+
+    async def _respond(self, send, scope, status, payload, etag):
+        if status == 200 and etag is not None and _not_modified(scope, etag):
+            status, payload = 304, None
+        body = b'' if payload is None else (self.flask_app.json.dumps(payload, separators=(',', ':')) + '\n').encode()
+        headers = [(b'content-length', str(len(body)).encode())]
+        if payload is not None:
+            headers.append((b'content-type', b'application/json'))
+        if etag is not None:
+            headers.append((b'etag', quote_etag(etag).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def _query(scope):
+    pairs = parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+    args = {}
+    for name, value in pairs:
+        args.setdefault(name, value)  # first value wins, like request.args.get
+    return pairs, args
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _not_modified(scope, etag):
+    value = _header(scope, b'if-none-match')
+    return value is not None and parse_etags(value).contains(etag)
+
+
+async def _wait(event, timeout):
+    try:
+        await asyncio.wait_for(event.wait(), max(timeout, 0))
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def create_asgi_app(flask_app):
+    """:return: The Flask app wrapped with the asyncio read API, for an ASGI server such as uvicorn."""
+    return AsyncReadAPI(flask_app)
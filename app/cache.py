@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class BalanceCache:
+    """
+        Bounded, thread-safe LRU cache of wallet balances tagged with Wallet.version.
+
+        Writers store the balance they just committed and readers store what they loaded. An entry is only
+        replaced by one with an equal or newer version, so a slow reader can never overwrite a fresher
+        value written by this process. Entries expire after ``ttl`` seconds to pick up writes made by
+        other processes. Wallet ids are normalized to int, since JSON clients may send them as strings.
+        """
+
+    def __init__(self, max_size=10000, ttl=30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # wallet_id -> (balance, version, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, wallet_id):
+        """:return: (balance, version) or None if the wallet is not cached or the entry expired."""
+        wallet_id = int(wallet_id)
+        with self._lock:
+            entry = self._entries.get(wallet_id)
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    del self._entries[wallet_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(wallet_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, wallet_id, balance, version):
+        if self.max_size <= 0:
+            return
+        wallet_id = int(wallet_id)
+        with self._lock:
+            entry = self._entries.get(wallet_id)
+            if entry is not None and entry[1] > version:
+                return
+            self._entries[wallet_id] = (balance, version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(wallet_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, wallet_id=None):
+        """Drops one wallet, or every entry when no wallet id is given."""
+        with self._lock:
+            if wallet_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(wallet_id), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+            }
+
+
+class IdempotencyCache:
+    """
+        Bounded, thread-safe LRU cache of recently stored idempotent responses.
+
+        Sits in front of the idempotency_key table so a client retrying right away is answered without a
+        query. Entries are only added after the write that produced them has committed, and expire after
+        ``ttl`` seconds like the stored keys themselves.
+        """
+
+    def __init__(self, max_size=10000, ttl=86400.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (fingerprint, status_code, body, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """:return: (fingerprint, status_code, body) or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[3] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[:3]
+
+    def put(self, key, fingerprint, status_code, body):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (fingerprint, status_code, body, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class ReportCache:
+    """
+        Bounded, thread-safe LRU cache of computed analytics reports, keyed by their parameters.
+
+        Reports are expensive to build and change slowly, so a repeated request for the same date range
+        is served from memory until the entry expires after ``ttl`` seconds or is evicted.
+        """
+
+    def __init__(self, max_size=32, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (report, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """:return: The cached report or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, report):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (report, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,149 @@
+import json
+from datetime import date
+import click
+import flask_migrate
+from flask import current_app
+from sqlalchemy import inspect
+from . import db
+from .services import archive_transactions, compact_shards, export_ledger_snapshot, ledger_summary, \
+    purge_idempotency_keys, rebuild_daily_totals, reconcile_wallets, set_wallet_shards
+from .snapshots import LedgerSnapshot
+
+
+# Revision matching the tables db.create_all() made before the schema was managed by migrations
+BASELINE_REVISION = 'd9284cc0ed9f'
+
+
+@click.command('init-db')
+def init_db():
+    """Create the schema on an empty database, or apply pending migrations to an existing one."""
+    inspector = inspect(db.engine)
+    if inspector.has_table('wallet'):
+        if not inspector.has_table('alembic_version'):
+            # Created by an older db.create_all(), which already has the baseline columns
+            flask_migrate.stamp(revision=BASELINE_REVISION)
+        flask_migrate.upgrade()
+        click.echo('Database upgraded')
+    else:
+        # The migrations start from the original tables, so a new database is created from the models
+        # and stamped as current
+        db.create_all()
+        flask_migrate.stamp()
+        click.echo('Database created')
+
+
+@click.command('backfill-daily-totals')
+@click.option('--batch-size', default=1000, show_default=True, help='Wallet ids rebuilt per transaction.')
+def backfill_daily_totals(batch_size):
+    """Rebuild the wallet_daily_totals rollup from the wallet_transaction ledger."""
+    written = rebuild_daily_totals(batch_size=batch_size)
+    click.echo(f'Wrote {written} daily total rows')
+
+
+@click.command('archive-ledger')
+@click.option('--older-than-days', type=int, help='Archive horizon; defaults to LEDGER_ARCHIVE_AFTER_DAYS.')
+@click.option('--batch-size', default=5000, show_default=True, help='Ledger rows moved per transaction.')
+def archive_ledger(older_than_days, batch_size):
+    """Move old wallet_transaction rows into wallet_transaction_archive."""
+    if older_than_days is None:
+        older_than_days = current_app.config['LEDGER_ARCHIVE_AFTER_DAYS']
+    archived = archive_transactions(older_than_days, batch_size=batch_size)
+    click.echo(f'Archived {archived} ledger rows older than {older_than_days} days')
+
+
+@click.command('reconcile')
+@click.option('--workers', type=int, help='Worker processes; defaults to the CPU count.')
+@click.option('--range-size', default=10000, show_default=True, help='Wallet ids checked per task.')
+@click.option('--tolerance', default=1e-6, show_default=True, help='Largest balance difference ignored.')
+@click.option('--repair', is_flag=True, help='Set mismatched balances to their ledger sum.')
+def reconcile(workers, range_size, tolerance, repair):
+    """Check every wallet balance against its ledger, printing mismatches as NDJSON."""
+    for item in reconcile_wallets(workers=workers, range_size=range_size, repair=repair, tolerance=tolerance):
+        if 'wallet_id' in item:
+            click.echo(json.dumps(item))
+        else:
+            click.echo(f"Checked {item['checked']} wallets: {item['mismatched']} mismatched, "
+                       f"{item['repaired']} repaired", err=True)
+
+
+@click.command('purge-idempotency-keys')
+@click.option('--batch-size', default=5000, show_default=True, help='Keys deleted per transaction.')
+def purge_idempotency_keys_command(batch_size):
+    """Delete stored Idempotency-Keys older than IDEMPOTENCY_KEY_TTL seconds."""
+    deleted = purge_idempotency_keys(current_app.config['IDEMPOTENCY_KEY_TTL'], batch_size=batch_size)
+    click.echo(f'Deleted {deleted} idempotency keys')
+
+
+@click.command('shard-wallet')
+@click.argument('wallet_id', type=int)
+@click.option('--shards', type=int, required=True, help='Number of credit shards; 0 turns sharding off.')
+def shard_wallet(wallet_id, shards):
+    """Spread the credits of a hot wallet over several shard rows."""
+    try:
+        balance = set_wallet_shards(wallet_id, shards)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Wallet {wallet_id} now has {shards} shards, balance {balance}')
+
+
+@click.command('compact-shards')
+def compact_shards_command():
+    """Fold the shards of sharded wallets back into their balances."""
+    compacted = compact_shards()
+    click.echo(f'Compacted {compacted} sharded wallets')
+
+
+@click.command('analytics-summary')
+@click.option('--start-date', help='First day (YYYY-MM-DD); defaults to the end date.')
+@click.option('--end-date', help='Last day (YYYY-MM-DD); defaults to today.')
+@click.option('--top', default=10, show_default=True, help='Wallets ranked by credit plus debit volume.')
+def analytics_summary(start_date, end_date, top):
+    """Print daily volumes, top wallets and the balance distribution as JSON."""
+    end_date = end_date or date.today().isoformat()
+    try:
+        report = ledger_summary(start_date or end_date, end_date, top)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(report, indent=2))
+
+
+@click.command('export-snapshot')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--start-date', required=True, help='First day (YYYY-MM-DD).')
+@click.option('--end-date', help='Last day (YYYY-MM-DD); defaults to the start date.')
+@click.option('--batch-size', default=100000, show_default=True, help='Ledger rows converted per chunk.')
+@click.option('--scale', default=100, show_default=True, help='Minor units per unit of currency.')
+def export_snapshot(path, start_date, end_date, batch_size, scale):
+    """Write the ledger of a date range to a memory-mappable snapshot file."""
+    try:
+        written = export_ledger_snapshot(path, start_date, end_date or start_date, batch_size=batch_size, scale=scale)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Wrote {written['records']} ledger rows of {written['wallets']} wallets to {path}")
+
+
+@click.command('snapshot-statements')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--wallet-id', type=int, multiple=True, help='Only this wallet; may be repeated.')
+@click.option('--totals-only', is_flag=True, help='Leave the transactions out of the statements.')
+def snapshot_statements(path, wallet_id, totals_only):
+    """Print per-wallet statements from a snapshot file as NDJSON, without touching the database."""
+    try:
+        with LedgerSnapshot(path) as snapshot:
+            for statement in snapshot.statements(wallet_id or None, transactions=not totals_only):
+                click.echo(json.dumps(statement))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+def init_app(app):
+    app.cli.add_command(init_db)
+    app.cli.add_command(backfill_daily_totals)
+    app.cli.add_command(archive_ledger)
+    app.cli.add_command(reconcile)
+    app.cli.add_command(purge_idempotency_keys_command)
+    app.cli.add_command(shard_wallet)
+    app.cli.add_command(compact_shards_command)
+    app.cli.add_command(analytics_summary)
+    app.cli.add_command(export_snapshot)
+    app.cli.add_command(snapshot_statements)
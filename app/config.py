@@ -7,6 +7,84 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///wallet.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     DEBUG = False
+    # Upper bound for the number of operations accepted by POST /wallet/batch
+    BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 10000))
+    # Records inserted per executemany/commit by /register/bulk and /wallet/create/bulk
+    BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 5000))
+    # Upper bound for the number of wallet ids accepted by /wallet/balances
+    BALANCES_MAX_IDS = int(os.environ.get('BALANCES_MAX_IDS', 10000))
+    # Page size for /wallet/transactions when no limit is given, and the largest limit accepted
+    HISTORY_PAGE_SIZE = 100
+    HISTORY_MAX_PAGE_SIZE = 1000
+    # Ledger rows older than this many days are moved to wallet_transaction_archive by `flask archive-ledger`
+    LEDGER_ARCHIVE_AFTER_DAYS = int(os.environ.get('LEDGER_ARCHIVE_AFTER_DAYS', 365))
+    # In-process balance cache for GET /wallet/balance; a size of 0 disables it
+    BALANCE_CACHE_SIZE = int(os.environ.get('BALANCE_CACHE_SIZE', 10000))
+    BALANCE_CACHE_TTL = float(os.environ.get('BALANCE_CACHE_TTL', 30))
+    # Group-commit pipeline for /wallet/credit and /wallet/debit (see services.WritePipeline)
+    WRITE_PIPELINE_ENABLED = os.environ.get('WRITE_PIPELINE_ENABLED', 'false').lower() == 'true'
+    WRITE_PIPELINE_SHARDS = int(os.environ.get('WRITE_PIPELINE_SHARDS', 4))
+    WRITE_PIPELINE_MAX_BATCH = int(os.environ.get('WRITE_PIPELINE_MAX_BATCH', 500))
+    WRITE_PIPELINE_TIMEOUT = float(os.environ.get('WRITE_PIPELINE_TIMEOUT', 10))
+    # Idempotency-Key support for /wallet/credit and /wallet/debit: front cache size and how long keys are kept
+    IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+    IDEMPOTENCY_KEY_TTL = float(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))
+    # Admission control for the credit/debit/transfer/batch endpoints (see admission.AdmissionController)
+    ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+    ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 64))
+    ADMISSION_MAX_PER_WALLET = int(os.environ.get('ADMISSION_MAX_PER_WALLET', 4))
+    ADMISSION_MAX_QUEUED = int(os.environ.get('ADMISSION_MAX_QUEUED', 128))
+    ADMISSION_MAX_QUEUED_PER_WALLET = int(os.environ.get('ADMISSION_MAX_QUEUED_PER_WALLET', 16))
+    ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 0.25))
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+    # GET /analytics/summary: rollup rows per NumPy chunk, longest date range, and the report cache
+    ANALYTICS_CHUNK_SIZE = int(os.environ.get('ANALYTICS_CHUNK_SIZE', 100000))
+    ANALYTICS_MAX_DAYS = int(os.environ.get('ANALYTICS_MAX_DAYS', 3660))
+    ANALYTICS_CACHE_SIZE = int(os.environ.get('ANALYTICS_CACHE_SIZE', 32))
+    ANALYTICS_CACHE_TTL = float(os.environ.get('ANALYTICS_CACHE_TTL', 300))
+    # GET /wallet/<id>/events: longest long-poll wait, SSE keep-alive interval, ledger rows replayed per
+    # response, and the directory of the sockets that fan change notifications out to the other workers
+    EVENTS_LONG_POLL_TIMEOUT = float(os.environ.get('EVENTS_LONG_POLL_TIMEOUT', 30))
+    EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+    EVENTS_REPLAY_LIMIT = int(os.environ.get('EVENTS_REPLAY_LIMIT', 1000))
+    EVENTS_SOCKET_DIR = os.environ.get('EVENTS_SOCKET_DIR')
+    # Worker threads per process that waiting long polls and event streams may hold in the WSGI app; keep
+    # it below GUNICORN_THREADS so wallet traffic always has a thread (the asyncio read API has no cap)
+    EVENTS_WSGI_MAX_WAITERS = int(os.environ.get('EVENTS_WSGI_MAX_WAITERS', 2))
+    # Request/SQL instrumentation exposed at GET /metrics, and the optional slow query log threshold
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    SLOW_QUERY_THRESHOLD_MS = float(os.environ['SLOW_QUERY_THRESHOLD_MS']) if os.environ.get('SLOW_QUERY_THRESHOLD_MS') else None
+    # Storage profile ('sqlite' or 'server'); picked from the database URL when not set
+    STORAGE_PROFILE = None
+    # Optional separate database (e.g. a replica) for balance and history reads
+    SQLALCHEMY_READER_URI = os.environ.get('READ_DATABASE_URL')
+
+class SQLiteStorage:
+    """Storage profile for a single SQLite file: WAL so readers never block behind the writer."""
+    STORAGE_PROFILE = 'sqlite'
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,  # milliseconds
+        'mmap_size': 268435456,  # 256 MiB
+        'cache_size': -65536,  # negative means KiB, i.e. 64 MiB
+    }
+
+class ServerStorage:
+    """Storage profile for a server database such as PostgreSQL: pooled, pre-pinged connections."""
+    STORAGE_PROFILE = 'server'
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': 10,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+
+STORAGE_PROFILES = {
+    'sqlite': SQLiteStorage,
+    'server': ServerStorage,
+}
 
 class DevelopmentConfig(Config):
     """Development configuration class with specific settings."""
@@ -22,11 +100,23 @@ class ProductionConfig(Config):
     DEBUG = False
     #SECRET_KEY = os.environ.get('SECRET_KEY')  # Ensure this is set in the production environment
 
-def get_config(env):
-    """Factory method to retrieve the appropriate configuration based on environment."""
+def get_config(env, storage=None):
+    """
+    Factory method to retrieve the appropriate configuration based on environment.
+
+    ``storage`` (or the STORAGE_PROFILE environment variable) selects a storage profile that is mixed
+    into the returned class. Without one, create_app picks the profile matching the database URL.
+    """
     if env == 'production':
-        return ProductionConfig
+        config = ProductionConfig
     elif env == 'testing':
-        return TestingConfig
+        config = TestingConfig
     else:
-        return DevelopmentConfig
+        config = DevelopmentConfig
+
+    storage = storage or os.environ.get('STORAGE_PROFILE')
+    if storage:
+        if storage not in STORAGE_PROFILES:
+            raise ValueError(f"Unknown storage profile: {storage}")
+        config = type(config.__name__, (STORAGE_PROFILES[storage], config), {})
+    return config
@@ -0,0 +1,226 @@
+import atexit
+import errno
+import os
+import socket
+import threading
+import time
+from flask import current_app, has_app_context
+
+EVENTS = 'events'
+WSGI_WAITERS = 'events_wsgi_waiters'
+DATAGRAM_SIZE = 4096
+
+
+class EventHub:
+    """
+        In-process fan-out of "wallet changed" notifications to waiting readers.
+
+        Writers call ``publish`` right after they commit; every callback subscribed to one of the wallets
+        is called from the publishing thread, so a waiter can wake a thread (threading.Event) or a
+        coroutine (loop.call_soon_threadsafe). Notifications carry no data: a woken reader reads the new
+        state from the database, so a lost or duplicated notification can only delay an event, never
+        corrupt it.
+
+        With a ``socket_dir`` every process on the host binds a Unix datagram socket there and each publish
+        is also sent to the other processes' sockets, so waiters in one pre-forked worker wake up on
+        writes made by another. Sends never block: if a peer's buffer is full the datagram is dropped and
+        its waiters catch up on their next heartbeat or timeout.
+        """
+
+    def __init__(self, socket_dir=None):
+        self.socket_dir = socket_dir
+        self.published = 0
+        self._subscribers = {}  # wallet_id -> set of callbacks
+        self._lock = threading.Lock()
+        self._pid = None  # process that owns the listening socket; a forked child binds its own
+        self._path = None
+        self._sender = None
+        self._peers = ([], 0.0)  # (socket paths, monotonic time they were listed)
+
+    def subscribe(self, wallet_id, callback):
+        """Calls ``callback()`` whenever the wallet changes, until ``unsubscribe`` is called."""
+        self._listen()
+        with self._lock:
+            self._subscribers.setdefault(int(wallet_id), set()).add(callback)
+
+    def unsubscribe(self, wallet_id, callback):
+        with self._lock:
+            callbacks = self._subscribers.get(int(wallet_id))
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._subscribers[int(wallet_id)]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(callbacks) for callbacks in self._subscribers.values())
+
+    def publish(self, wallet_ids):
+        """Notifies this process's subscribers of the given wallets, then the other processes."""
+        wallet_ids = sorted({int(wallet_id) for wallet_id in wallet_ids})
+        self.published += 1
+        self._notify(wallet_ids)
+        if self.socket_dir is not None:
+            self._broadcast(wallet_ids)
+
+    def _notify(self, wallet_ids):
+        with self._lock:
+            callbacks = [callback for wallet_id in wallet_ids for callback in self._subscribers.get(wallet_id, ())]
+        for callback in callbacks:
+            callback()
+
+    def _listen(self):
+        if self.socket_dir is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.socket_dir, exist_ok=True)
+            path = os.path.join(self.socket_dir, f'{os.getpid()}.sock')
+            if os.path.exists(path):
+                os.unlink(path)
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            receiver.bind(path)
+            self._pid, self._path = os.getpid(), path
+            atexit.register(self._close)
+            threading.Thread(target=self._receive, args=(receiver,), name='wallet-events', daemon=True).start()
+
+    def _close(self):
+        # atexit handlers are inherited by forked children, which must not remove their parent's socket
+        if self._pid == os.getpid():
+            _unlink(self._path)
+
+    def _receive(self, receiver):
+        while True:
+            data = receiver.recv(DATAGRAM_SIZE)
+            self._notify([int(wallet_id) for wallet_id in data.split(b',') if wallet_id])
+
+    def _broadcast(self, wallet_ids):
+        if self._sender is None or self._sender[0] != os.getpid():
+            sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sender.setblocking(False)
+            self._sender = (os.getpid(), sender)
+        sender = self._sender[1]
+        payloads, payload = [], b''
+        for wallet_id in wallet_ids:
+            item = str(wallet_id).encode()
+            if len(payload) + len(item) + 1 > DATAGRAM_SIZE:
+                payloads.append(payload)
+                payload = b''
+            payload += item + b','
+        payloads.append(payload)
+
+        for path in self._peer_paths():
+            for payload in payloads:
+                try:
+                    sender.sendto(payload, path)
+                except ConnectionRefusedError:
+                    # Nobody is bound to it any more: the process exited without cleaning up
+                    _unlink(path)
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.ENOENT, errno.ENOBUFS):
+                        raise
+                    break
+
+    def _peer_paths(self):
+        paths, listed_at = self._peers
+        if time.monotonic() - listed_at > 1.0:
+            try:
+                names = os.listdir(self.socket_dir)
+            except FileNotFoundError:
+                names = []
+            paths = [os.path.join(self.socket_dir, name) for name in names if name.endswith('.sock')]
+            self._peers = (paths, time.monotonic())
+        own = self._path if self._pid == os.getpid() else None
+        return [path for path in paths if path != own]
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def parse_since_version(value):
+    """:return: The ``since_version`` cursor as an int, or None when it is not given."""
+    if value is None or value == '':
+        return None
+    try:
+        version = int(value)
+    except (TypeError, ValueError):
+        version = -1
+    if version < 0:
+        raise ValueError("since_version must be a non-negative integer")
+    return version
+
+
+def parse_timeout(value, maximum):
+    """:return: The long-poll ``timeout`` in seconds, capped at ``maximum``; ``maximum`` when not given."""
+    if value is None:
+        return maximum
+    try:
+        return min(max(float(value), 0.0), maximum)
+    except (TypeError, ValueError):
+        raise ValueError("timeout must be a number of seconds")
+
+
+def format_event(event, dumps):
+    """
+        Encodes one event for a text/event-stream response.
+
+        The SSE id is the wallet version, so a client that reconnects resumes from its Last-Event-ID.
+        """
+    return f"id: {event['version']}\nevent: balance\ndata: {dumps(event, separators=(',', ':'))}\n\n"
+
+
+def hub():
+    """:return: The app's EventHub, or None outside an app context."""
+    return current_app.extensions.get(EVENTS) if has_app_context() else None
+
+
+def publish(*wallet_ids):
+    """Tells waiting readers that the wallets changed; call it after the write has committed."""
+    instance = hub()
+    if instance is not None:
+        instance.publish(wallet_ids)
+
+
+def wait_for_change(wallet_id, changed, timeout):
+    """
+        Blocks the calling thread until ``changed()`` is true or ``timeout`` seconds have passed.
+
+        ``changed`` is checked once after subscribing, so a write that commits between the caller's last
+        read and the subscription is not missed, and again after every notification for the wallet.
+
+        :return: The last result of ``changed()``.
+        """
+    instance = hub()
+    woken = threading.Event()
+    instance.subscribe(wallet_id, woken.set)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            result = changed()
+            remaining = deadline - time.monotonic()
+            if result or remaining <= 0:
+                return result
+            woken.wait(remaining)
+            woken.clear()
+    finally:
+        instance.unsubscribe(wallet_id, woken.set)
+
+
+def acquire_waiter():
+    """:return: Whether a WSGI request may hold its worker thread to wait for changes; see ``release_waiter``."""
+    return current_app.extensions[WSGI_WAITERS].acquire(blocking=False)
+
+
+def release_waiter():
+    current_app.extensions[WSGI_WAITERS].release()
+
+
+def init_app(app):
+    app.extensions[EVENTS] = EventHub(app.config['EVENTS_SOCKET_DIR'])
+    app.extensions[WSGI_WAITERS] = threading.BoundedSemaphore(app.config['EVENTS_WSGI_MAX_WAITERS'])
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+from collections import defaultdict, Counter
+from flask import Response, current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+
+slow_query_log = logging.getLogger('app.sql.slow')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+# Per request SQL counters, also reported per endpoint
+SQL_COUNTERS = ('queries', 'query_seconds', 'commits', 'rollbacks', 'cas_retries')
+BACKGROUND = 'background'  # label for work outside a request (CLI commands, pipeline workers)
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class Metrics:
+    """
+    Request and SQL instrumentation for one app.
+
+    Requests are timed from before_request to after_request. SQLAlchemy engine events count queries,
+    query time, commits and rollbacks, failed statements included; they are added up per request in ``g``
+    and folded into the per-endpoint totals at teardown, which also runs for requests that ended in an
+    unhandled exception (counted as 500), so a handler that suddenly issues many more queries
+    per request (an N+1 pattern) shows up in ``wallet_sql_queries_per_request``.
+    """
+
+    def __init__(self, slow_query_threshold_ms=None):
+        self.slow_query_threshold = slow_query_threshold_ms / 1000 if slow_query_threshold_ms is not None else None
+        self.requests = Counter()  # (endpoint, method, status) -> count
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.queries_per_request = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))
+        self.sql = Counter()  # (endpoint, counter) -> value
+        self._lock = threading.Lock()
+
+    def record(self, name, amount=1):
+        """Adds to a SQL counter of the current request, or to the background totals outside one."""
+        if has_request_context():
+            stats = g.get('sql_stats')
+            if stats is not None:
+                stats[name] += amount
+                return
+        with self._lock:
+            self.sql[(BACKGROUND, name)] += amount
+
+    def before_request(self):
+        g.request_started = time.perf_counter()
+        g.sql_stats = Counter()
+
+    def after_request(self, response):
+        started = g.get('request_started')
+        if started is not None:
+            g.request_elapsed = time.perf_counter() - started
+            g.response_status = response.status_code
+        return response
+
+    def teardown_request(self, exc):
+        started = g.pop('request_started', None)
+        stats = g.pop('sql_stats', Counter())
+        if started is None:
+            return
+        # Without a response the request failed with an unhandled exception
+        elapsed = g.pop('request_elapsed', None)
+        if elapsed is None:
+            elapsed = time.perf_counter() - started
+        status = g.pop('response_status', 500)
+        endpoint = request.endpoint or 'unmatched'
+        with self._lock:
+            self.requests[(endpoint, request.method, status)] += 1
+            self.latency[endpoint].observe(elapsed)
+            self.queries_per_request[endpoint].observe(stats['queries'])
+            for name in SQL_COUNTERS:
+                self.sql[(endpoint, name)] += stats[name]
+
+    def instrument(self, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_started', []).append((context, time.perf_counter()))
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            self._finish_query(conn, statement)
+
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(context):
+            # A failed statement (e.g. "database is locked") never reaches after_cursor_execute; pop its
+            # start time here, or the next statement on this pooled connection would be timed from it.
+            # Only a statement that got as far as before_cursor_execute has one.
+            conn = context.connection
+            started = conn.info.get('query_started') if conn is not None else None
+            if started and context.execution_context is not None and started[-1][0] is context.execution_context:
+                self._finish_query(conn, context.statement)
+
+        @event.listens_for(engine, 'commit')
+        def commit(conn):
+            self.record('commits')
+
+        @event.listens_for(engine, 'rollback')
+        def rollback(conn):
+            self.record('rollbacks')
+
+    def _finish_query(self, conn, statement):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()[1]
+        self.record('queries')
+        self.record('query_seconds', elapsed)
+        if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+            slow_query_log.warning('Slow query (%.1f ms): %s', elapsed * 1000, statement)
+
+    def render(self, extra=()):
+        """:return: Everything in Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines += ['# HELP wallet_http_requests_total Requests by endpoint, method and status.',
+                      '# TYPE wallet_http_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'wallet_http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+
+            lines += ['# HELP wallet_http_request_duration_seconds Request latency by endpoint.',
+                      '# TYPE wallet_http_request_duration_seconds histogram']
+            for endpoint, histogram in sorted(self.latency.items()):
+                lines += histogram.render('wallet_http_request_duration_seconds', f'endpoint="{endpoint}"')
+
+            lines += ['# HELP wallet_sql_queries_per_request SQL statements issued per request.',
+                      '# TYPE wallet_sql_queries_per_request histogram']
+            for endpoint, histogram in sorted(self.queries_per_request.items()):
+                lines += histogram.render('wallet_sql_queries_per_request', f'endpoint="{endpoint}"')
+
+            for name, help_text in (
+                    ('queries', 'SQL statements executed.'),
+                    ('query_seconds', 'Time spent executing SQL statements.'),
+                    ('commits', 'Database commits.'),
+                    ('rollbacks', 'Database rollbacks.'),
+                    ('cas_retries', 'Compare-and-swap retries after a write conflict.')):
+                metric = f'wallet_sql_{name}_total' if name != 'cas_retries' else 'wallet_cas_retries_total'
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+                for (endpoint, counter), value in sorted(self.sql.items()):
+                    if counter == name:
+                        lines.append(f'{metric}{{endpoint="{endpoint}"}} {value}')
+
+        for metric, metric_type, help_text, value in extra:
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {metric_type}', f'{metric} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def metrics():
+    return current_app.extensions['metrics']
+
+
+def record(name, amount=1):
+    """Adds to a per-request SQL counter when metrics are enabled; a no-op otherwise."""
+    if has_app_context() and 'metrics' in current_app.extensions:
+        current_app.extensions['metrics'].record(name, amount)
+
+
+def _process_metrics():
+    from app.admission import controller
+    from app.services import contention, write_pipeline, balance_cache
+
+    cache = balance_cache().stats()
+    extra = [
+        ('wallet_cas_conflicts_total', 'counter', 'Compare-and-swap conflicts in this process.', contention['conflicts']),
+        ('wallet_cas_exhausted_total', 'counter', 'Writes that gave up after all retries.', contention['exhausted']),
+        ('wallet_balance_cache_hits_total', 'counter', 'Balance cache hits.', cache['hits']),
+        ('wallet_balance_cache_misses_total', 'counter', 'Balance cache misses.', cache['misses']),
+        ('wallet_balance_cache_entries', 'gauge', 'Balances currently cached.', cache['size']),
+    ]
+    pipeline = write_pipeline()
+    if pipeline is not None:
+        extra += [
+            ('wallet_write_pipeline_batches_total', 'counter', 'Group commits made by the write pipeline.', pipeline.batches),
+            ('wallet_write_pipeline_items_total', 'counter', 'Writes applied by the write pipeline.', pipeline.items),
+        ]
+    admission = controller()
+    if admission is not None:
+        stats = admission.stats(top=0)
+        extra += [
+            ('wallet_admission_in_flight', 'gauge', 'Write requests currently admitted.', stats['in_flight']),
+            ('wallet_admission_waiting', 'gauge', 'Write requests queued for admission.', stats['waiting']),
+            ('wallet_admission_admitted_total', 'counter', 'Write requests admitted.', stats['admitted']),
+        ] + [
+            (f'wallet_admission_rejected_{reason}_total', 'counter', f'Write requests rejected with 429 ({reason}).',
+             stats['rejected'].get(reason, 0))
+            for reason in ('queue_full', 'timeout')
+        ]
+    return extra
+
+
+def metrics_view():
+    return Response(metrics().render(_process_metrics()), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app, engines):
+    app.extensions['metrics'] = instance = Metrics(app.config.get('SLOW_QUERY_THRESHOLD_MS'))
+    for engine in engines:
+        instance.instrument(engine)
+    app.before_request(instance.before_request)
+    app.after_request(instance.after_request)
+    app.teardown_request(instance.teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view, methods=['GET'])
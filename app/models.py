@@ -7,18 +7,86 @@ class User(db.Model):
 
 class Wallet(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True, index=True)  # one wallet per user
     balance = db.Column(db.Float, nullable=False, default=0.0)
     version = db.Column(db.Integer, default=0)  # Add a version column for optimistic locking
+    shard_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 0: not sharded
     user = db.relationship('User', backref=db.backref('wallets', lazy=True))
 
 
+class WalletShard(db.Model):
+    """
+    Credits to a sharded wallet that have not been folded into Wallet.balance yet.
+
+    The wallet's balance is Wallet.balance plus the sum of its shards, and its version is Wallet.version
+    plus the sum of the shard versions, so every credit still moves the version an ETag is built from.
+    """
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallet.id'), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    balance = db.Column(db.Float, nullable=False, default=0.0)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
 class WalletTransaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     wallet_id = db.Column(db.Integer, db.ForeignKey('wallet.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     type = db.Column(db.String(20), nullable=False)  # 'credit' or 'debit'
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.now())
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.now)  # evaluated per row
+    transfer_id = db.Column(db.String(32), index=True)  # links the debit and credit of a transfer
+    balance_after = db.Column(db.Float)  # wallet balance once this row was applied; NULL until a shard credit is folded
+    version = db.Column(db.Integer)  # wallet version the row was committed with; NULL for rows older than the column
 
     wallet = db.relationship('Wallet', backref=db.backref('transactions', lazy=True))
 
+    # History and totals are always filtered by wallet and time range
+    __table_args__ = (
+        db.Index('ix_wallet_transaction_wallet_id_timestamp', 'wallet_id', 'timestamp'),
+        # Change feed replay: the rows of a wallet committed after a version
+        db.Index('ix_wallet_transaction_wallet_id_version', 'wallet_id', 'version'),
+        # Shard credits waiting to be settled by the next fold; partial, so it only holds those rows
+        db.Index('ix_wallet_transaction_unsettled', 'wallet_id', sqlite_where=db.text('balance_after IS NULL'),
+                 postgresql_where=db.text('balance_after IS NULL')),
+    )
+
+
+
+class WalletTransactionArchive(db.Model):
+    """
+    Cold storage for WalletTransaction rows older than the archive horizon.
+
+    Rows keep their original id, so keyset cursors stay valid across the hot and the archived ledger.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallet.id'), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    type = db.Column(db.String(20), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    transfer_id = db.Column(db.String(32), index=True)
+    balance_after = db.Column(db.Float)
+    version = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_wallet_transaction_archive_wallet_id_timestamp', 'wallet_id', 'timestamp'),
+    )
+
+
+class WalletDailyTotals(db.Model):
+    """Per wallet and day rollup of the ledger, maintained in the same transaction as every ledger write."""
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallet.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    # 0 for the wallet itself, n + 1 for credits to wallet shard n; readers sum over it
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False, default=0, server_default='0')
+    credit_sum = db.Column(db.Float, nullable=False, default=0.0)
+    debit_sum = db.Column(db.Float, nullable=False, default=0.0)
+    txn_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(db.Model):
+    """Stored response of a write made with an Idempotency-Key header, committed together with the write."""
+    key = db.Column(db.String(128), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)  # hash of the request the key was first used with
+    wallet_id = db.Column(db.Integer, db.ForeignKey('wallet.id'), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.Text, nullable=False)  # JSON body
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)  # for the TTL purge
@@ -1,10 +1,105 @@
-from flask import Blueprint, request, jsonify
-from .services import create_wallet, credit_money, debit_money, get_balance, transaction_history,create_user
+import csv
+import hashlib
+import io
+import json
+import time
+import zlib
+from flask import Blueprint, Response, current_app, request, jsonify, make_response, stream_with_context
+from .services import create_wallet, credit_money, debit_money, transaction_history,create_user, \
+    apply_batch, transaction_totals, balance_cache, write_pipeline, bulk_create_users, bulk_create_wallets, \
+    export_transactions, transfer_money, get_balances, balance_as_of, get_balance_and_version, wallet_version, \
+    find_idempotent_response, ledger_summary, wallet_events, parse_amounts, WriteTimeout
+from concurrent.futures import TimeoutError
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from . import db
+from .admission import Overloaded, admit, controller as admission_controller
+from .events import acquire_waiter, format_event, parse_since_version, parse_timeout, release_waiter, \
+    wait_for_change
 
 # Create a Blueprint for better organization
 wallet_bp = Blueprint('wallet', __name__)
+IDEMPOTENCY_KEY_MAX_LENGTH = 128  # length of IdempotencyKey.key
 
 
+def _write(txn_type, wallet_id, amount, minimum_balance=100, idempotency_key=None):
+    # Validated before picking a path, so the pipeline rejects exactly what a direct write rejects
+    amount, minimum_balance = parse_amounts(amount, minimum_balance)
+    pipeline = write_pipeline()
+    # Keyed writes store their response in their own transaction, so they skip the group commit
+    if pipeline is None or idempotency_key is not None:
+        write = credit_money if txn_type == 'credit' else debit_money
+        with admit(wallet_id):
+            return write(wallet_id, amount, minimum_balance, idempotency_key=idempotency_key)
+    # The pipeline already applies a wallet's writes one group commit at a time, so only the global
+    # slot is taken: a per-wallet slot would cap the group commit at ADMISSION_MAX_PER_WALLET writes
+    with admit():
+        return _pipelined_write(pipeline, txn_type, wallet_id, amount, minimum_balance)
+
+def _pipelined_write(pipeline, txn_type, wallet_id, amount, minimum_balance):
+    future = pipeline.submit(wallet_id, txn_type, amount, minimum_balance)
+    try:
+        return future.result(current_app.config['WRITE_PIPELINE_TIMEOUT'])
+    except TimeoutError:
+        if future.cancel():
+            raise WriteTimeout(applied=False)
+    # A worker already took the write; it may have just finished
+    try:
+        return future.result(0)
+    except TimeoutError:
+        raise WriteTimeout(applied=None)
+
+def _replay(key, txn_type, wallet_id, amount, minimum_balance):
+    replay = find_idempotent_response(key, txn_type, wallet_id, amount, minimum_balance)
+    if replay is None:
+        return None
+    status_code, body = replay
+    return jsonify(body), status_code, {'Idempotent-Replayed': 'true'}
+
+def _credit_or_debit(txn_type, wallet_id, amount, minimum_balance=100):
+    """Runs a credit or debit, honouring an optional Idempotency-Key header."""
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        return jsonify(error=f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters"), 400
+    try:
+        replayed = key and _replay(key, txn_type, wallet_id, amount, minimum_balance)
+        if replayed:
+            return replayed
+        new_balance = _write(txn_type, wallet_id, amount, minimum_balance, idempotency_key=key)
+        return jsonify(new_balance=new_balance), 200
+    except ValueError as e:
+        if key:
+            # A concurrent request with the same key may have committed first
+            try:
+                replayed = _replay(key, txn_type, wallet_id, amount, minimum_balance)
+            except ValueError:
+                replayed = None
+            if replayed:
+                return replayed
+        return jsonify(error=str(e)), 400
+
+@wallet_bp.errorhandler(Overloaded)
+def overloaded(e):
+    return jsonify(error="Too many concurrent requests, please retry later"), 429, {'Retry-After': str(e.retry_after)}
+
+@wallet_bp.errorhandler(WriteTimeout)
+def write_timeout(e):
+    if e.applied is False:
+        return jsonify(error="Timed out waiting for the write; it was not applied and can be retried"), 503
+    # Not a 400: the money may still move, and a blind retry could apply it twice
+    return jsonify(error="Timed out waiting for the write to commit; its outcome is unknown, check the wallet "
+                         "before retrying", outcome="unknown"), 504
+
+@wallet_bp.route('/ready', methods=['GET'])
+def api_ready():
+    """Readiness probe: 200 once the database answers, 503 otherwise."""
+    try:
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+    except SQLAlchemyError:
+        return jsonify(status="unavailable"), 503
+    return jsonify(status="ready"), 200
+
 @wallet_bp.route('/wallet/create', methods=['POST'])
 def api_create_wallet():
     user_id = request.json.get('user_id')
@@ -22,11 +117,7 @@ def api_credit_money():
     amount = request.json.get('amount')
     if not all([wallet_id, amount]):
         return jsonify(error="Wallet ID and amount are required"), 400
-    try:
-        new_balance = credit_money(wallet_id, amount)
-        return jsonify(new_balance=new_balance), 200
-    except ValueError as e:
-        return jsonify(error=str(e)), 400
+    return _credit_or_debit('credit', wallet_id, amount)
 
 @wallet_bp.route('/wallet/debit', methods=['POST'])
 def api_debit_money():
@@ -35,33 +126,262 @@ def api_debit_money():
     minimum_balance = request.json.get('minimum_balance', 100)  # Optional minimum balance from request
     if not all([wallet_id, amount]):
         return jsonify(error="Wallet ID and amount are required"), 400
+    return _credit_or_debit('debit', wallet_id, amount, minimum_balance)
+
+@wallet_bp.route('/wallet/transfer', methods=['POST'])
+def api_transfer_money():
+    source_wallet_id = request.json.get('source_wallet_id')
+    destination_wallet_id = request.json.get('destination_wallet_id')
+    amount = request.json.get('amount')
+    minimum_balance = request.json.get('minimum_balance', 100)
+    if not all([source_wallet_id, destination_wallet_id, amount]):
+        return jsonify(error="Source wallet ID, destination wallet ID and amount are required"), 400
     try:
-        new_balance = debit_money(wallet_id, amount, minimum_balance)
-        return jsonify(new_balance=new_balance), 200
+        with admit(source_wallet_id, destination_wallet_id):
+            transfer = transfer_money(source_wallet_id, destination_wallet_id, amount, minimum_balance)
+        return jsonify(transfer), 200
     except ValueError as e:
         return jsonify(error=str(e)), 400
 
+@wallet_bp.route('/wallet/batch', methods=['POST'])
+def api_batch():
+    operations = request.json.get('operations')
+    mode = request.json.get('mode', 'atomic')
+    if not isinstance(operations, list) or not operations:
+        return jsonify(error="A non-empty list of operations is required"), 400
+    if mode not in ('atomic', 'best_effort'):
+        return jsonify(error="Mode must be 'atomic' or 'best_effort'"), 400
+    if len(operations) > current_app.config['BATCH_MAX_OPERATIONS']:
+        return jsonify(error=f"At most {current_app.config['BATCH_MAX_OPERATIONS']} operations per batch"), 400
+    try:
+        # A batch may touch thousands of wallets, so it only takes a global slot
+        with admit():
+            outcome = apply_batch(operations, atomic=(mode == 'atomic'))
+        return jsonify(outcome), 200 if outcome['committed'] else 400
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+def _not_modified(etag):
+    """:return: A 304 response if the client already holds ``etag``, else None."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def balance_etag(wallet_id, version):
+    return f'wallet-{wallet_id}-v{version}'
+
+def history_etag(wallet_id, version, args):
+    """ETag of a history query: the same query against the same wallet version always has the same answer."""
+    query = hashlib.sha1(json.dumps(sorted(args)).encode()).hexdigest()[:16]
+    return f'wallet-{int(wallet_id)}-v{version}-{query}'
+
+def _balance_response(wallet_id):
+    balance, version = get_balance_and_version(wallet_id)
+    etag = balance_etag(wallet_id, version)
+    response = _not_modified(etag) or jsonify(balance=balance)
+    response.set_etag(etag)
+    return response
+
 @wallet_bp.route('/wallet/balance/<int:wallet_id>', methods=['GET'])
 def api_get_balance(wallet_id):
     try:
-        balance = get_balance(wallet_id)
-        return jsonify(balance=balance), 200
+        return _balance_response(wallet_id)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+@wallet_bp.route('/wallet/<int:wallet_id>/balance', methods=['GET'])
+def api_get_balance_as_of(wallet_id):
+    as_of = request.args.get('as_of')
+    try:
+        if as_of is None:
+            return _balance_response(wallet_id)
+        return jsonify(balance_as_of(wallet_id, as_of)), 200
     except ValueError as e:
         return jsonify(error=str(e)), 400
 
+@wallet_bp.route('/wallet/balances', methods=['GET', 'POST'])
+def api_get_balances():
+    if request.method == 'POST':
+        ids = request.json.get('ids')
+    else:
+        ids = [i for i in request.args.get('ids', '').split(',') if i.strip()]
+    try:
+        if not isinstance(ids, list) or not ids:
+            raise ValueError
+        wallet_ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        return jsonify(error="A list of wallet ids is required"), 400
+    if len(wallet_ids) > current_app.config['BALANCES_MAX_IDS']:
+        return jsonify(error=f"At most {current_app.config['BALANCES_MAX_IDS']} wallet ids per request"), 400
+    return jsonify(get_balances(wallet_ids)), 200
+
+@wallet_bp.route('/wallet/cache/stats', methods=['GET'])
+def api_balance_cache_stats():
+    return jsonify(balance_cache().stats()), 200
+
+@wallet_bp.route('/wallet/admission/stats', methods=['GET'])
+def api_admission_stats():
+    instance = admission_controller()
+    if instance is None:
+        return jsonify(error="Admission control is disabled"), 404
+    return jsonify(instance.stats()), 200
+
 @wallet_bp.route('/wallet/transactions', methods=['GET'])
 def api_transaction_history():
     wallet_id = request.args.get('wallet_id')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    after = request.args.get('after')
+    limit = request.args.get('limit', current_app.config['HISTORY_PAGE_SIZE'], type=int)
+    totals_only = request.args.get('totals_only', 'false').lower() == 'true'
     if not wallet_id:
         return jsonify(error="Wallet ID is required"), 400
+    version = wallet_version(wallet_id)
+    etag = None
+    if version is not None:
+        etag = history_etag(wallet_id, version, request.args.items(multi=True))
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
+    response = make_response(_transaction_history_response(wallet_id, start_date, end_date, after, limit, totals_only))
+    if etag is not None and response.status_code == 200:
+        response.set_etag(etag)
+    return response
+
+def _transaction_history_response(wallet_id, start_date, end_date, after, limit, totals_only):
+    if totals_only:
+        try:
+            return jsonify(transaction_totals(wallet_id, start_date, end_date)), 200
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+    if not 0 < limit <= current_app.config['HISTORY_MAX_PAGE_SIZE']:
+        return jsonify(error=f"Limit must be between 1 and {current_app.config['HISTORY_MAX_PAGE_SIZE']}"), 400
     try:
-        history = transaction_history(wallet_id, start_date, end_date)
+        history = transaction_history(wallet_id, start_date, end_date, limit=limit, after=after)
         return jsonify(history), 200
     except ValueError as e:
         return jsonify(error=str(e)), 400
 
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', None,
+               '{{"id":{0},"amount":{1!r},"type":"{2}","timestamp":"{3}"}}\n'),
+    'csv': ('text/csv', 'id,amount,type,timestamp\n', '{0},{1!r},{2},{3}\n'),
+}
+
+def _export_chunks(rows, header, line, chunk_bytes=65536):
+    """Formats rows into roughly ``chunk_bytes`` sized strings so the response is written in few, large pieces."""
+    buffer, size = [header] if header else [], 0
+    for row in rows:
+        text = line.format(row.id, row.amount, row.type, row.timestamp.isoformat())
+        buffer.append(text)
+        size += len(text)
+        if size >= chunk_bytes:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+@wallet_bp.route('/analytics/summary', methods=['GET'])
+def api_analytics_summary():
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    if not start_date or not end_date:
+        return jsonify(error="start_date and end_date are required"), 400
+    try:
+        top = int(request.args.get('top', 10))
+    except ValueError:
+        return jsonify(error="top must be an integer"), 400
+    try:
+        return jsonify(ledger_summary(start_date, end_date, top)), 200
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+@wallet_bp.route('/wallet/<int:wallet_id>/events', methods=['GET'])
+def api_wallet_events(wallet_id):
+    config = current_app.config
+    try:
+        since_version = parse_since_version(request.args.get('since_version', request.headers.get('Last-Event-ID')))
+        timeout = parse_timeout(request.args.get('timeout'), config['EVENTS_LONG_POLL_TIMEOUT'])
+        events, cursor = wallet_events(wallet_id, since_version, config['EVENTS_REPLAY_LIMIT'])
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    stream = request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
+    # A waiting client holds a worker thread, so only a few may wait at once; the asyncio read API
+    # (asgi.py) waits on coroutines instead and is where subscribers belong
+    if (stream or not events and timeout > 0) and not acquire_waiter():
+        return jsonify(error="Too many clients waiting for events, please retry later"), 503, {'Retry-After': '1'}
+
+    if stream:
+        response = Response(stream_with_context(_event_stream(wallet_id, events, cursor)),
+                            mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        response.call_on_close(release_waiter)
+        return response
+
+    # Long poll: answer at once if something changed after the cursor, else wait for the next write
+    state = {'events': events, 'cursor': cursor}
+
+    def changed():
+        if not state['events']:
+            state['events'], state['cursor'] = wallet_events(wallet_id, since_version, config['EVENTS_REPLAY_LIMIT'])
+        return bool(state['events'])
+    if not events and timeout > 0:
+        try:
+            wait_for_change(wallet_id, changed, timeout)
+        finally:
+            release_waiter()
+    return jsonify(events=state['events'], version=state['cursor']), 200
+
+def _event_stream(wallet_id, events, cursor):
+    config = current_app.config
+    state = {'events': events, 'cursor': cursor}
+    # Ends like a long poll, to give the worker thread back; EventSource reconnects with Last-Event-ID
+    deadline = time.monotonic() + config['EVENTS_LONG_POLL_TIMEOUT']
+
+    def changed():
+        state['events'], state['cursor'] = wallet_events(wallet_id, state['cursor'], config['EVENTS_REPLAY_LIMIT'])
+        return bool(state['events'])
+    while True:
+        if state['events']:
+            yield ''.join(format_event(event, current_app.json.dumps) for event in state['events'])
+        else:
+            yield ': keep-alive\n\n'
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        wait_for_change(wallet_id, changed, min(config['EVENTS_HEARTBEAT'], remaining))
+
+@wallet_bp.route('/wallet/<int:wallet_id>/transactions/export', methods=['GET'])
+def api_export_transactions(wallet_id):
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify(error="Format must be 'ndjson' or 'csv'"), 400
+    try:
+        rows = export_transactions(wallet_id)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    mimetype, header, line = EXPORT_FORMATS[export_format]
+    chunks = _export_chunks(rows, header, line)
+    headers = {
+        'Content-Disposition': f'attachment; filename=wallet-{wallet_id}-transactions.{export_format}',
+        'Vary': 'Accept-Encoding',
+    }
+    if request.accept_encodings['gzip']:
+        chunks = _gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
 @wallet_bp.route('/register', methods=['POST'])
 def register_user():
     phone_number = request.json.get('phone_number')
@@ -77,5 +397,54 @@ def register_user():
     except ValueError as e:
         return jsonify(error=str(e)), 400
 
+def _read_records(field):
+    """Yields the ``field`` of every record in a streamed text/csv or NDJSON request body (None if unreadable)."""
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    if request.mimetype == 'text/csv':
+        column = 0
+        for number, row in enumerate(csv.reader(lines)):
+            if not row:
+                continue
+            if number == 0 and field in row:  # header row
+                column = row.index(field)
+                continue
+            yield row[column].strip() if len(row) > column else None
+    else:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            yield record.get(field) if isinstance(record, dict) else record
+
+def _stream_ndjson(results, lines_per_write=1000):
+    def generate():
+        buffer = []
+        try:
+            for result in results:
+                buffer.append(json.dumps(result))
+                if len(buffer) >= lines_per_write:
+                    yield '\n'.join(buffer) + '\n'
+                    buffer = []
+        except ValueError as e:
+            buffer.append(json.dumps({'error': str(e)}))
+        if buffer:
+            yield '\n'.join(buffer) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@wallet_bp.route('/register/bulk', methods=['POST'])
+def register_users_bulk():
+    phone_numbers = (str(p) if p is not None else None for p in _read_records('phone_number'))
+    return _stream_ndjson(bulk_create_users(phone_numbers, current_app.config['BULK_CHUNK_SIZE']))
+
+@wallet_bp.route('/wallet/create/bulk', methods=['POST'])
+def api_create_wallets_bulk():
+    user_ids = _read_records('user_id')
+    return _stream_ndjson(bulk_create_wallets(user_ids, current_app.config['BULK_CHUNK_SIZE']))
+
 def init_app(app):
     app.register_blueprint(wallet_bp)
@@ -1,7 +1,28 @@
+import base64
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import queue
+import random
+import threading
 import time
-from app.models import db, Wallet, User, WalletTransaction
-from sqlalchemy.exc import SQLAlchemyError, IntegrityError
-from sqlalchemy.orm.exc import StaleDataError
+import uuid
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from itertools import chain
+import numpy as np
+from flask import current_app
+from app.models import db, Wallet, User, WalletTransaction, WalletTransactionArchive, WalletDailyTotals, \
+    IdempotencyKey, WalletShard
+from app.storage import create_worker_engine, engine_spec, reader_engine
+from app import events, metrics, snapshots
+from sqlalchemy import String, and_, case, cast, delete, func, insert, or_, select, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError, OperationalError
 
 
 def create_wallet(user_id):
@@ -19,40 +40,545 @@ def create_wallet(user_id):
         db.session.add(new_wallet)
         db.session.commit()
         return new_wallet
+    except IntegrityError:
+        # A concurrent request created the user's wallet first
+        db.session.rollback()
+        existing_wallet = Wallet.query.filter_by(user_id=user_id).first()
+        if existing_wallet is None:
+            raise ValueError("Database error: Unable to create wallet")
+        raise ValueError("User already has a wallet with id:"+str(existing_wallet.id))
     except SQLAlchemyError as e:
         db.session.rollback()
         raise ValueError("Database error: Unable to create wallet")
 
-def credit_money(wallet_id, amount, minimum_balance=100):
+# Process-wide compare-and-swap counters: conflicts seen, retries slept for and operations given up
+contention = Counter()
+_contention_lock = threading.Lock()
+
+
+def _count_contention(name):
+    with _contention_lock:
+        contention[name] += 1
+    if name == 'retries':
+        metrics.record('cas_retries')
+
+
+def _backoff_delay(attempt, base_delay, max_delay):
+    """Full-jitter exponential backoff: a random delay in [0, min(max_delay, base_delay * 2**attempt)]."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def _compare_and_swap(wallet_id, delta, floor, version):
+    """
+        Applies ``delta`` to the wallet balance with a single guarded UPDATE.
+
+        The row is only touched if it is still at ``version`` and the resulting balance stays at or above
+        ``floor``, so the check and the write happen atomically inside the database. Pass ``floor=None``
+        when the caller already validated the balance it read at ``version``.
+
+        :return: True if the row was updated, False if the guard did not match.
+        """
+    stmt = (
+        update(Wallet)
+        .where(Wallet.id == wallet_id)
+        .where(func.coalesce(Wallet.version, 0) == version)
+        .values(balance=Wallet.balance + delta, version=func.coalesce(Wallet.version, 0) + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if floor is not None:
+        stmt = stmt.where(Wallet.balance + delta >= floor)
+    return db.session.execute(stmt).rowcount == 1
+
+
+def _shard_sum(column):
+    # Correlated sum over the wallet's shards; the CASE skips the probe for wallets that are not sharded
+    shards = select(func.coalesce(func.sum(column), 0)).where(WalletShard.wallet_id == Wallet.id)
+    return case((Wallet.shard_count > 0, shards.scalar_subquery()), else_=0)
+
+
+def _total_balance():
+    """Wallet balance including the credits still held in its shards, as a column expression."""
+    return (Wallet.balance + _shard_sum(WalletShard.balance)).label('balance')
+
+
+def _total_version():
+    """Wallet version including its shard versions, so it also moves on every sharded credit."""
+    return (func.coalesce(Wallet.version, 0) + _shard_sum(WalletShard.version)).label('version')
+
+
+def _credit_shard(wallet_id, shard_count, amount):
+    """
+        Adds a credit to a random shard of the wallet. The UPDATE is relative, so it never conflicts.
+
+        :return: The shard credited.
+        """
+    shard = random.randrange(shard_count)
+    db.session.execute(
+        update(WalletShard)
+        .where(WalletShard.wallet_id == wallet_id, WalletShard.shard == shard)
+        .values(balance=WalletShard.balance + amount, version=WalletShard.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return shard
+
+
+def _fold_shards(wallet_id, balance):
+    """
+        Empties the shards of a sharded wallet within the caller's transaction.
+
+        The shards are locked first with a relative version bump, so the balances read next cannot change
+        until the caller commits, and each is then taken out with a relative UPDATE. A credit arriving
+        meanwhile waits for the shard instead of making the fold fail, so a debit on a hot wallet does not
+        keep losing to a stream of credits. The caller adds the folded amount to Wallet.balance with its
+        own compare-and-swap in the same transaction. The folded credits get their ``balance_after``
+        counted up from ``balance``, the wallet balance before the fold.
+
+        :return: (folded amount, sum of the shard versions after the fold)
+        """
+    db.session.execute(
+        update(WalletShard)
+        .where(WalletShard.wallet_id == wallet_id)
+        .values(version=WalletShard.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    shards = db.session.execute(
+        select(WalletShard.shard, WalletShard.balance, WalletShard.version).where(WalletShard.wallet_id == wallet_id)
+    ).all()
+    for shard in shards:
+        if shard.balance:
+            db.session.execute(
+                update(WalletShard)
+                .where(WalletShard.wallet_id == wallet_id, WalletShard.shard == shard.shard)
+                .values(balance=WalletShard.balance - shard.balance)
+                .execution_options(synchronize_session=False)
+            )
+    _settle_shard_credits(wallet_id, balance)
+    return sum(shard.balance for shard in shards), sum(shard.version for shard in shards)
+
+
+def _settle_shard_credits(wallet_id, balance):
+    # Shard credits are written without balance_after; once folded their running balance is known
+    rows = db.session.execute(
+        select(WalletTransaction.id, WalletTransaction.amount)
+        .where(WalletTransaction.wallet_id == wallet_id, WalletTransaction.balance_after.is_(None))
+        .order_by(WalletTransaction.timestamp, WalletTransaction.id)
+    ).all()
+    settled = []
+    for row in rows:
+        balance += row.amount
+        settled.append({'id': row.id, 'balance_after': balance})
+    if settled:
+        db.session.execute(update(WalletTransaction), settled)
+
+
+def balance_cache():
+    return current_app.extensions['balance_cache']
+
+
+def idempotency_cache():
+    return current_app.extensions['idempotency_cache']
+
+
+def analytics_cache():
+    return current_app.extensions['analytics_cache']
+
+
+def _read(stmt):
+    """
+        Runs a read-only statement on the reader engine and returns all rows.
+
+        Falls back to the request session when there is no separate reader (in-memory SQLite).
+        """
+    engine = reader_engine()
+    if engine is None:
+        return db.session.execute(stmt).all()
+    with engine.connect() as connection:
+        return connection.execute(stmt).all()
+
+
+def _run_plan(plan):
+    """
+        Runs a read plan synchronously.
+
+        A read plan is a generator that yields SELECT statements, receives each result as a list of rows and
+        returns its answer. The query logic of a read is written once and can be run here through ``_read``
+        or by the asyncio read API on an async connection (see ``run_plan_async``).
+        """
     try:
-        wallet = Wallet.query.get(wallet_id)
-        if not wallet:
-            raise ValueError("Wallet not found")
+        stmt = next(plan)
+        while True:
+            stmt = plan.send(_read(stmt))
+    except StopIteration as done:
+        return done.value
+
+
+async def run_plan_async(plan, engine):
+    """Runs a read plan on an SQLAlchemy AsyncEngine; a connection is only checked out if the plan queries."""
+    try:
+        stmt = next(plan)
+    except StopIteration as done:
+        return done.value
+    async with engine.connect() as connection:
+        try:
+            while True:
+                stmt = plan.send((await connection.execute(stmt)).all())
+        except StopIteration as done:
+            return done.value
+
+
+def _stream(stmt, batch_size=1000):
+    """
+        Yields the rows of a read-only statement from a server-side cursor, ``batch_size`` at a time.
+
+        Uses the reader engine when there is one, so a long export never holds a connection of the write
+        path.
+        """
+    for partition in _stream_partitions(stmt, batch_size):
+        yield from partition
+
+
+def _stream_partitions(stmt, size):
+    """Like ``_stream``, but yields the rows in lists of at most ``size``."""
+    stmt = stmt.execution_options(yield_per=size)
+    engine = reader_engine()
+    if engine is None:
+        yield from db.session.execute(stmt).partitions()
+        return
+    with engine.connect() as connection:
+        yield from connection.execute(stmt).partitions()
+
+
+def _wallet_exists(wallet_id):
+    return bool(_read(select(Wallet.id).where(Wallet.id == wallet_id)))
+
+
+def _upsert(table):
+    """INSERT ... ON CONFLICT for the dialect of the current session."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def _record_transactions(transactions, rollup_shard=0):
+    """
+        Inserts ledger rows and folds them into WalletDailyTotals within the caller's transaction.
+
+        :param transactions: List of dicts with ``wallet_id``, ``amount``, ``type``, ``balance_after`` and
+            ``version``. A ``timestamp`` is filled in when missing so the row and its rollup day always agree.
+        :param rollup_shard: Rollup row to add to; a credit on wallet shard n uses n + 1, so sharded
+            credits do not all update the wallet's one row for the day.
+        """
+    now = datetime.now()
+    daily = {}
+    for txn in transactions:
+        txn.setdefault('timestamp', now)
+        totals = daily.setdefault((txn['wallet_id'], txn['timestamp'].date()), [0.0, 0.0, 0])
+        totals[0 if txn['type'] == 'credit' else 1] += txn['amount']
+        totals[2] += 1
+
+    db.session.execute(insert(WalletTransaction), transactions)
+
+    stmt = _upsert(WalletDailyTotals.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['wallet_id', 'day', 'shard'],
+        set_={
+            'credit_sum': WalletDailyTotals.credit_sum + stmt.excluded.credit_sum,
+            'debit_sum': WalletDailyTotals.debit_sum + stmt.excluded.debit_sum,
+            'txn_count': WalletDailyTotals.txn_count + stmt.excluded.txn_count,
+        },
+    )
+    db.session.execute(stmt, [
+        {'wallet_id': wallet_id, 'day': day, 'shard': rollup_shard, 'credit_sum': credit, 'debit_sum': debit,
+         'txn_count': count}
+        for (wallet_id, day), (credit, debit, count) in daily.items()
+    ])
+
+
+def _check_credit(balance, amount, minimum_balance):
+    if balance + amount < minimum_balance:
+        raise ValueError(f'You need to add minimum {minimum_balance} in your wallet')
+
+
+def _check_debit(balance, amount, minimum_balance):
+    if balance < amount:
+        raise ValueError('Insufficient balance')
+
+    if balance - amount < minimum_balance:
+        raise ValueError(f'Balance cannot drop below minimum required balance of {minimum_balance}')
+
+
+def _parse_wallet_id(value):
+    # 7 and "7" name wallet 7; 7.5, "7.0" and True name no wallet
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError("Wallet not found")
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Wallet not found")
+
+
+def _number(value):
+    # Numbers are kept as sent, so error messages do not change; text is parsed
+    if isinstance(value, bool):
+        raise TypeError(value)
+    return value if isinstance(value, (int, float)) else float(value)
+
+
+def parse_amounts(amount, minimum_balance):
+    """:return: (amount, minimum_balance) as numbers; raises ValueError unless ``amount`` is a positive number."""
+    try:
+        amount, minimum_balance = _number(amount), _number(minimum_balance)
+    except (TypeError, ValueError):
+        raise ValueError("Amount and minimum balance must be numbers")
+    if not 0 < amount < math.inf:
+        raise ValueError("Amount must be positive")
+    if not math.isfinite(minimum_balance):
+        raise ValueError("Minimum balance must be a finite number")
+    return amount, minimum_balance
+
+
+# SQLite result codes and PostgreSQL SQLSTATEs of lock waits that timed out and transactions that lost a
+# serialization race; any other OperationalError is a real failure
+SQLITE_BUSY_CODES = (5, 6)  # SQLITE_BUSY, SQLITE_LOCKED
+RETRYABLE_SQLSTATES = ('40001', '40P01', '55P03')  # serialization_failure, deadlock_detected, lock_not_available
+
+
+def _is_contention(error):
+    orig = error.orig
+    code = getattr(orig, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in SQLITE_BUSY_CODES  # the low byte is the primary result code
+    sqlstate = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    if sqlstate is not None:
+        return sqlstate in RETRYABLE_SQLSTATES
+    return 'database is locked' in str(orig)
+
+
+# Serializes this process's SQLite write attempts. SQLite has a single writer anyway; threads waiting here
+# take over the moment the holder commits, instead of polling the database lock through SQLite's busy
+# handler, whose growing sleeps leave unlucky writers waiting far longer than their turn.
+_sqlite_writer = threading.RLock()
+
+
+@contextmanager
+def _write_transaction():
+    """
+        Holds the transaction of one write attempt.
+
+        SQLite would otherwise read the wallet outside of any transaction and only take the write lock at
+        the UPDATE, by which time a concurrent writer has often moved the version on, so the swap misses.
+        BEGIN IMMEDIATE takes the write lock before the read, waiting up to busy_timeout for writers in
+        other processes, so writers queue instead of burning their retries. Server databases keep the
+        plain optimistic read.
+        """
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        yield
+        return
+    with _sqlite_writer:
+        if not connection.connection.dbapi_connection.in_transaction:
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+        yield
+
+
+post_commit_log = logging.getLogger('app.post_commit')
+
+
+def _after_commit(balances, idempotent_response=None):
+    """
+        Updates the caches and wakes event subscribers once a write has committed.
+
+        The money has already moved, so nothing here may raise into the caller: a client told that the
+        write failed would retry it and apply it twice. A failure is logged and the wallet's cached
+        balance dropped, so the next read goes to the database.
+
+        :param balances: {wallet_id: (balance, version)}, or None for wallets whose cached balance is
+            only invalidated (sharded wallets).
+        :param idempotent_response: Optional (key, fingerprint, status_code, body) for the key cache.
+        """
+    for wallet_id, entry in balances.items():
+        try:
+            if entry is None:
+                balance_cache().invalidate(wallet_id)
+            else:
+                balance_cache().put(wallet_id, *entry)
+        except Exception:
+            post_commit_log.exception('Could not update the cached balance of wallet %s', wallet_id)
+            balance_cache().invalidate()
+    try:
+        events.publish(*balances)
+    except Exception:
+        post_commit_log.exception('Could not publish changes to wallets %s', list(balances))
+    if idempotent_response is not None:
+        try:
+            idempotency_cache().put(*idempotent_response)
+        except Exception:
+            post_commit_log.exception('Could not cache the response of Idempotency-Key %s', idempotent_response[0])
+
+
+def _run_with_retries(attempt, action, retries, delay, max_delay):
+    """
+        Runs one optimistic write ``attempt`` until it succeeds, retrying compare-and-swap conflicts.
+
+        Each attempt runs in a ``_write_transaction``. ``attempt`` returns None when a guarded UPDATE lost
+        a race. The session is then rolled back and the attempt re-run after a jittered exponential
+        backoff. Lock timeouts (SQLite "database is locked") and serialization failures are contention as
+        well and are retried the same way. ValueErrors and other database errors roll back and are raised
+        immediately.
+
+        :param action: Used in error messages, e.g. 'debit money'.
+        """
+    for n in range(retries):
+        try:
+            with _write_transaction():
+                result = attempt()
+                if result is None:
+                    # Lost the race: someone else changed a wallet since we read it
+                    db.session.rollback()
+            if result is not None:
+                return result
+        except ValueError:
+            db.session.rollback()
+            raise
+        except OperationalError as e:
+            db.session.rollback()
+            if not _is_contention(e):
+                raise
+        except IntegrityError:
+            db.session.rollback()
+            raise ValueError(f"Database integrity error: Unable to {action}")
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            raise ValueError(f"Database error: Unable to {action}:{str(e)}")
+
+        _count_contention('conflicts')
+        if n < retries - 1:  # Don't sleep after the last attempt
+            _count_contention('retries')
+            time.sleep(_backoff_delay(n, delay, max_delay))
+
+    _count_contention('exhausted')
+    raise ValueError("Transaction conflict detected. Please retry the transaction.")
+
+
+def _fingerprint(txn_type, wallet_id, amount, minimum_balance):
+    # Normalized, so 10, 10.0 and "10" are the same request
+    request = [txn_type, str(int(wallet_id)), float(amount), float(minimum_balance)]
+    return hashlib.sha256(json.dumps(request).encode()).hexdigest()
+
+
+def find_idempotent_response(key, txn_type, wallet_id, amount, minimum_balance=100):
+    """
+        Looks up the stored outcome of an earlier write made with the same Idempotency-Key.
+
+        Served from the in-process front cache when possible, otherwise with one primary key lookup on the
+        primary database (a replica might not have the key yet).
+
+        :return: (status_code, body) of the original response, or None if the key is unused.
+        :raises ValueError: If the key was used for a different request, or the wallet id or amounts are
+            invalid.
+        """
+    wallet_id = _parse_wallet_id(wallet_id)
+    amount, minimum_balance = parse_amounts(amount, minimum_balance)
+    entry = idempotency_cache().get(key)
+    if entry is None:
+        row = db.session.execute(
+            select(IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.response)
+            .where(IdempotencyKey.key == key)
+        ).first()
+        db.session.commit()  # end the read transaction
+        if row is None:
+            return None
+        entry = (row.fingerprint, row.status_code, json.loads(row.response))
+        idempotency_cache().put(key, *entry)
+
+    fingerprint, status_code, body = entry
+    if fingerprint != _fingerprint(txn_type, wallet_id, amount, minimum_balance):
+        raise ValueError("Idempotency-Key was already used for a different request")
+    return status_code, body
 
-        if wallet.balance + amount < minimum_balance:
-            raise ValueError(f'You need to add minimum {minimum_balance} in your wallet')
 
-        # Update wallet balance
-        wallet.balance += amount
-        wallet.version += 1  # Increment version for optimistic locking
+def _apply_delta(wallet_id, amount, txn_type, minimum_balance, retries, delay, max_delay, idempotency_key=None):
+    """
+        Shared credit/debit engine.
+
+        Reads the current (balance, version), validates the request against it and then tries a
+        compare-and-swap UPDATE. If another writer got there first the rowcount is 0 and the whole
+        read-validate-swap cycle is retried after a jittered exponential backoff. A lost race therefore
+        costs milliseconds instead of a blocking fixed sleep, and the guard in the UPDATE itself keeps
+        the minimum balance rule intact under any interleaving.
+
+        With an ``idempotency_key`` the response is stored in the same transaction as the ledger row, so a
+        key is recorded if and only if the money moved. A concurrent duplicate fails on the key's primary
+        key and rolls back without applying anything.
+
+        On a sharded wallet a credit only adds to one random shard, without a compare-and-swap, and its
+        ledger row waits for the next fold to get its ``balance_after``; the balance it returns does not
+        include credits committed concurrently on other shards. A debit first folds all shards into the
+        wallet, so the minimum balance is checked against the whole balance.
+        """
+    wallet_id = _parse_wallet_id(wallet_id)
+    amount, minimum_balance = parse_amounts(amount, minimum_balance)
+    check = _check_credit if txn_type == 'credit' else _check_debit
+    delta = amount if txn_type == 'credit' else -amount
 
+    def attempt():
+        row = db.session.execute(
+            select(Wallet.balance, Wallet.version, Wallet.shard_count, _total_balance().label('total'))
+            .where(Wallet.id == wallet_id)
+        ).first()
+        if row is None:
+            raise ValueError("Wallet not found")
+
+        balance, version, rollup_shard = row.balance, row.version or 0, 0
+        if row.shard_count and txn_type == 'credit':
+            _check_credit(row.total, amount, minimum_balance)
+            rollup_shard = _credit_shard(wallet_id, row.shard_count, amount) + 1
+            new_balance, new_version = row.total + amount, None
+        else:
+            folded, shard_versions = 0.0, 0
+            if row.shard_count:
+                folded, shard_versions = _fold_shards(wallet_id, balance)
+            check(balance + folded, amount, minimum_balance)
+
+            if not _compare_and_swap(wallet_id, folded + delta, minimum_balance, version):
+                return None
+            new_balance, new_version = balance + folded + delta, version + 1 + shard_versions
         # Create transaction record
-        transaction = WalletTransaction(wallet_id=wallet_id, amount=amount, type='credit')
-        db.session.add(transaction)
+        _record_transactions([{'wallet_id': wallet_id, 'amount': amount, 'type': txn_type,
+                               'balance_after': None if new_version is None else new_balance,
+                               'version': new_version}], rollup_shard)
+        if idempotency_key is not None:
+            fingerprint = _fingerprint(txn_type, wallet_id, amount, minimum_balance)
+            body = {'new_balance': new_balance}
+            db.session.execute(insert(IdempotencyKey).values(
+                key=idempotency_key, fingerprint=fingerprint, wallet_id=wallet_id, status_code=200,
+                response=json.dumps(body), created_at=datetime.now(),
+            ))
         db.session.commit()
+        _after_commit({wallet_id: None if row.shard_count else (new_balance, new_version)},
+                      None if idempotency_key is None else (idempotency_key, fingerprint, 200, body))
+        return new_balance
 
-        return wallet.balance
-    except IntegrityError as e:
-        db.session.rollback()
-        raise ValueError("Database integrity error: Unable to credit money")
-    except Exception as e:
-        db.session.rollback()
-        raise ValueError(f"Database error: Unable to credit money: {str(e)}")
+    return _run_with_retries(attempt, f'{txn_type} money', retries, delay, max_delay)
 
 
+def credit_money(wallet_id, amount, minimum_balance=100, retries=5, delay=0.002, max_delay=0.05, idempotency_key=None):
+    """
+        Credits an amount to a wallet.
+
+        :param wallet_id: ID of the wallet to credit.
+        :param amount: Amount to credit.
+        :param minimum_balance: Minimum balance the wallet must hold after the credit.
+        :param idempotency_key: Optional client key; the response is stored with the write for replays.
+        :return: New balance if successful.
+        :raises ValueError: If the wallet does not exist, the minimum is not reached or the
+            retries are exhausted.
+        """
+    return _apply_delta(wallet_id, amount, 'credit', minimum_balance, retries, delay, max_delay, idempotency_key)
 
 
-def debit_money(wallet_id, amount, minimum_balance=100,retries=3, delay=1):
+def debit_money(wallet_id, amount, minimum_balance=100, retries=5, delay=0.002, max_delay=0.05, idempotency_key=None):
     """
         Attempts to debit an amount from a wallet.
         Ensures the balance does not fall below a specified minimum after the transaction.
@@ -60,110 +586,1151 @@ def debit_money(wallet_id, amount, minimum_balance=100,retries=3, delay=1):
         :param wallet_id: ID of the wallet to debit from.
         :param amount: Amount to debit.
         :param minimum_balance: Minimum allowable balance after debit.
+        :param retries: Number of compare-and-swap attempts before giving up.
+        :param delay: Base backoff delay in seconds, doubled on every failed attempt.
+        :param max_delay: Upper bound for a single backoff delay in seconds.
+        :param idempotency_key: Optional client key; the response is stored with the write for replays.
         :return: New balance if successful.
         :raises ValueError: If balance is insufficient or wallet does not exist.
         #To Prevent the Race conditions following logic is implemented
 
-        1.Lock the wallet record during this transaction to prevent race conditions.
-         with_for_update() effectively locks the row in the database,
-         which prevents other transactions from accessing the wallet while it's being updated,
+        1.Compare-and-swap: the debit is a single conditional UPDATE
+         (balance >= amount + minimum_balance AND version = :v), so the balance check and the write
+         are atomic in the database and no row lock is needed (SQLite ignores FOR UPDATE anyway).
+
+        2.Optimistic Locking: every successful write bumps the version column. A rowcount of 0 means
+         another transaction changed the wallet since we read it.
+
+        3.Retry Logic: conflicts are retried up to ``retries`` times with bounded exponential backoff
+         and jitter, so competing writers spread out instead of blocking a worker for a whole second.
+
+        4.Error Handling: validation failures surface as ValueError right away and database errors are
+         rolled back and reported as ValueError as well.
+        """
+    return _apply_delta(wallet_id, amount, 'debit', minimum_balance, retries, delay, max_delay, idempotency_key)
+
+
+# Keep IN (...) lists well below SQLite's bound-parameter limit
+IN_CHUNK_SIZE = 500
+
+# Every debit folds all shards of the wallet, so more shards make debits slower
+MAX_WALLET_SHARDS = 64
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-        2. Optimistic Locking: The function now assumes that the Wallet model has a version column
-        that is incremented each time the wallet is updated.
-        This version number is used to detect conflicts at commit time.
-        If a StaleDataError is caught, it indicates a conflict, and the transaction is retried after a delay.
 
-        3.Retry Logic: The function includes a retry mechanism that attempts to debit the wallet up to a specified
-         number of times (retries) with a delay (delay) between attempts.
-         This is useful for handling temporary conflicts or database issues that might resolve themselves after a short wait.
+def _parse_operation(op):
+    try:
+        wallet_id = _parse_wallet_id(op['wallet_id'])
+        amount = op['amount']
+        txn_type = op['type']
+        minimum_balance = op.get('minimum_balance', 100)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Each operation needs a wallet_id, type and amount")
+    if txn_type not in ('credit', 'debit'):
+        raise ValueError("Operation type must be 'credit' or 'debit'")
+    # Same rules as a single credit or debit: finite, positive, and never a bool
+    amount, minimum_balance = parse_amounts(amount, minimum_balance)
+    return wallet_id, float(amount), txn_type, float(minimum_balance)
+
+
+def _plan_batch(operations):
+    """
+        Validates every operation against a single read of each wallet.
 
-        4.Error Handling: The function now specifically catches StaleDataError to handle conflicts detected
-        by optimistic locking. It also includes a generic SQLAlchemyError catch for other database errors.
+        Operations are grouped by wallet and checked in input order against a running balance, exactly as
+        if they had been sent one by one. The shards of sharded wallets are folded first, so their
+        running balance starts from the whole balance; nothing else is written here.
+
+        :return: (per-item results, {wallet_id: [start_balance, version, running_balance, shard_versions]},
+            rows to insert). ``shard_versions`` is None for wallets that are not sharded.
         """
-    for attempt in range(retries):
+    parsed = []
+    for op in operations:
         try:
-            with db.session.begin_nested():
-                wallet = Wallet.query.filter_by(id=wallet_id).with_for_update().first()
-                if not wallet:
-                    raise ValueError("Wallet not found")
+            parsed.append(_parse_operation(op))
+        except ValueError as e:
+            parsed.append(e)
+
+    wallet_ids = sorted({p[0] for p in parsed if not isinstance(p, ValueError)})
+    wallets = {}
+    for chunk in _chunks(wallet_ids, IN_CHUNK_SIZE):
+        rows = db.session.execute(
+            select(Wallet.id, Wallet.balance, Wallet.version, Wallet.shard_count).where(Wallet.id.in_(chunk))
+        )
+        for row in rows:
+            wallets[row.id] = [row.balance, row.version or 0, row.balance, 0 if row.shard_count else None]
+
+    for wallet_id, wallet in sorted(wallets.items()):
+        if wallet[3] is not None:
+            fold = _fold_shards(wallet_id, wallet[0])
+            wallet[2] += fold[0]
+            wallet[3] = fold[1]
+
+    results, transactions = [], []
+    for index, item in enumerate(parsed):
+        if isinstance(item, ValueError):
+            results.append({'index': index, 'status': 'rejected', 'error': str(item)})
+            continue
+
+        wallet_id, amount, txn_type, minimum_balance = item
+        wallet = wallets.get(wallet_id)
+        try:
+            if wallet is None:
+                raise ValueError("Wallet not found")
+            if txn_type == 'credit':
+                _check_credit(wallet[2], amount, minimum_balance)
+                wallet[2] += amount
+            else:
+                _check_debit(wallet[2], amount, minimum_balance)
+                wallet[2] -= amount
+        except ValueError as e:
+            results.append({'index': index, 'wallet_id': wallet_id, 'status': 'rejected', 'error': str(e)})
+            continue
+
+        # Every row of a wallet is committed with the version its single compare-and-swap produces
+        transactions.append({'wallet_id': wallet_id, 'amount': amount, 'type': txn_type,
+                             'balance_after': wallet[2], 'version': wallet[1] + 1 + (wallet[3] or 0)})
+        results.append({'index': index, 'wallet_id': wallet_id, 'status': 'applied', 'new_balance': wallet[2]})
+
+    return results, wallets, transactions
 
-                if wallet.balance < amount:
-                    raise ValueError('Insufficient balance')
 
-                if wallet.balance - amount < minimum_balance:
-                    raise ValueError(f'Balance cannot drop below minimum required balance of {minimum_balance}')
+def apply_batch(operations, atomic=True, retries=5, delay=0.002, max_delay=0.05):
+    """
+        Applies a list of credit/debit operations with one read per wallet and a single commit.
 
-                wallet.balance -= amount  # Update balance
+        Each operation is a dict with ``wallet_id``, ``type`` ('credit' or 'debit'), ``amount`` and an
+        optional ``minimum_balance`` (default 100). Every touched wallet gets one compare-and-swap UPDATE
+        carrying its net change and the ledger rows are inserted with one executemany.
 
-                # Create transaction record
-                transaction = WalletTransaction(wallet_id=wallet_id, amount=amount, type='debit')
-                db.session.add(transaction)
+        :param operations: List of operation dicts, applied per wallet in list order.
+        :param atomic: If True, nothing is committed when any operation is rejected. If False, rejected
+            operations are skipped and the rest are committed (best effort).
+        :return: {'committed': bool, 'results': [...]} with one result per operation, in input order.
+        :raises ValueError: On database errors or when the retries are exhausted.
+        """
+    def attempt():
+        results, wallets, transactions = _plan_batch(operations)
 
-            # Commit transaction
-            db.session.commit()
-            return wallet.balance
-        except StaleDataError:
-            # Handle StaleDataError due to optimistic locking conflict
+        if atomic and any(r['status'] == 'rejected' for r in results):
             db.session.rollback()
-            if attempt < retries - 1:  # Don't sleep on the last attempt
-                time.sleep(delay)
+            for result in results:
+                if result['status'] == 'applied':
+                    result['status'] = 'skipped'
+                    del result['new_balance']
+            return {'committed': False, 'results': results}
+
+        # Swap wallets in id order so concurrent batches always touch rows in the same order. Folded
+        # shards are part of the swap even when every operation on the wallet was rejected.
+        touched = {txn['wallet_id'] for txn in transactions}
+        touched.update(wallet_id for wallet_id, wallet in wallets.items() if wallet[3] is not None)
+        for wallet_id, (start, version, running, shard_versions) in sorted(wallets.items()):
+            if wallet_id in touched and not _compare_and_swap(wallet_id, running - start, None, version):
+                return None
+
+        if transactions:
+            _record_transactions(transactions)
+        db.session.commit()
+        _after_commit({
+            wallet_id: (wallets[wallet_id][2], wallets[wallet_id][1] + 1) if wallets[wallet_id][3] is None else None
+            for wallet_id in touched
+        })
+        return {'committed': True, 'results': results}
+
+    return _run_with_retries(attempt, 'apply batch', retries, delay, max_delay)
+
+
+def transfer_money(source_wallet_id, destination_wallet_id, amount, minimum_balance=100, retries=5, delay=0.002,
+                   max_delay=0.05):
+    """
+        Moves an amount between two wallets in a single transaction.
+
+        Both wallets are read with one query and swapped with version-guarded UPDATEs in wallet id order,
+        so two transfers in opposite directions always touch the rows in the same order and cannot
+        deadlock on databases that take row locks. Sharded wallets have their shards folded first, like in
+        ``apply_batch``. The debit and the credit are written as a pair of ledger rows sharing a transfer
+        id, and everything is committed once: either both sides happen or neither does. Only the source
+        wallet is held to ``minimum_balance``.
+
+        :return: {'transfer_id', 'source_balance', 'destination_balance'}
+        :raises ValueError: If a wallet does not exist, the amount is not a positive number, the source
+            balance is insufficient or the retries are exhausted.
+        """
+    source, destination = _parse_wallet_id(source_wallet_id), _parse_wallet_id(destination_wallet_id)
+    if source == destination:
+        raise ValueError("Cannot transfer to the same wallet")
+    amount, minimum_balance = parse_amounts(amount, minimum_balance)
+
+    def attempt():
+        rows = {
+            row.id: row
+            for row in db.session.execute(
+                select(Wallet.id, Wallet.balance, Wallet.version, Wallet.shard_count)
+                .where(Wallet.id.in_([source, destination]))
+            )
+        }
+        if len(rows) != 2:
+            raise ValueError("Wallet not found")
+
+        # wallet_id -> [balance including folded shards, version, shard versions or None]
+        wallets = {}
+        for wallet_id in sorted(rows):
+            row = rows[wallet_id]
+            wallets[wallet_id] = [row.balance, row.version or 0, None]
+            if row.shard_count:
+                fold = _fold_shards(wallet_id, row.balance)
+                wallets[wallet_id][0] += fold[0]
+                wallets[wallet_id][2] = fold[1]
+        _check_debit(wallets[source][0], amount, minimum_balance)
+
+        deltas = {source: -amount, destination: amount}
+        for wallet_id in sorted(deltas):
+            floor = minimum_balance if wallet_id == source else None
+            folded = wallets[wallet_id][0] - rows[wallet_id].balance
+            if not _compare_and_swap(wallet_id, folded + deltas[wallet_id], floor, wallets[wallet_id][1]):
+                return None
+
+        transfer_id = uuid.uuid4().hex
+        _record_transactions([
+            {'wallet_id': wallet_id, 'amount': amount, 'type': 'debit' if delta < 0 else 'credit',
+             'transfer_id': transfer_id, 'balance_after': wallets[wallet_id][0] + delta,
+             'version': wallets[wallet_id][1] + 1 + (wallets[wallet_id][2] or 0)}
+            for wallet_id, delta in deltas.items()
+        ])
+        db.session.commit()
+        _after_commit({
+            wallet_id: (wallets[wallet_id][0] + delta, wallets[wallet_id][1] + 1) if wallets[wallet_id][2] is None
+            else None
+            for wallet_id, delta in deltas.items()
+        })
+        return {
+            'transfer_id': transfer_id,
+            'source_balance': wallets[source][0] - amount,
+            'destination_balance': wallets[destination][0] + amount,
+        }
+
+    return _run_with_retries(attempt, 'transfer money', retries, delay, max_delay)
+
+
+class WriteTimeout(Exception):
+    """
+        Raised when a pipelined write was not committed within WRITE_PIPELINE_TIMEOUT.
+
+        ``applied`` is False when the write was withdrawn from its queue and will never be applied, and None
+        when a worker had already started committing it, so it may still go through.
+        """
+
+    def __init__(self, applied):
+        super().__init__("Timed out waiting for the write to commit")
+        self.applied = applied
+
+
+class WritePipeline:
+    """
+        Optional per-wallet group-commit pipeline for credits and debits.
+
+        Requests are queued on one of ``shards`` worker threads, chosen by wallet id, so every wallet is
+        always written by the same worker and in arrival order. Whenever a worker finishes a commit it
+        drains everything that queued up meanwhile (up to ``max_batch``) and applies it through
+        ``apply_batch`` in best-effort mode: one balance update per wallet, one executemany of ledger
+        rows and one commit for the whole group. Each caller gets a Future that resolves to its own new
+        balance, or to its own ValueError if the minimum balance check failed at its position. A Future
+        cancelled while still queued is dropped from its group and never applied.
+        """
+
+    def __init__(self, app, shards=4, max_batch=500):
+        self.max_batch = max_batch
+        self.batches = 0
+        self.items = 0
+        self._stats_lock = threading.Lock()  # the shard workers update the counters concurrently
+        self._queues = [queue.Queue() for _ in range(shards)]
+        self._workers = [
+            threading.Thread(target=self._run, args=(app, q), name=f'write-pipeline-{i}', daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, wallet_id, txn_type, amount, minimum_balance=100):
+        """:return: A Future resolving to the new balance."""
+        wallet_id = _parse_wallet_id(wallet_id)
+        shard = wallet_id % len(self._queues)
+        future = Future()
+        operation = {'wallet_id': wallet_id, 'type': txn_type, 'amount': amount, 'minimum_balance': minimum_balance}
+        self._queues[shard].put((operation, future))
+        return future
+
+    def close(self):
+        for q in self._queues:
+            q.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self, app, q):
+        with app.app_context():
+            while True:
+                item = q.get()
+                if item is None:
+                    return
+                group = [item]
+                while len(group) < self.max_batch:
+                    try:
+                        item = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        q.put(None)  # finish this group, stop on the next loop
+                        break
+                    group.append(item)
+                self._flush(group)
+
+    def _flush(self, group):
+        # From here on a caller can no longer withdraw its write
+        group = [(operation, future) for operation, future in group if future.set_running_or_notify_cancel()]
+        if not group:
+            return
+        try:
+            outcome = apply_batch([operation for operation, _ in group], atomic=False)
+        except Exception as e:
+            # Never leave a caller waiting on a group that failed as a whole
+            for _, future in group:
+                future.set_exception(ValueError(str(e)))
+            return
+        finally:
+            db.session.remove()
+
+        with self._stats_lock:
+            self.batches += 1
+            self.items += len(group)
+        for (_, future), result in zip(group, outcome['results']):
+            if result['status'] == 'applied':
+                future.set_result(result['new_balance'])
             else:
-                raise ValueError("Transaction conflict detected. Please retry the transaction.")
-        except IntegrityError as e:
-            db.session.rollback()
-            raise ValueError("Database integrity error: Unable to debit money")
-        except SQLAlchemyError as e:
-            db.session.rollback()
-            raise ValueError(f"Database error: Unable to debit money:{str(e)}")
+                future.set_exception(ValueError(result['error']))
+
+
+def write_pipeline():
+    """:return: The app's WritePipeline, or None when writes go straight to credit_money/debit_money."""
+    return current_app.extensions.get('write_pipeline')
 
 
 def get_balance(wallet_id):
-    wallet = Wallet.query.get(wallet_id)
-    if not wallet:
+    """
+        Returns the wallet balance, served from the in-process balance cache when possible.
+
+        Writes in this process refresh the cache right after they commit, so a hit is never older than the
+        last committed write made here.
+        """
+    return get_balance_and_version(wallet_id)[0]
+
+
+def get_balance_and_version(wallet_id):
+    """:return: (balance, version) of a wallet, read through the balance cache like ``get_balance``."""
+    return _run_plan(balance_plan(wallet_id, balance_cache()))
+
+
+def balance_plan(wallet_id, cache):
+    """Read plan (see ``_run_plan``) for the (balance, version) of a wallet, read through ``cache``."""
+    cached = cache.get(wallet_id)
+    if cached is not None:
+        return cached
+
+    rows = yield select(_total_balance(), _total_version(), Wallet.shard_count).where(Wallet.id == wallet_id)
+    if not rows:
         raise ValueError("Wallet not found")
-    return wallet.balance
+    if not rows[0].shard_count:  # sharded credits do not refresh the cache, so those wallets are not cached
+        cache.put(wallet_id, rows[0].balance, rows[0].version)
+    return rows[0].balance, rows[0].version
+
+
+def wallet_version(wallet_id):
+    """
+        Returns the committed version of a wallet with one primary key lookup, bypassing the cache.
+
+        Every write to a wallet bumps its version in the same transaction as its ledger rows, so anything
+        derived from the wallet's ledger is unchanged as long as the version is.
+
+        :return: The version, or None if the wallet does not exist.
+        """
+    return _run_plan(version_plan(wallet_id))
+
+
+def version_plan(wallet_id):
+    """Read plan for ``wallet_version``."""
+    try:
+        wallet_id = int(wallet_id)
+    except (TypeError, ValueError):
+        return None
+    rows = yield select(_total_version()).where(Wallet.id == wallet_id)
+    return rows[0].version if rows else None
+
+
+def wallet_events(wallet_id, since_version=None, limit=1000):
+    """
+        Returns the changes of a wallet after the ``since_version`` cursor, replayed from the ledger.
+
+        Every commit to a wallet moves its version, and its ledger rows carry the version they were
+        committed with. So the events after a cursor are the ledger rows with a greater version, one
+        event per version, read through the (wallet_id, version) index. Changes that the ledger cannot
+        attribute to a version, namely unsettled shard credits and rows older than the version column,
+        are folded into a final event that carries the current balance and no transactions. Archived rows
+        are not replayed.
+
+        :param since_version: Last version the client has seen; None returns the current state as one event.
+        :param limit: Most ledger rows per call; the rest follows on the next call from the returned cursor.
+        :return: (events, cursor), each event being {'version', 'balance', 'transactions'}, and the cursor the
+            version of the last event (``since_version`` when there are none).
+        :raises ValueError: If the wallet does not exist.
+        """
+    return _run_plan(events_plan(wallet_id, since_version, limit))
 
 
-def transaction_history(wallet_id, start_date, end_date):
-    wallet = Wallet.query.get(wallet_id)
-    if not wallet:
+def events_plan(wallet_id, since_version=None, limit=1000):
+    """Read plan for ``wallet_events``."""
+    rows = yield select(_total_balance(), _total_version()).where(Wallet.id == wallet_id)
+    if not rows:
         raise ValueError("Wallet not found")
+    balance, version = rows[0].balance, rows[0].version
+    if since_version is None:
+        return [{'version': version, 'balance': balance, 'transactions': []}], version
+    if since_version >= version:
+        return [], since_version
 
-    transactions = WalletTransaction.query \
-        .filter(WalletTransaction.wallet_id == wallet_id) \
-        .filter(WalletTransaction.timestamp.between(start_date, end_date)) \
-        .all()
+    ledger = (
+        select(WalletTransaction.id, WalletTransaction.amount, WalletTransaction.type, WalletTransaction.timestamp,
+               WalletTransaction.transfer_id, WalletTransaction.balance_after, WalletTransaction.version)
+        .where(WalletTransaction.wallet_id == wallet_id)
+        .order_by(WalletTransaction.version, WalletTransaction.id)
+    )
+    ledger_rows = yield ledger.where(WalletTransaction.version > since_version,
+                                     WalletTransaction.version <= version).limit(limit + 1)
+    truncated = len(ledger_rows) > limit
+    if truncated:
+        last = ledger_rows[limit - 1].version
+        if ledger_rows[0].version == last:
+            # A single commit larger than the limit is still sent whole
+            ledger_rows = yield ledger.where(WalletTransaction.version == last)
+        else:
+            ledger_rows = [row for row in ledger_rows[:limit] if row.version != last]
 
-    #commenting transaction history and adding logic for total credit and debit as per assignment
-    #return [{'amount': txn.amount, 'type': txn.type, 'date': txn.timestamp} for txn in transactions]
-    # Initialize total amounts
-    total_credit = 0
-    total_debit = 0
+    changes = []
+    for row in ledger_rows:
+        if not changes or changes[-1]['version'] != row.version:
+            changes.append({'version': row.version, 'balance': row.balance_after, 'transactions': []})
+        changes[-1]['balance'] = row.balance_after
+        changes[-1]['transactions'].append({'id': row.id, 'amount': row.amount, 'type': row.type,
+                                            'date': row.timestamp, 'transfer_id': row.transfer_id})
+    if not truncated and (not changes or changes[-1]['version'] < version):
+        changes.append({'version': version, 'balance': balance, 'transactions': []})
+    return changes, changes[-1]['version']
 
-    transaction_list = []
-    for txn in transactions:
-        amount = txn.amount
-        txn_type = txn.type
-        date = txn.timestamp
 
-        # Update total amounts based on transaction type
-        if txn_type == 'credit':
-            total_credit += amount
-        elif txn_type == 'debit':
-            total_debit += amount
+def get_balances(wallet_ids):
+    """
+        Returns the balances of many wallets at once.
+
+        Cached balances are used as they are; the rest are resolved with IN queries of at most
+        IN_CHUNK_SIZE ids that select only (id, balance, version), so a dashboard of hundreds of wallets
+        costs one round trip.
+
+        :param wallet_ids: Iterable of wallet ids (ints).
+        :return: {'balances': {wallet_id: balance}, 'missing': [wallet ids that do not exist]}
+        """
+    cache = balance_cache()
+    balances, pending = {}, []
+    for wallet_id in dict.fromkeys(wallet_ids):
+        cached = cache.get(wallet_id)
+        if cached is not None:
+            balances[wallet_id] = cached[0]
+        else:
+            pending.append(wallet_id)
+
+    for chunk in _chunks(pending, IN_CHUNK_SIZE):
+        stmt = select(Wallet.id, _total_balance(), _total_version(), Wallet.shard_count).where(Wallet.id.in_(chunk))
+        for row in _read(stmt):
+            balances[row.id] = row.balance
+            if not row.shard_count:
+                cache.put(row.id, row.balance, row.version)
+
+    return {'balances': balances, 'missing': [wallet_id for wallet_id in pending if wallet_id not in balances]}
+
+
+def _encode_cursor(timestamp, txn_id):
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{txn_id}".encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        timestamp, txn_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(txn_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def _history_page(model, wallet_id, lower, upper, limit, after):
+    page = (
+        select(model.id, model.amount, model.type, model.timestamp)
+        .where(model.wallet_id == wallet_id, model.timestamp >= lower, model.timestamp < upper)
+        .order_by(model.timestamp, model.id)
+        .limit(limit)
+    )
+    if after:
+        after_timestamp, after_id = after
+        page = page.where(or_(
+            model.timestamp > after_timestamp,
+            and_(model.timestamp == after_timestamp, model.id > after_id),
+        ))
+    return page
+
+
+def transaction_history(wallet_id, start_date, end_date, limit=100, after=None):
+    """
+        Returns one page of a wallet's transactions plus the credit/debit totals for the whole range.
+
+        Rows are ordered by (timestamp, id) and paginated with a keyset cursor, so every page is a bounded
+        range scan on the (wallet_id, timestamp) index no matter how long the history is. Totals are
+        computed by the database with SUM ... GROUP BY type. Archived rows are merged in only when the
+        range actually reaches them. The range covers whole days and includes all of ``end_date``, like
+        ``transaction_totals``.
+
+        :param limit: Maximum number of transactions in the page.
+        :param after: Opaque cursor from the previous page's ``next_cursor``.
+        :return: {'total_credit', 'total_debit', 'history', 'next_cursor'}; ``next_cursor`` is None on the
+            last page.
+        """
+    return _run_plan(history_plan(wallet_id, start_date, end_date, limit, after))
+
+
+def history_plan(wallet_id, start_date, end_date, limit=100, after=None):
+    """Read plan for ``transaction_history``."""
+    lower, upper = _day_range(start_date, end_date)
+    if not (yield select(Wallet.id).where(Wallet.id == wallet_id)):
+        raise ValueError("Wallet not found")
+
+    sources = [WalletTransaction]
+    # One index probe: does the wallet have archived rows inside the range?
+    if (yield select(WalletTransactionArchive.id)
+            .where(WalletTransactionArchive.wallet_id == wallet_id)
+            .where(WalletTransactionArchive.timestamp >= lower, WalletTransactionArchive.timestamp < upper)
+            .limit(1)):
+        sources.append(WalletTransactionArchive)
+
+    totals = Counter()
+    for model in sources:
+        totals.update(dict((yield (
+            select(model.type, func.sum(model.amount))
+            .where(model.wallet_id == wallet_id, model.timestamp >= lower, model.timestamp < upper)
+            .group_by(model.type)
+        ))))
+
+    after = _decode_cursor(after) if after else None
+    pages = [_history_page(model, wallet_id, lower, upper, limit + 1, after).subquery() for model in sources]
+    if len(pages) == 1:
+        page = select(pages[0])
+    else:
+        merged = union_all(*[select(p) for p in pages]).subquery()
+        page = select(merged).order_by(merged.c.timestamp, merged.c.id).limit(limit + 1)
+    rows = yield page
 
-        # Append transaction details to the list
-        transaction_list.append({'amount': amount, 'type': txn_type, 'date': date})
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].timestamp, rows[-1].id)
 
     # Create response dictionary with transaction history and total amounts
     response = {
-        'total_credit': total_credit,
-        'total_debit': total_debit,
-        'history': transaction_list
+        'total_credit': totals.get('credit', 0),
+        'total_debit': totals.get('debit', 0),
+        'history': [{'amount': row.amount, 'type': row.type, 'date': row.timestamp} for row in rows],
+        'next_cursor': next_cursor,
     }
 
     return response
 
+
+def export_transactions(wallet_id, batch_size=1000):
+    """
+        Streams a wallet's complete ledger in (timestamp, id) order.
+
+        The wallet is checked up front, so a ValueError is raised before the first row is produced; the
+        rows themselves come from a server-side cursor and are never all held in memory. Archived rows are
+        all older than the hot ones, so they are streamed first.
+
+        :return: Iterator of rows with id, amount, type and timestamp.
+        """
+    if not _wallet_exists(wallet_id):
+        raise ValueError("Wallet not found")
+
+    def ledger(model):
+        return (
+            select(model.id, model.amount, model.type, model.timestamp)
+            .where(model.wallet_id == wallet_id)
+            .order_by(model.timestamp, model.id)
+        )
+    return chain(_stream(ledger(WalletTransactionArchive), batch_size), _stream(ledger(WalletTransaction), batch_size))
+
+
+def balance_as_of(wallet_id, as_of):
+    """
+        Returns the wallet balance at an instant from the ``balance_after`` of the last ledger row at or before it.
+
+        One descending probe of the (wallet_id, timestamp) index instead of summing the history. Archived
+        rows are all older than the hot ones, so the archive is only probed when the hot table has no row
+        that early. Shard credits that no fold has settled yet come after every settled row and are added
+        on top, read through the partial index that only holds them; ``version`` is then None.
+
+        :param as_of: ISO 8601 timestamp.
+        :return: {'balance', 'version', 'as_of'}; a wallet with no rows yet at ``as_of`` had a balance of 0.
+        """
+    try:
+        instant = datetime.fromisoformat(as_of)
+    except (TypeError, ValueError):
+        raise ValueError("as_of must be an ISO 8601 timestamp")
+    if not _wallet_exists(wallet_id):
+        raise ValueError("Wallet not found")
+
+    pending = _read(
+        select(func.sum(WalletTransaction.amount).label('amount'))
+        .where(WalletTransaction.wallet_id == wallet_id, WalletTransaction.balance_after.is_(None),
+               WalletTransaction.timestamp <= instant)
+    )[0].amount
+    for model in (WalletTransaction, WalletTransactionArchive):
+        rows = _read(
+            select(model.balance_after, model.version)
+            .where(model.wallet_id == wallet_id, model.balance_after.isnot(None), model.timestamp <= instant)
+            .order_by(model.timestamp.desc(), model.id.desc())
+            .limit(1)
+        )
+        if rows:
+            break
+    balance, version = (rows[0].balance_after, rows[0].version) if rows else (0.0, None)
+    if pending is not None:
+        balance, version = balance + pending, None
+    return {'balance': balance, 'version': version, 'as_of': instant}
+
+
+def _parse_day(value):
+    if isinstance(value, date):
+        return value.date() if isinstance(value, datetime) else value
+    try:
+        return datetime.fromisoformat(value).date()
+    except (TypeError, ValueError):
+        raise ValueError("Dates must be in YYYY-MM-DD format")
+
+
+def _day_range(start_date, end_date):
+    """
+        :return: Half-open [lower, upper) timestamps covering the whole days from ``start_date`` through
+            ``end_date``, the days the daily rollup sums up.
+        """
+    start, end = _parse_day(start_date), _parse_day(end_date)
+    lower = datetime(start.year, start.month, start.day)
+    return lower, datetime(end.year, end.month, end.day) + timedelta(days=1)
+
+
+def transaction_totals(wallet_id, start_date, end_date):
+    """
+        Returns total credit/debit for a date range from the daily rollup instead of the raw ledger.
+
+        Reads at most one WalletDailyTotals row per day and rollup shard in the range. The range is day-granular and
+        includes the whole of ``end_date``.
+
+        :return: {'total_credit', 'total_debit', 'transaction_count'}
+        """
+    return _run_plan(totals_plan(wallet_id, start_date, end_date))
+
+
+def totals_plan(wallet_id, start_date, end_date):
+    """Read plan for ``transaction_totals``."""
+    if not (yield select(Wallet.id).where(Wallet.id == wallet_id)):
+        raise ValueError("Wallet not found")
+
+    credit, debit, count = (yield (
+        select(
+            func.coalesce(func.sum(WalletDailyTotals.credit_sum), 0),
+            func.coalesce(func.sum(WalletDailyTotals.debit_sum), 0),
+            func.coalesce(func.sum(WalletDailyTotals.txn_count), 0),
+        )
+        .where(WalletDailyTotals.wallet_id == wallet_id)
+        .where(WalletDailyTotals.day.between(_parse_day(start_date), _parse_day(end_date)))
+    ))[0]
+
+    return {'total_credit': credit, 'total_debit': debit, 'transaction_count': count}
+
+
+def rebuild_daily_totals(batch_size=1000):
+    """
+        Rebuilds WalletDailyTotals from the raw ledger, one range of wallet ids per transaction.
+
+        Each range is deleted and re-aggregated with a single INSERT ... SELECT ... GROUP BY, so no ledger
+        rows pass through Python and no long-running transaction holds the tables.
+
+        :return: Number of rollup rows written.
+        """
+    max_id = db.session.execute(select(func.max(Wallet.id))).scalar() or 0
+    written = 0
+    for low in range(0, max_id + 1, batch_size):
+        high = low + batch_size
+        db.session.execute(
+            delete(WalletDailyTotals)
+            .where(WalletDailyTotals.wallet_id >= low, WalletDailyTotals.wallet_id < high)
+        )
+        ledger = union_all(*[
+            select(model.wallet_id, model.amount, model.type, model.timestamp)
+            .where(model.wallet_id >= low, model.wallet_id < high)
+            for model in (WalletTransaction, WalletTransactionArchive)
+        ]).subquery()
+        if db.session.get_bind().dialect.name == 'sqlite':
+            day = func.date(ledger.c.timestamp, type_=db.Date)
+        else:
+            day = cast(ledger.c.timestamp, db.Date)
+        aggregate = (
+            select(
+                ledger.c.wallet_id,
+                day,
+                func.sum(case((ledger.c.type == 'credit', ledger.c.amount), else_=0.0)),
+                func.sum(case((ledger.c.type == 'debit', ledger.c.amount), else_=0.0)),
+                func.count(),
+            )
+            .group_by(ledger.c.wallet_id, day)
+        )
+        result = db.session.execute(
+            insert(WalletDailyTotals.__table__).from_select(
+                ['wallet_id', 'day', 'credit_sum', 'debit_sum', 'txn_count'], aggregate
+            )
+        )
+        written += result.rowcount
+        db.session.commit()
+    return written
+
+
+
+# Largest ``top`` accepted by ledger_summary
+MAX_TOP_WALLETS = 1000
+
+
+def ledger_summary(start_date, end_date, top=10):
+    """
+        Cross-wallet report for a date range: daily volumes, the top wallets by flow and the distribution
+        of current balances.
+
+        Volumes come from the WalletDailyTotals rollup, which has a row per wallet, active day and
+        rollup shard instead of one per transaction and also covers archived rows. The rollup is streamed in wallet
+        order, ANALYTICS_CHUNK_SIZE rows at a time, and each chunk is reduced with NumPy. Memory is
+        bounded by the chunk size plus one float per wallet for the balance percentiles. Reports are
+        cached per (start_date, end_date, top).
+
+        :param top: Number of wallets to rank by credit plus debit volume.
+        :return: {'start_date', 'end_date', 'totals', 'days', 'top_wallets', 'balances'}
+        :raises ValueError: On malformed dates, an invalid ``top`` or a range longer than ANALYTICS_MAX_DAYS.
+        """
+    start, end = _parse_day(start_date), _parse_day(end_date)
+    if end < start:
+        raise ValueError("end_date must not be before start_date")
+    max_days = current_app.config['ANALYTICS_MAX_DAYS']
+    if (end - start).days >= max_days:
+        raise ValueError(f"Date range must be at most {max_days} days")
+    if not 1 <= top <= MAX_TOP_WALLETS:
+        raise ValueError(f"top must be between 1 and {MAX_TOP_WALLETS}")
+
+    cache = analytics_cache()
+    report = cache.get((start, end, top))
+    if report is None:
+        report = _build_summary(start, end, top, current_app.config['ANALYTICS_CHUNK_SIZE'])
+        cache.put((start, end, top), report)
+    return report
+
+
+def _build_summary(start, end, top, chunk_size):
+    days = (end - start).days + 1
+    origin = np.datetime64(start, 'D')
+    credit, debit, count = np.zeros(days), np.zeros(days), np.zeros(days)
+    # wallet_id, credit, debit, count of the best wallets so far, and of the last wallet of the previous chunk
+    leaders = [np.empty(0, np.int64), np.empty(0), np.empty(0), np.empty(0)]
+    carry = None
+
+    stmt = (
+        # The day as ISO text: NumPy parses a column of strings far faster than date objects
+        select(WalletDailyTotals.wallet_id, cast(WalletDailyTotals.day, String), WalletDailyTotals.credit_sum,
+               WalletDailyTotals.debit_sum, WalletDailyTotals.txn_count)
+        .where(WalletDailyTotals.day.between(start, end))
+        .order_by(WalletDailyTotals.wallet_id)
+    )
+    for rows in _stream_partitions(stmt, chunk_size):
+        wallet_ids, row_days, credits, debits, counts = zip(*rows)
+        offsets = (np.array(row_days, dtype='datetime64[D]') - origin).astype(np.int64)
+        columns = [np.array(wallet_ids, np.int64), np.array(credits, np.float64), np.array(debits, np.float64),
+                   np.array(counts, np.float64)]
+        credit += np.bincount(offsets, weights=columns[1], minlength=days)
+        debit += np.bincount(offsets, weights=columns[2], minlength=days)
+        count += np.bincount(offsets, weights=columns[3], minlength=days)
+
+        # Rows arrive in wallet order, so every wallet is one run: sum the runs
+        ids = columns[0]
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        groups = [ids[starts]] + [np.add.reduceat(column, starts) for column in columns[1:]]
+        if carry is not None:
+            if carry[0][0] == groups[0][0]:
+                for column, value in zip(groups[1:], carry[1:]):
+                    column[0] += value[0]
+            else:
+                groups = [np.concatenate(pair) for pair in zip(carry, groups)]
+        # The last wallet may continue in the next chunk
+        carry = [column[-1:] for column in groups]
+        leaders = _top_wallets(leaders, [column[:-1] for column in groups], top)
+    if carry is not None:
+        leaders = _top_wallets(leaders, carry, top)
+
+    wallet_ids, credits, debits, counts = leaders
+    order = np.lexsort((wallet_ids, -(credits + debits)))
+    balances = [
+        np.fromiter((row.balance for row in rows), np.float64, len(rows))
+        for rows in _stream_partitions(select(_total_balance()), chunk_size)
+    ]
+    balances = np.concatenate(balances) if balances else np.empty(0)
+    active = np.flatnonzero(count)
+
+    return {
+        'start_date': start.isoformat(),
+        'end_date': end.isoformat(),
+        'totals': {'credit_volume': float(credit.sum()), 'debit_volume': float(debit.sum()),
+                   'transaction_count': int(count.sum())},
+        'days': [
+            {'day': (start + timedelta(days=i)).isoformat(), 'credit_volume': c, 'debit_volume': d,
+             'transaction_count': int(n)}
+            for i, c, d, n in zip(active.tolist(), credit[active].tolist(), debit[active].tolist(),
+                                  count[active].tolist())
+        ],
+        'top_wallets': [
+            {'wallet_id': w, 'credit_volume': c, 'debit_volume': d, 'flow': c + d, 'transaction_count': int(n)}
+            for w, c, d, n in zip(wallet_ids[order].tolist(), credits[order].tolist(), debits[order].tolist(),
+                                  counts[order].tolist())
+        ],
+        'balances': _distribution(balances),
+    }
+
+
+def _top_wallets(leaders, candidates, top):
+    # Keeps the ``top`` wallets with the largest credit plus debit volume among both sets
+    merged = [np.concatenate(pair) for pair in zip(leaders, candidates)]
+    flow = merged[1] + merged[2]
+    if len(flow) <= top:
+        return merged
+    keep = np.argpartition(-flow, top - 1)[:top]
+    return [column[keep] for column in merged]
+
+
+def _distribution(balances):
+    if not balances.size:
+        return {'wallets': 0, 'total': 0.0, 'mean': None, 'min': None, 'p50': None, 'p90': None, 'p99': None,
+                'max': None}
+    p50, p90, p99 = np.percentile(balances, [50, 90, 99]).tolist()
+    return {'wallets': int(balances.size), 'total': float(balances.sum()), 'mean': float(balances.mean()),
+            'min': float(balances.min()), 'p50': p50, 'p90': p90, 'p99': p99, 'max': float(balances.max())}
+
+
+def export_ledger_snapshot(path, start_date, end_date, batch_size=100000, scale=100):
+    """
+        Writes the ledger of a date range to a snapshot file that statements can be generated from.
+
+        Hot and archived rows are streamed in (wallet_id, timestamp, id) order, ``batch_size`` at a time,
+        and each chunk is converted with NumPy into fixed-width records: epoch microsecond timestamps and
+        integer minor-unit amounts. Opening balances are summed from the WalletDailyTotals rollup of the
+        days before the range. Every wallet gets an index entry, active in the range or not. See
+        ``app.snapshots`` for the format and the memory-mapped reader.
+
+        :param scale: Minor units per unit of currency, e.g. 100 for cents.
+        :return: {'records', 'wallets'}
+        """
+    start, end = _parse_day(start_date), _parse_day(end_date)
+    if end < start:
+        raise ValueError("end_date must not be before start_date")
+    if scale < 1:
+        raise ValueError("scale must be a positive integer")
+    lower = datetime(start.year, start.month, start.day)
+    upper = lower + timedelta(days=(end - start).days + 1)
+
+    ledger = union_all(*[
+        select(model.id, model.wallet_id, model.timestamp, model.amount,
+               case((model.type == 'credit', snapshots.CREDIT), else_=snapshots.DEBIT).label('type'))
+        .where(model.timestamp >= lower, model.timestamp < upper)
+        for model in (WalletTransactionArchive, WalletTransaction)
+    ]).subquery()
+    stmt = (
+        # The timestamp as ISO text: NumPy parses a column of strings far faster than datetime objects
+        select(ledger.c.wallet_id, cast(ledger.c.timestamp, String), ledger.c.amount, ledger.c.type)
+        .order_by(ledger.c.wallet_id, ledger.c.timestamp, ledger.c.id)
+    )
+    openings = (
+        select(WalletDailyTotals.wallet_id, func.sum(WalletDailyTotals.credit_sum - WalletDailyTotals.debit_sum))
+        .where(WalletDailyTotals.day < start)
+        .group_by(WalletDailyTotals.wallet_id)
+        .order_by(WalletDailyTotals.wallet_id)
+    )
+
+    writer = snapshots.SnapshotWriter(path, snapshots.to_epoch_us(lower), snapshots.to_epoch_us(upper), scale)
+    try:
+        for rows in _stream_partitions(stmt, batch_size):
+            wallet_ids, timestamps, amounts, types = zip(*rows)
+            records = np.empty(len(rows), snapshots.RECORD)
+            records['wallet_id'] = wallet_ids
+            records['timestamp'] = np.array(timestamps, 'datetime64[us]').astype(np.int64)
+            records['amount'] = np.rint(np.array(amounts, np.float64) * scale).astype(np.int64)
+            records['type'] = types
+            writer.append(records)
+
+        wallet_ids = [
+            np.fromiter((row[0] for row in rows), np.int64, len(rows))
+            for rows in _stream_partitions(select(Wallet.id).order_by(Wallet.id), batch_size)
+        ]
+        opening_ids, opening_sums = [], []
+        for rows in _stream_partitions(openings, batch_size):
+            ids, sums = zip(*rows)
+            opening_ids.append(np.array(ids, np.int64))
+            opening_sums.append(np.rint(np.array(sums, np.float64) * scale).astype(np.int64))
+        wallets = writer.finish(*(np.concatenate(parts) if parts else np.empty(0, np.int64)
+                                  for parts in (wallet_ids, opening_ids, opening_sums)))
+    except BaseException:
+        writer.abort()
+        raise
+    return {'records': writer.records, 'wallets': wallets}
+
+
+def archive_transactions(older_than_days, batch_size=5000):
+    """
+        Moves ledger rows older than ``older_than_days`` from wallet_transaction to the archive table.
+
+        Works in batches of at most ``batch_size`` rows in id order; each batch is copied with
+        INSERT ... SELECT and deleted in the same transaction, so a row is always in exactly one of the
+        two tables. WalletDailyTotals is not touched and keeps range totals correct. The hot table only
+        keeps recent rows, which keeps its indexes small and its inserts and range scans fast. Shard
+        credits stay until a fold has settled their ``balance_after``.
+
+        :return: Number of rows archived.
+        """
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    columns = ['id', 'wallet_id', 'amount', 'type', 'timestamp', 'transfer_id', 'balance_after', 'version']
+    hot = WalletTransaction.__table__
+    archived = 0
+    while True:
+        ids = db.session.execute(
+            select(hot.c.id).where(hot.c.timestamp < cutoff, hot.c.balance_after.isnot(None))
+            .order_by(hot.c.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return archived
+        batch = (hot.c.timestamp < cutoff, hot.c.balance_after.isnot(None), hot.c.id <= ids[-1])
+        db.session.execute(
+            insert(WalletTransactionArchive.__table__).from_select(
+                columns, select(*[hot.c[name] for name in columns]).where(*batch)
+            )
+        )
+        archived += db.session.execute(delete(hot).where(*batch)).rowcount
+        db.session.commit()
+
+
+def purge_idempotency_keys(older_than_seconds, batch_size=5000):
+    """
+        Deletes stored idempotency keys older than ``older_than_seconds``, ``batch_size`` keys per transaction.
+
+        Each batch is a short DELETE of the oldest keys picked through the created_at index, so the purge
+        never holds a long write lock.
+
+        :return: Number of keys deleted.
+        """
+    cutoff = datetime.now() - timedelta(seconds=older_than_seconds)
+    deleted = 0
+    while True:
+        keys = select(IdempotencyKey.key).where(IdempotencyKey.created_at < cutoff) \
+            .order_by(IdempotencyKey.created_at).limit(batch_size)
+        count = db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.key.in_(keys))).rowcount
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+
+def _fold_into_wallet(wallet_id, shard_count=None):
+    """
+        Write attempt (see ``_run_with_retries``) that folds a wallet's shards into Wallet.balance.
+
+        With a ``shard_count`` different from the current one the shards are then replaced by that many
+        empty ones. Their versions move into Wallet.version, so the version clients see never goes back.
+
+        :return: The wallet balance, or None if the wallet changed meanwhile.
+        """
+    row = db.session.execute(
+        select(Wallet.balance, Wallet.version, Wallet.shard_count).where(Wallet.id == wallet_id)
+    ).first()
+    if row is None:
+        raise ValueError("Wallet not found")
+    version = row.version or 0
+    folded, shard_versions = _fold_shards(wallet_id, row.balance)
+
+    shard_count = row.shard_count if shard_count is None else shard_count
+    resharded = shard_count != row.shard_count
+    result = db.session.execute(
+        update(Wallet)
+        .where(Wallet.id == wallet_id, func.coalesce(Wallet.version, 0) == version)
+        .values(balance=Wallet.balance + folded, version=version + 1 + (shard_versions if resharded else 0),
+                shard_count=shard_count)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        return None
+    if resharded:
+        db.session.execute(delete(WalletShard).where(WalletShard.wallet_id == wallet_id))
+        if shard_count:
+            db.session.execute(insert(WalletShard), [
+                {'wallet_id': wallet_id, 'shard': shard, 'balance': 0.0, 'version': 0} for shard in range(shard_count)
+            ])
+    db.session.commit()
+    _after_commit({wallet_id: None})
+    return row.balance + folded
+
+
+def set_wallet_shards(wallet_id, shard_count, retries=5, delay=0.002, max_delay=0.05):
+    """
+        Turns sharded credits on or off for a wallet, or changes its number of shards.
+
+        Credits to a sharded wallet are spread over ``shard_count`` WalletShard rows instead of all
+        updating the one Wallet row, so they do not serialize on it. Debits, batches and transfers fold
+        the shards back first. The current shards are folded before they are replaced, so nothing is lost.
+
+        :param shard_count: Number of shards; 0 turns sharding off.
+        :return: The wallet balance.
+        :raises ValueError: If the wallet does not exist, the shard count is invalid or the retries are exhausted.
+        """
+    if not isinstance(shard_count, int) or not 0 <= shard_count <= MAX_WALLET_SHARDS:
+        raise ValueError(f"Shard count must be between 0 and {MAX_WALLET_SHARDS}")
+    return _run_with_retries(lambda: _fold_into_wallet(wallet_id, shard_count), 'set wallet shards',
+                             retries, delay, max_delay)
+
+
+def compact_shards(retries=5, delay=0.002, max_delay=0.05):
+    """
+        Folds the shards of every sharded wallet that holds unfolded credits into its balance.
+
+        Keeps the shard rows small and settles the ``balance_after`` of the folded credits, so history and
+        ``balance_as_of`` stay exact for wallets that are rarely debited. Meant to run periodically.
+
+        :return: Number of wallets compacted.
+        """
+    wallet_ids = db.session.execute(
+        select(WalletShard.wallet_id).where(WalletShard.balance != 0).distinct().order_by(WalletShard.wallet_id)
+    ).scalars().all()
+    for wallet_id in wallet_ids:
+        _run_with_retries(lambda: _fold_into_wallet(wallet_id), 'compact shards', retries, delay, max_delay)
+    return len(wallet_ids)
+
+
+# Engine of a reconcile worker process, opened once by the pool initializer
+_reconcile_engine = None
+
+
+def _init_reconcile_worker(url, pragmas):
+    global _reconcile_engine
+    _reconcile_engine = create_worker_engine(url, pragmas)
+
+
+def _signed_amount(model):
+    return case((model.type == 'credit', model.amount), else_=-model.amount)
+
+
+def _reconcile_range(low, high, repair, tolerance):
+    """
+        Compares the balances of wallets ``low <= id < high`` with their ledger sums. Runs in a pool worker.
+
+        The ledger (hot and archived rows) is summed per wallet and joined to the wallets by a single
+        statement, so balance and ledger come from one consistent snapshot and only the wallets that
+        differ are returned. The balance of a sharded wallet includes its shards, and a repair only moves
+        Wallet.balance. Repairs are version-guarded like any other write: a wallet written to since the
+        check is left alone and reported as 'changed'.
+
+        :return: (number of wallets checked, list of mismatch dicts)
+        """
+    in_range = (Wallet.id >= low, Wallet.id < high)
+    ledger = union_all(*[
+        select(model.wallet_id, _signed_amount(model).label('amount'))
+        .where(model.wallet_id >= low, model.wallet_id < high)
+        for model in (WalletTransaction, WalletTransactionArchive)
+    ]).subquery()
+    sums = (
+        select(ledger.c.wallet_id, func.sum(ledger.c.amount).label('total'))
+        .group_by(ledger.c.wallet_id)
+        .subquery()
+    )
+    total = func.coalesce(sums.c.total, 0.0)
+    balance = _total_balance()
+    mismatched = (
+        select(Wallet.id, balance, Wallet.balance.label('main'), Wallet.version, total.label('ledger'))
+        .outerjoin(sums, sums.c.wallet_id == Wallet.id)
+        .where(*in_range, func.abs(balance - total) > tolerance)
+        .order_by(Wallet.id)
+    )
+
+    with _reconcile_engine.connect() as connection:
+        checked = connection.execute(select(func.count()).select_from(Wallet).where(*in_range)).scalar()
+        rows = connection.execute(mismatched).all()
+        connection.rollback()  # end the read snapshot before writing
+        mismatches = []
+        for row in rows:
+            status = 'mismatch'
+            if repair:
+                version = row.version or 0
+                result = connection.execute(
+                    update(Wallet)
+                    .where(Wallet.id == row.id, func.coalesce(Wallet.version, 0) == version)
+                    .values(balance=row.ledger - (row.balance - row.main), version=version + 1)
+                )
+                status = 'repaired' if result.rowcount == 1 else 'changed'
+            mismatches.append({'wallet_id': row.id, 'balance': row.balance, 'ledger': row.ledger, 'status': status})
+        connection.commit()
+    return checked, mismatches
+
+
+def reconcile_wallets(workers=None, range_size=10000, repair=False, tolerance=1e-6):
+    """
+        Checks every wallet balance against the sum of its ledger across a process pool.
+
+        Wallet ids are cut into ranges of ``range_size`` and each range is reconciled in one worker process
+        with its own engine (see ``_reconcile_range``), so a full check uses every core and each statement
+        only touches one bounded range of the live tables. Mismatches are yielded as ranges complete, in
+        no particular order; repaired wallets are also dropped from this process's balance cache.
+
+        :param workers: Number of worker processes; defaults to the CPU count.
+        :param repair: Set mismatched balances to their ledger sum.
+        :return: Iterator of mismatch dicts with ``wallet_id``, ``balance``, ``ledger`` and ``status``
+            ('mismatch', 'repaired', or 'changed' when the wallet was written to during the check). The
+            final item is a summary dict with ``checked``, ``mismatched`` and ``repaired`` counts.
+        """
+    max_id = db.session.execute(select(func.max(Wallet.id))).scalar() or 0
+    url, pragmas = engine_spec()
+    db.session.remove()
+    summary = {'checked': 0, 'mismatched': 0, 'repaired': 0}
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_reconcile_worker, initargs=(url, pragmas)) as pool:
+        futures = [
+            pool.submit(_reconcile_range, low, low + range_size, repair, tolerance)
+            for low in range(0, max_id + 1, range_size)
+        ]
+        for future in as_completed(futures):
+            checked, mismatches = future.result()
+            summary['checked'] += checked
+            for mismatch in mismatches:
+                summary['mismatched'] += 1
+                if mismatch['status'] == 'repaired':
+                    summary['repaired'] += 1
+                    balance_cache().invalidate(mismatch['wallet_id'])
+                yield mismatch
+    yield summary
+
+
 def create_user(phone_number):
     # Check if the user already exists
     existing_user = User.query.filter_by(phone_number=phone_number).first()
@@ -183,4 +1750,138 @@ def create_user(phone_number):
     except Exception as e:
         # Rollback changes if an error occurs
         db.session.rollback()
-        raise ValueError("Failed to create user")
\ No newline at end of file
+        raise ValueError("Failed to create user")
+
+
+def _insert_returning(table, rows, *columns):
+    """executemany INSERT ... RETURNING, with results in the same order as ``rows``."""
+    stmt = insert(table).returning(*columns, sort_by_parameter_order=True)
+    return db.session.execute(stmt, rows).all()
+
+
+def _bulk_chunks(values, chunk_size):
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _create_users_chunk(chunk):
+    unique = list(dict.fromkeys(p for p in chunk if p))
+    existing = {}
+    for part in _chunks(unique, IN_CHUNK_SIZE):
+        existing.update(db.session.execute(
+            select(User.phone_number, User.id).where(User.phone_number.in_(part))
+        ).all())
+
+    created = {}
+    new = [p for p in unique if p not in existing]
+    if new:
+        table = User.__table__
+        created = dict(_insert_returning(table, [{'phone_number': p} for p in new], table.c.phone_number, table.c.id))
+    db.session.commit()
+
+    ids = {**existing, **created}
+    results, seen = [], set()
+    for phone_number in chunk:
+        if not phone_number:
+            results.append({'phone_number': phone_number, 'status': 'invalid'})
+            continue
+        # Only the first occurrence of a newly inserted number counts as created
+        status = 'created' if phone_number in created and phone_number not in seen else 'exists'
+        seen.add(phone_number)
+        results.append({'phone_number': phone_number, 'user_id': ids[phone_number], 'status': status})
+    return results
+
+
+def bulk_create_users(phone_numbers, chunk_size=5000):
+    """
+        Registers users from an iterable of phone numbers, streaming one result per input.
+
+        Input is consumed in chunks. Each chunk is deduplicated against itself and against existing
+        users with set-based IN queries, inserted with a single executemany INSERT ... RETURNING and
+        committed, so the cost per user is a fraction of a round trip instead of four queries and two
+        commits.
+
+        :param phone_numbers: Iterable of phone numbers; empty values are reported as invalid.
+        :return: Generator of {'phone_number', 'user_id', 'status'} dicts with status 'created',
+            'exists' or 'invalid' (no user_id).
+        """
+    for chunk in _bulk_chunks(phone_numbers, chunk_size):
+        for attempt in range(2):
+            try:
+                results = _create_users_chunk(chunk)
+                break
+            except IntegrityError:
+                # A concurrent request inserted one of these numbers first; dedupe again
+                db.session.rollback()
+                if attempt:
+                    raise ValueError("Failed to create users")
+        yield from results
+
+
+def _create_wallets_chunk(chunk):
+    user_ids = []
+    for value in chunk:
+        try:
+            user_ids.append(int(value))
+        except (TypeError, ValueError):
+            user_ids.append(None)
+    unique = list(dict.fromkeys(u for u in user_ids if u is not None))
+
+    users, existing = set(), {}
+    for part in _chunks(unique, IN_CHUNK_SIZE):
+        users.update(db.session.execute(select(User.id).where(User.id.in_(part))).scalars())
+        existing.update(db.session.execute(
+            select(Wallet.user_id, Wallet.id).where(Wallet.user_id.in_(part))
+        ).all())
+
+    created = {}
+    new = [u for u in unique if u in users and u not in existing]
+    if new:
+        table = Wallet.__table__
+        rows = [{'user_id': u, 'balance': 0.0, 'version': 0} for u in new]
+        created = dict(_insert_returning(table, rows, table.c.user_id, table.c.id))
+    db.session.commit()
+
+    ids = {**existing, **created}
+    results, seen = [], set()
+    for value, user_id in zip(chunk, user_ids):
+        if user_id is None:
+            results.append({'user_id': value, 'status': 'invalid'})
+        elif user_id not in users:
+            results.append({'user_id': user_id, 'status': 'user_not_found'})
+        else:
+            status = 'created' if user_id in created and user_id not in seen else 'exists'
+            seen.add(user_id)
+            results.append({'user_id': user_id, 'wallet_id': ids[user_id], 'status': status})
+    return results
+
+
+def bulk_create_wallets(user_ids, chunk_size=5000):
+    """
+        Creates one wallet per user from an iterable of user ids, streaming one result per input.
+
+        Works like bulk_create_users: per chunk, one IN query for the users, one for their existing
+        wallets, one executemany INSERT ... RETURNING and one commit. The unique index on
+        Wallet.user_id rejects a wallet created concurrently for the same user; the chunk is then
+        deduplicated again.
+
+        :return: Generator of {'user_id', 'wallet_id', 'status'} dicts with status 'created', 'exists',
+            'user_not_found' or 'invalid'.
+        """
+    for chunk in _bulk_chunks(user_ids, chunk_size):
+        for attempt in range(2):
+            try:
+                results = _create_wallets_chunk(chunk)
+                break
+            except IntegrityError:
+                # A concurrent request created a wallet for one of these users first; dedupe again
+                db.session.rollback()
+                if attempt:
+                    raise ValueError("Failed to create wallets")
+        yield from results
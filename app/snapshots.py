@@ -0,0 +1,224 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+
+MAGIC = b'WLEDGER1'
+CREDIT, DEBIT = 1, 2
+TYPE_NAMES = {CREDIT: 'credit', DEBIT: 'debit'}
+
+# File layout: HEADER, then RECORD * records sorted by (wallet_id, timestamp, id), then INDEX * wallets
+# sorted by wallet_id. Everything is little-endian and fixed-width, so each section maps straight onto
+# a NumPy array.
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('scale', '<i8'),  # minor units per unit of currency, e.g. 100 for cents
+    ('start', '<i8'),  # period as epoch microseconds, end exclusive
+    ('end', '<i8'),
+    ('records', '<i8'),
+    ('wallets', '<i8'),
+])
+RECORD = np.dtype([
+    ('wallet_id', '<i8'),
+    ('timestamp', '<i8'),  # epoch microseconds
+    ('amount', '<i8'),  # minor units, always positive; ``type`` gives the direction
+    ('type', 'u1'),
+])
+INDEX = np.dtype([
+    ('wallet_id', '<i8'),
+    ('start', '<i8'),  # the wallet's records are records[start:stop]
+    ('stop', '<i8'),
+    ('opening', '<i8'),  # balance in minor units at the start of the period
+])
+
+
+def to_epoch_us(value):
+    """:return: A naive datetime (or date) as microseconds since 1970-01-01."""
+    return int(np.datetime64(value, 'us').astype(np.int64))
+
+
+def _from_epoch_us(value):
+    return datetime(1970, 1, 1) + timedelta(microseconds=value)
+
+
+class SnapshotWriter:
+    """
+        Writes a ledger snapshot file one chunk of records at a time.
+
+        Chunks must arrive in (wallet_id, timestamp) order. Only the run length of each wallet is kept in
+        memory; the wallet index and the header are written by ``finish``. The file is written next to
+        ``path`` and renamed into place, so readers never see a partial snapshot.
+        """
+
+    def __init__(self, path, start, end, scale=100):
+        self.path = path
+        self.header = np.zeros(1, HEADER)
+        self.header[0] = (MAGIC, scale, start, end, 0, 0)
+        self.records = 0
+        self._runs = []  # (wallet ids, record counts) per chunk
+        self._partial = f'{path}.partial'
+        self._file = open(self._partial, 'wb')
+        self._file.write(self.header.tobytes())
+
+    def append(self, records):
+        """Appends a RECORD array; consecutive chunks may continue the same wallet."""
+        if not len(records):
+            return
+        ids = records['wallet_id']
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        self._runs.append((ids[starts], np.diff(np.r_[starts, len(ids)])))
+        self._file.write(records.tobytes())
+        self.records += len(records)
+
+    def finish(self, wallet_ids, opening_ids, openings):
+        """
+            Writes the wallet index and the header, then moves the file into place.
+
+            :param wallet_ids: Wallets to list, in addition to those that have records.
+            :param opening_ids: Wallets with a balance at the start of the period, sorted.
+            :param openings: Their balances in minor units.
+            :return: Number of wallets in the index.
+            """
+        if self._runs:
+            run_ids, run_counts = (np.concatenate(column) for column in zip(*self._runs))
+        else:
+            run_ids, run_counts = np.empty(0, np.int64), np.empty(0, np.int64)
+        ids = np.union1d(np.union1d(wallet_ids, run_ids), opening_ids).astype(np.int64)
+        counts = np.zeros(len(ids), np.int64)
+        np.add.at(counts, np.searchsorted(ids, run_ids), run_counts)
+
+        index = np.zeros(len(ids), INDEX)
+        index['wallet_id'] = ids
+        index['stop'] = np.cumsum(counts)
+        index['start'] = index['stop'] - counts
+        index['opening'][np.searchsorted(ids, opening_ids)] = openings
+        self._file.write(index.tobytes())
+
+        self.header['records'] = self.records
+        self.header['wallets'] = len(ids)
+        self._file.seek(0)
+        self._file.write(self.header.tobytes())
+        self._file.close()
+        os.replace(self._partial, self.path)
+        return len(ids)
+
+    def abort(self):
+        self._file.close()
+        os.unlink(self._partial)
+
+
+class LedgerSnapshot:
+    """
+        Read-only view of a ledger snapshot file through memory maps.
+
+        Opening a snapshot reads only its header. The record and index sections are mapped, not loaded,
+        so a wallet's transactions are a zero-copy slice of the file and the operating system pages in
+        only what is touched. Statements come from the file alone and never query the database.
+        """
+
+    def __init__(self, path):
+        header = np.fromfile(path, HEADER, count=1)
+        if len(header) != 1 or header[0]['magic'] != MAGIC:
+            raise ValueError(f"{path} is not a ledger snapshot")
+        header = header[0]
+        self.path = path
+        self.scale = int(header['scale'])
+        self.start = _from_epoch_us(int(header['start']))
+        self.end = _from_epoch_us(int(header['end']))
+        self.records = _map(path, RECORD, HEADER.itemsize, int(header['records']))
+        self.index = _map(path, INDEX, HEADER.itemsize + RECORD.itemsize * len(self.records), int(header['wallets']))
+        self._totals = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # The maps are released when the last array viewing them is garbage collected
+        self.records = self.index = self._totals = None
+
+    def _position(self, wallet_id):
+        ids = self.index['wallet_id']
+        i = int(np.searchsorted(ids, wallet_id))
+        if i == len(ids) or ids[i] != wallet_id:
+            raise ValueError("Wallet not in snapshot")
+        return i
+
+    def transactions(self, wallet_id):
+        """:return: The wallet's RECORD rows in time order, as a view into the file."""
+        entry = self.index[self._position(wallet_id)]
+        return self.records[entry['start']:entry['stop']]
+
+    def totals(self):
+        """
+            Per-wallet totals of the whole snapshot, computed with one pass over the records.
+
+            :return: Dict of arrays in index order: wallet_id, opening, credit, debit, count and closing,
+                amounts in minor units.
+            """
+        if self._totals is None:
+            amounts = self.records['amount']
+            credits = np.where(self.records['type'] == CREDIT, amounts, 0)
+            # Prefix sums turn every wallet's total into the difference of two entries, empty wallets included
+            credit_sums = np.r_[0, np.cumsum(credits)]
+            all_sums = np.r_[0, np.cumsum(amounts)]
+            start, stop = self.index['start'], self.index['stop']
+            credit = credit_sums[stop] - credit_sums[start]
+            debit = all_sums[stop] - all_sums[start] - credit
+            opening = np.array(self.index['opening'])
+            self._totals = {'wallet_id': np.array(self.index['wallet_id']), 'opening': opening, 'credit': credit,
+                            'debit': debit, 'count': stop - start, 'closing': opening + credit - debit}
+        return self._totals
+
+    def statement(self, wallet_id):
+        """:return: The wallet's statement for the period, see ``statements``."""
+        i = self._position(wallet_id)
+        records = self.records[self.index[i]['start']:self.index[i]['stop']]
+        credit = int(records['amount'][records['type'] == CREDIT].sum())
+        debit = int(records['amount'].sum()) - credit
+        return self._statement(i, credit, debit, True)
+
+    def statements(self, wallet_ids=None, transactions=True):
+        """
+            Yields one statement per wallet, in wallet order unless ``wallet_ids`` are given.
+
+            A statement has the opening and closing balance, the credit and debit totals and, unless
+            ``transactions`` is false, every transaction of the period as {'timestamp', 'type', 'amount'}.
+            """
+        totals = self.totals()
+        positions = range(len(self.index)) if wallet_ids is None else map(self._position, wallet_ids)
+        for i in positions:
+            yield self._statement(i, int(totals['credit'][i]), int(totals['debit'][i]), transactions)
+
+    def _statement(self, i, credit, debit, transactions):
+        entry = self.index[i]
+        records = self.records[entry['start']:entry['stop']]
+        opening = int(entry['opening'])
+        statement = {
+            'wallet_id': int(entry['wallet_id']),
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat(),
+            'opening_balance': opening / self.scale,
+            'total_credit': credit / self.scale,
+            'total_debit': debit / self.scale,
+            'closing_balance': (opening + credit - debit) / self.scale,
+            'transaction_count': len(records),
+        }
+        if transactions:
+            timestamps = records['timestamp'].astype('datetime64[us]').astype(str)
+            statement['transactions'] = [
+                {'timestamp': timestamp, 'type': TYPE_NAMES[code], 'amount': amount / self.scale}
+                for timestamp, code, amount in zip(timestamps.tolist(), records['type'].tolist(),
+                                                   records['amount'].tolist())
+            ]
+        return statement
+
+
+def _map(path, dtype, offset, count):
+    if count == 0:  # an empty section cannot be mapped
+        return np.empty(0, dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
@@ -0,0 +1,125 @@
+from flask import current_app
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from app.config import STORAGE_PROFILES
+
+READER_ENGINE = 'reader_engine'
+# Async drivers used by the asyncio read API, by backend
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+
+def _profile_name(app):
+    name = app.config.get('STORAGE_PROFILE')
+    if name:
+        return name
+    return 'sqlite' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') else 'server'
+
+
+def _is_memory_database(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def _on_connect(pragmas, read_only):
+    def set_connection_options(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+    return set_connection_options
+
+
+def _on_connect_read_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+    cursor.close()
+
+
+def init_app(app, db):
+    """
+    Applies the storage profile and initializes Flask-SQLAlchemy.
+
+    Engine options have to be in the config before ``db.init_app`` creates the engine. The read-only
+    reader engine is built afterwards from the primary engine's resolved URL (or SQLALCHEMY_READER_URI)
+    and kept in ``app.extensions``. An in-memory SQLite database only exists on its one connection, so
+    it never gets a reader engine.
+    """
+    profile = STORAGE_PROFILES[_profile_name(app)]
+    for key in dir(profile):
+        if key.isupper() and key != 'STORAGE_PROFILE':
+            app.config.setdefault(key, getattr(profile, key))
+    app.config['STORAGE_PROFILE'] = profile.STORAGE_PROFILE
+
+    db.init_app(app)
+
+    with app.app_context():
+        engine = db.engine
+        reader = None
+        if not _is_memory_database(app.config['SQLALCHEMY_DATABASE_URI']):
+            reader = create_engine(
+                app.config.get('SQLALCHEMY_READER_URI') or engine.url,
+                **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+            )
+
+    pragmas = app.config.get('SQLITE_PRAGMAS', {})
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _on_connect(pragmas, read_only=False))
+    if reader is not None:
+        if reader.dialect.name == 'sqlite':
+            event.listen(reader, 'connect', _on_connect(pragmas, read_only=True))
+        elif reader.dialect.name == 'postgresql':
+            event.listen(reader, 'connect', _on_connect_read_only)
+    app.extensions[READER_ENGINE] = reader
+
+
+def engine_spec():
+    """:return: (url, SQLite PRAGMAs) that recreate the primary engine in another process."""
+    from app.models import db
+    url = db.engine.url.render_as_string(hide_password=False)
+    return url, dict(current_app.config.get('SQLITE_PRAGMAS', {}))
+
+
+def create_worker_engine(url, pragmas):
+    """
+    Builds a private engine for a worker process from ``engine_spec()``.
+
+    Engines and their pooled connections must never cross a fork, so every process of a pool opens its
+    own, with the same PRAGMAs the app applies.
+    """
+    engine = create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _on_connect(pragmas, read_only=False))
+    return engine
+
+
+def create_async_reader(app):
+    """
+    Builds a read-only AsyncEngine on the reader database (SQLALCHEMY_READER_URI, else the primary).
+
+    Connections get the same PRAGMAs and read-only guard as the synchronous reader engine.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from app.models import db
+
+    with app.app_context():
+        url = make_url(app.config.get('SQLALCHEMY_READER_URI') or db.engine.url)
+    if _is_memory_database(url):
+        raise ValueError("The asyncio read API needs a database file or server, not an in-memory database")
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+
+    engine = create_async_engine(url.set(drivername=ASYNC_DRIVERS[backend]),
+                                 **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    if backend == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', _on_connect(app.config.get('SQLITE_PRAGMAS', {}), read_only=True))
+    else:
+        event.listen(engine.sync_engine, 'connect', _on_connect_read_only)
+    return engine
+
+
+def reader_engine():
+    """:return: The read-only engine, or None when reads have to share the primary session."""
+    return current_app.extensions.get(READER_ENGINE)
@@ -0,0 +1,8 @@
+import os
+from app import create_app
+from app.async_api import create_asgi_app
+from app.config import get_config
+
+# Entry point for ASGI servers, e.g. `uvicorn asgi:app --workers 4`: balance and history reads are served on
+# asyncio, every other request by the Flask app
+app = create_asgi_app(create_app(get_config(os.environ.get('FLASK_ENV', 'production'))))
@@ -0,0 +1,323 @@
+"""
+Load and latency benchmarks for every wallet endpoint.
+
+Runs offline against a temporary SQLite file. Each scenario drives one endpoint through one of three
+client modes:
+
+- ``client``: the Flask test client, in-process and single-threaded (no network, no server).
+- ``threads``: a real threaded HTTP server and ``--workers`` client threads.
+- ``processes``: the same server and ``--workers`` client processes.
+
+Reports ops/sec, p50/p95/p99 latency, errors, requests shed with 429 by admission control and
+compare-and-swap conflicts/retries per scenario,
+writes them as JSON and compares them with a stored baseline. After the run the final balance of every
+wallet is checked against the sum of its ledger.
+
+Usage:
+    python -m benchmarks.bench_wallet --mode threads --workers 8 --output bench.json
+    python -m benchmarks.bench_wallet --mode threads --update-baseline
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+SCENARIOS = ('register', 'wallet_create', 'credit', 'debit', 'balance', 'transactions')
+SEED_BALANCE = 1e9
+
+
+def make_app(directory):
+    from app import create_app, db
+    from app.config import TestingConfig
+
+    class BenchConfig(TestingConfig):
+        TESTING = False
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'bench.db')
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def seed(app, wallets, history, spare_users):
+    """
+    Creates ``wallets`` funded wallets with ``history`` ledger rows each, plus ``spare_users`` users
+    without a wallet for the wallet_create scenario.
+
+    :return: (wallet ids, spare user ids)
+    """
+    from app import db
+    from app.models import User, Wallet
+    from app.services import apply_batch
+
+    with app.app_context():
+        users = [User(phone_number=f'seed-{i}') for i in range(wallets + spare_users)]
+        db.session.add_all(users)
+        db.session.commit()
+        wallet_rows = [Wallet(user_id=user.id, balance=0.0, version=0) for user in users[:wallets]]
+        db.session.add_all(wallet_rows)
+        db.session.commit()
+        wallet_ids = [wallet.id for wallet in wallet_rows]
+        spare_ids = [user.id for user in users[wallets:]]
+
+        operations = [{'wallet_id': wallet_id, 'type': 'credit', 'amount': SEED_BALANCE} for wallet_id in wallet_ids]
+        for i in range(history):
+            for wallet_id in wallet_ids:
+                txn_type = 'credit' if i % 2 else 'debit'
+                operations.append({'wallet_id': wallet_id, 'type': txn_type, 'amount': 1.0, 'minimum_balance': 0})
+        for start in range(0, len(operations), 10000):
+            outcome = apply_batch(operations[start:start + 10000])
+            if not outcome['committed']:
+                raise RuntimeError('Seeding failed')
+        db.session.remove()
+    return wallet_ids, spare_ids
+
+
+def build_requests(scenario, ops, wallet_ids, spare_user_ids, skew, seed_value):
+    """
+    Pre-generates the (method, path, body) of every request so all client modes send the same load.
+
+    ``skew`` is the fraction of requests that go to the first (hot) wallet; the rest are uniform.
+    """
+    rng = random.Random(seed_value)
+
+    def pick_wallet():
+        return wallet_ids[0] if rng.random() < skew else rng.choice(wallet_ids)
+
+    requests = []
+    for i in range(ops):
+        if scenario == 'register':
+            requests.append(('POST', '/register', {'phone_number': f'bench-{seed_value}-{i}'}))
+        elif scenario == 'wallet_create':
+            requests.append(('POST', '/wallet/create', {'user_id': spare_user_ids[i]}))
+        elif scenario == 'credit':
+            requests.append(('POST', '/wallet/credit', {'wallet_id': pick_wallet(), 'amount': 5}))
+        elif scenario == 'debit':
+            requests.append(('POST', '/wallet/debit', {'wallet_id': pick_wallet(), 'amount': 3, 'minimum_balance': 0}))
+        elif scenario == 'balance':
+            requests.append(('GET', f'/wallet/balance/{pick_wallet()}', None))
+        elif scenario == 'transactions':
+            path = f'/wallet/transactions?wallet_id={pick_wallet()}&start_date=2000-01-01&end_date=2100-01-01&limit=50'
+            requests.append(('GET', path, None))
+    return requests
+
+
+def _classify(status, body):
+    if status < 400:
+        return None
+    if status == 429:
+        return 'shed'
+    if b'conflict' in body:
+        return 'conflict'
+    return 'error'
+
+
+def run_test_client(app, requests):
+    client = app.test_client()
+    samples = []
+    for method, path, body in requests:
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        samples.append((time.perf_counter() - started, _classify(response.status_code, response.data)))
+    return samples
+
+
+def http_worker(args):
+    """Sends one slice of requests over a keep-alive connection. Top level so processes can run it."""
+    port, requests = args
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    samples = []
+    for method, path, body in requests:
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        started = time.perf_counter()
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        samples.append((time.perf_counter() - started, _classify(response.status, data)))
+    connection.close()
+    return samples
+
+
+def start_server(app):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_http(port, requests, workers, mode):
+    slices = [(port, requests[i::workers]) for i in range(workers)]
+    if mode == 'threads':
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(http_worker, slices))
+    else:
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            results = pool.map(http_worker, slices)
+    return [sample for result in results for sample in result]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed, retries):
+    latencies = sorted(latency for latency, _ in samples)
+    return {
+        'ops': len(samples),
+        'errors': sum(1 for _, outcome in samples if outcome == 'error'),
+        'conflicts': sum(1 for _, outcome in samples if outcome == 'conflict'),
+        'shed': sum(1 for _, outcome in samples if outcome == 'shed'),
+        'retries': retries,
+        'ops_per_sec': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def check_ledger(app):
+    """:return: Wallets whose balance differs from the sum of their ledger rows."""
+    from sqlalchemy import case, func, select
+    from app import db
+    from app.models import Wallet, WalletShard, WalletTransaction
+
+    signed = case((WalletTransaction.type == 'credit', WalletTransaction.amount), else_=-WalletTransaction.amount)
+    shards = (
+        select(func.coalesce(func.sum(WalletShard.balance), 0.0))
+        .where(WalletShard.wallet_id == Wallet.id)
+        .scalar_subquery()
+    )
+    with app.app_context():
+        rows = db.session.execute(
+            select(Wallet.id, Wallet.balance + shards, func.coalesce(func.sum(signed), 0.0))
+            .outerjoin(WalletTransaction, WalletTransaction.wallet_id == Wallet.id)
+            .group_by(Wallet.id, Wallet.balance)
+        ).all()
+        db.session.remove()
+    return [
+        {'wallet_id': wallet_id, 'balance': balance, 'ledger': ledger}
+        for wallet_id, balance, ledger in rows
+        if abs(balance - ledger) > 1e-6
+    ]
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """:return: Human-readable regressions; throughput may drop and p99 may grow by ``tolerance``."""
+    regressions = []
+    for scenario, current in results.items():
+        reference = baseline.get(scenario)
+        if not reference:
+            continue
+        if current['ops_per_sec'] < reference['ops_per_sec'] * (1 - tolerance):
+            regressions.append(f"{scenario}: {current['ops_per_sec']} ops/s < baseline {reference['ops_per_sec']}")
+        if current['p99_ms'] > reference['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{scenario}: p99 {current['p99_ms']}ms > baseline {reference['p99_ms']}ms")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('client', 'threads', 'processes'), default='threads')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated subset of scenarios.')
+    parser.add_argument('--wallets', type=int, default=50)
+    parser.add_argument('--history', type=int, default=200, help='Seeded ledger rows per wallet.')
+    parser.add_argument('--ops', type=int, default=2000, help='Requests per scenario.')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--skew', type=float, default=0.5, help='Fraction of requests sent to one hot wallet.')
+    parser.add_argument('--hot-wallet-shards', type=int, default=0, help='Credit shards for the hot wallet.')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--update-baseline', action='store_true', help='Store this run as the baseline for --mode.')
+    args = parser.parse_args(argv)
+
+    from app import services
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = make_app(directory)
+        wallet_ids, spare_user_ids = seed(app, args.wallets, args.history, args.ops)
+        if args.hot_wallet_shards:
+            with app.app_context():
+                services.set_wallet_shards(wallet_ids[0], args.hot_wallet_shards)
+        server = start_server(app) if args.mode != 'client' else None
+
+        results = {}
+        for scenario in scenarios:
+            requests = build_requests(scenario, args.ops, wallet_ids, spare_user_ids, args.skew, args.seed)
+            retries_before = services.contention['retries']
+            started = time.perf_counter()
+            if server is None:
+                samples = run_test_client(app, requests)
+            else:
+                samples = run_http(server.server_port, requests, args.workers, args.mode)
+            elapsed = time.perf_counter() - started
+            results[scenario] = summarize(samples, elapsed, services.contention['retries'] - retries_before)
+            print(f"{scenario:>13}: {json.dumps(results[scenario])}")
+
+        if server is not None:
+            server.shutdown()
+        mismatches = check_ledger(app)
+
+    report = {
+        'mode': args.mode,
+        'config': {key: getattr(args, key)
+                   for key in ('wallets', 'history', 'ops', 'workers', 'skew', 'hot_wallet_shards', 'seed')},
+        'scenarios': results,
+        'ledger_mismatches': mismatches,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = False
+    if mismatches:
+        print(f"LEDGER MISMATCH: {len(mismatches)} wallet balances differ from their ledger: {mismatches[:5]}")
+        failed = True
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.update_baseline:
+        baseline[args.mode] = results
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline for mode '{args.mode}' written to {args.baseline}")
+    else:
+        regressions = compare_with_baseline(results, baseline.get(args.mode, {}), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        failed = failed or bool(regressions)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+# Production server settings: `gunicorn -c gunicorn.conf.py wsgi:app`
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+# One worker process per core by default; each serves requests on a few threads
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# Import and build the app once in the master, so forked workers start serving right away
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+# Workers tell each other about wallet changes through sockets in this directory, so long polls and
+# event streams wake up on writes served by any worker. Set before the app is preloaded.
+_events_socket_dir = None
+if 'EVENTS_SOCKET_DIR' not in os.environ:
+    _events_socket_dir = os.environ['EVENTS_SOCKET_DIR'] = tempfile.mkdtemp(prefix='wallet-events-')
+
+
+def post_fork(server, worker):
+    from app import init_worker
+    init_worker(worker.app.wsgi())
+
+
+def on_exit(server):
+    if _events_socket_dir is not None:
+        shutil.rmtree(_events_socket_dir, ignore_errors=True)
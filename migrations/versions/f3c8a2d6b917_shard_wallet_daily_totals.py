@@ -0,0 +1,42 @@
+"""Shard wallet_daily_totals
+
+Revision ID: f3c8a2d6b917
+Revises: b5d1a7e3c920
+Create Date: 2026-10-18 21:14:39.506128
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c8a2d6b917'
+down_revision = 'b5d1a7e3c920'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows are the wallets' own rows, shard 0. On SQLite the table is recreated, and the new
+    # primary key replaces the old one.
+    with op.batch_alter_table('wallet_daily_totals', schema=None, recreate='always') as batch_op:
+        batch_op.add_column(sa.Column('shard', sa.Integer(), server_default='0', nullable=False))
+        batch_op.create_primary_key('pk_wallet_daily_totals', ['wallet_id', 'day', 'shard'])
+
+
+def downgrade():
+    # Merge the shard rows back into one row per wallet and day first
+    op.execute(
+        "UPDATE wallet_daily_totals SET "
+        "credit_sum = (SELECT SUM(s.credit_sum) FROM wallet_daily_totals s "
+        "WHERE s.wallet_id = wallet_daily_totals.wallet_id AND s.day = wallet_daily_totals.day), "
+        "debit_sum = (SELECT SUM(s.debit_sum) FROM wallet_daily_totals s "
+        "WHERE s.wallet_id = wallet_daily_totals.wallet_id AND s.day = wallet_daily_totals.day), "
+        "txn_count = (SELECT SUM(s.txn_count) FROM wallet_daily_totals s "
+        "WHERE s.wallet_id = wallet_daily_totals.wallet_id AND s.day = wallet_daily_totals.day) "
+        "WHERE shard = 0"
+    )
+    op.execute("DELETE FROM wallet_daily_totals WHERE shard != 0")
+    with op.batch_alter_table('wallet_daily_totals', schema=None, recreate='always') as batch_op:
+        batch_op.drop_column('shard')
+        batch_op.create_primary_key('pk_wallet_daily_totals', ['wallet_id', 'day'])
@@ -1,8 +1,10 @@
+import os
 from app import create_app
+from app.config import get_config
 
-app = create_app()
+app = create_app(get_config(os.environ.get('FLASK_ENV', 'development')))
 
 if __name__ == '__main__':
-    #for Docker
+    # Development server only; production runs `gunicorn -c gunicorn.conf.py wsgi:app` (see Dockerfile)
     app.run(host='0.0.0.0', port=5000, debug=True)
     #app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,68 @@
+# tests/test_admission.py
+import threading
+import time
+import unittest
+from app import create_app, db
+from app.admission import AdmissionController, Overloaded, controller
+from app.services import create_wallet, create_user, get_balance
+from app.config import TestingConfig
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        class AdmissionConfig(TestingConfig):
+            ADMISSION_MAX_PER_WALLET = 1
+            ADMISSION_MAX_QUEUED_PER_WALLET = 1
+            ADMISSION_QUEUE_TIMEOUT = 0.05
+
+        self.app = create_app(AdmissionConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_hot_wallet_does_not_block_others(self):
+        admission = AdmissionController(max_in_flight=4, max_per_wallet=2, max_queued_per_wallet=1, queue_timeout=0.5)
+        with admission.admit([1]), admission.admit([1]):
+            # The hot wallet is saturated: one caller queues until its deadline, the next is shed at once
+            waiter_failed = []
+
+            def wait_for_hot_wallet():
+                try:
+                    with admission.admit([1]):
+                        pass
+                except Overloaded as e:
+                    waiter_failed.append(e.reason)
+            queued = threading.Thread(target=wait_for_hot_wallet)
+            queued.start()
+            while admission.stats()['waiting'] == 0:
+                time.sleep(0.001)
+            self.assertEqual(admission.stats()['hot_wallets'], [{'wallet_id': 1, 'waiting': 1, 'in_flight': 2}])
+            with self.assertRaises(Overloaded) as shed:
+                with admission.admit([1]):
+                    pass
+            self.assertEqual(shed.exception.reason, 'queue_full')
+
+            with admission.admit(['2']):  # another wallet still gets in
+                self.assertEqual(admission.stats()['in_flight'], 3)
+            queued.join()
+
+        self.assertEqual(waiter_failed, ['timeout'])
+        self.assertEqual(admission.stats()['rejected'], {'queue_full': 1, 'timeout': 1})
+        self.assertEqual(admission.stats()['in_flight'], 0)
+
+    def test_write_endpoints_return_429(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        with controller().admit([wallet.id]):
+            response = self.client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': 200})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(get_balance(wallet.id), 0.0)
+
+        self.assertEqual(self.client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': 200}).status_code, 200)
+        self.assertEqual(self.client.get('/wallet/admission/stats').json['rejected'], {'timeout': 1})
+        self.assertIn('wallet_admission_rejected_timeout_total 1', self.client.get('/metrics').get_data(as_text=True))
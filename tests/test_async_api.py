@@ -0,0 +1,91 @@
+# tests/test_async_api.py
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from app import create_app, db
+from app.async_api import AsyncReadAPI
+from app.services import create_wallet, credit_money, debit_money, create_user, balance_cache, balance_plan, \
+    run_plan_async
+from app.config import TestingConfig
+class TestAsyncReadAPI(unittest.TestCase):
+
+    def setUp(self):
+        # The async engine needs a database file it can open on its own connections
+        self.directory = tempfile.TemporaryDirectory()
+
+        class FileConfig(TestingConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.directory.name, 'wallet.db')
+
+        self.app = create_app(FileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.asgi = AsyncReadAPI(self.app)
+
+    def tearDown(self):
+        asyncio.run(self.asgi.engine.dispose())
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def request(self, path, method='GET', headers=(), body=b''):
+        path, _, query = path.partition('?')
+        headers = list(headers) + ([('Content-Length', str(len(body)))] if body else [])
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+                 'raw_path': path.encode(), 'root_path': '', 'query_string': query.encode(),
+                 'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+                 'server': ('testserver', 80), 'client': ('127.0.0.1', 12345)}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.asgi(scope, receive, send))
+        start = messages[0]
+        return start['status'], dict(start['headers']), b''.join(m.get('body', b'') for m in messages[1:])
+
+    def test_reads_match_the_flask_views(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        debit_money(wallet.id, 50.0)
+        balance_cache().invalidate()
+
+        for path in (f'/wallet/balance/{wallet.id}',
+                     f'/wallet/transactions?wallet_id={wallet.id}&start_date=2000-01-01&end_date=2100-01-01&limit=1',
+                     f'/wallet/transactions?wallet_id={wallet.id}&start_date=2000-01-01&end_date=2100-01-01&totals_only=true',
+                     '/wallet/balance/999',
+                     '/wallet/transactions?wallet_id=1&start_date=2000-01-01&end_date=2100-01-01&limit=0'):
+            expected = self.client.get(path)
+            status, headers, body = self.request(path)
+            self.assertEqual((status, json.loads(body)), (expected.status_code, expected.json), path)
+            self.assertEqual(headers.get(b'etag', b'').decode(), expected.headers.get('ETag', ''), path)
+
+        status, _, body = self.request(f'/wallet/balance/{wallet.id}',
+                                       headers=[('If-None-Match', f'"wallet-{wallet.id}-v2"')])
+        self.assertEqual((status, body), (304, b''))
+
+    def test_other_requests_go_to_flask(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        status, _, body = self.request('/wallet/credit', method='POST', headers=[('Content-Type', 'application/json')],
+                                       body=json.dumps({'wallet_id': wallet.id, 'amount': 300}).encode())
+        self.assertEqual((status, json.loads(body)), (200, {'new_balance': 300.0}))
+
+    def test_many_concurrent_reads(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+
+        async def read_all():
+            async def read():
+                balance_cache().invalidate(wallet.id)
+                return await run_plan_async(balance_plan(wallet.id, self.asgi.balance_cache), self.asgi.engine)
+            return await asyncio.gather(*[read() for _ in range(500)])
+
+        self.assertEqual(set(asyncio.run(read_all())), {(200.0, 1)})
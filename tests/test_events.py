@@ -0,0 +1,195 @@
+# tests/test_events.py
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from app import create_app, db
+from app.async_api import AsyncReadAPI
+from app.events import EventHub
+from app.services import create_wallet, credit_money, create_user, apply_batch, transfer_money, \
+    set_wallet_shards, wallet_events
+from app.config import TestingConfig
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        # Long polls wait on one thread while another one writes, so use a real database file
+        self.directory = tempfile.TemporaryDirectory()
+
+        class FileConfig(TestingConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.directory.name, 'wallet.db')
+
+        self.app = create_app(FileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.wallet = create_wallet(create_user("1234567890").id).id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def _credit_later(self, amount, delay=0.1):
+        def credit():
+            time.sleep(delay)
+            with self.app.app_context():
+                credit_money(self.wallet, amount)
+        thread = threading.Thread(target=credit)
+        thread.start()
+        return thread
+
+    def test_replay_from_the_ledger(self):
+        other = create_wallet(create_user("0987654321").id).id
+        credit_money(self.wallet, 200.0)
+        apply_batch([{'wallet_id': self.wallet, 'type': 'credit', 'amount': 5},
+                     {'wallet_id': self.wallet, 'type': 'credit', 'amount': 7}])
+        transfer_money(self.wallet, other, 12.0)
+
+        events, cursor = wallet_events(self.wallet, 0)
+        self.assertEqual([(e['version'], e['balance'], len(e['transactions'])) for e in events],
+                         [(1, 200.0, 1), (2, 212.0, 2), (3, 200.0, 1)])
+        self.assertIsNotNone(events[2]['transactions'][0]['transfer_id'])
+        self.assertEqual(cursor, 3)
+        self.assertEqual(wallet_events(self.wallet, 3), ([], 3))
+        self.assertEqual(wallet_events(self.wallet, None), ([{'version': 3, 'balance': 200.0, 'transactions': []}], 3))
+        # The limit only cuts between commits
+        self.assertEqual([e['version'] for e in wallet_events(self.wallet, 0, limit=2)[0]], [1])
+        self.assertEqual([e['version'] for e in wallet_events(self.wallet, 1, limit=1)[0]], [2])
+
+        # Shard credits have no version of their own; they arrive as the current balance
+        set_wallet_shards(self.wallet, 2)
+        credit_money(self.wallet, 50.0)
+        events, cursor = wallet_events(self.wallet, 3)
+        self.assertEqual((events[-1]['balance'], events[-1]['transactions'], cursor), (250.0, [], events[-1]['version']))
+        with self.assertRaises(ValueError):
+            wallet_events(999, 0)
+
+    def test_long_poll(self):
+        credit_money(self.wallet, 200.0)
+        response = self.client.get(f'/wallet/{self.wallet}/events')
+        self.assertEqual(response.json, {'events': [{'version': 1, 'balance': 200.0, 'transactions': []}], 'version': 1})
+        self.assertEqual(self.client.get(f'/wallet/{self.wallet}/events?since_version=1&timeout=0').json,
+                         {'events': [], 'version': 1})
+
+        writer = self._credit_later(50.0)
+        started = time.monotonic()
+        response = self.client.get(f'/wallet/{self.wallet}/events?since_version=1&timeout=10')
+        writer.join()
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([(e['version'], e['balance']) for e in response.json['events']], [(2, 250.0)])
+        self.assertEqual(response.json['version'], 2)
+
+        self.assertEqual(self.client.get(f'/wallet/{self.wallet}/events?since_version=-1').status_code, 400)
+        self.assertEqual(self.client.get('/wallet/999/events').status_code, 400)
+
+    def test_server_sent_events(self):
+        credit_money(self.wallet, 200.0)
+        response = self.client.get(f'/wallet/{self.wallet}/events', headers={'Accept': 'text/event-stream',
+                                                                             'Last-Event-ID': '0'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        stream = response.response
+        first = next(stream)
+        self.assertTrue(first.startswith(b'id: 1\nevent: balance\ndata: '))
+        self._credit_later(50.0)
+        second = next(stream)
+        self.assertEqual(json.loads(second.split(b'data: ')[1])['balance'], 250.0)
+        response.close()
+
+    def test_waiting_clients_are_capped_and_streams_end(self):
+        credit_money(self.wallet, 200.0)
+        self.app.config['EVENTS_LONG_POLL_TIMEOUT'] = 0.3
+        self.app.config['EVENTS_HEARTBEAT'] = 0.1
+        self.app.extensions['events_wsgi_waiters'] = threading.BoundedSemaphore(1)
+
+        stream = self.client.get(f'/wallet/{self.wallet}/events', headers={'Accept': 'text/event-stream'})
+        self.assertEqual(stream.status_code, 200)
+        # The one slot is taken: a long poll that would wait is turned away, one that has events is not
+        response = self.client.get(f'/wallet/{self.wallet}/events?since_version=1')
+        self.assertEqual((response.status_code, response.headers['Retry-After']), (503, '1'))
+        self.assertEqual(self.client.get(f'/wallet/{self.wallet}/events?since_version=0').status_code, 200)
+
+        # The stream ends after EVENTS_LONG_POLL_TIMEOUT and gives its slot back
+        started = time.monotonic()
+        chunks = list(stream.response)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertTrue(chunks[0].startswith(b'id: 1\n'))
+        self.assertTrue(all(chunk == b': keep-alive\n\n' for chunk in chunks[1:]))
+        stream.close()
+        response = self.client.get(f'/wallet/{self.wallet}/events?since_version=1&timeout=0.1')
+        self.assertEqual(response.json, {'events': [], 'version': 1})
+
+    def test_hub_fans_out_between_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Two hubs sharing a socket directory stand in for two workers
+            listener, publisher = EventHub(directory), EventHub(directory)
+            woken = threading.Event()
+            listener.subscribe(7, woken.set)
+            publisher.publish([7, 8])
+            self.assertTrue(woken.wait(2))
+            self.assertEqual(listener.subscriber_count(), 1)
+            listener.unsubscribe(7, woken.set)
+            self.assertEqual(listener.subscriber_count(), 0)
+            listener._close()
+
+    def test_async_long_poll_and_stream(self):
+        credit_money(self.wallet, 200.0)
+        asgi = AsyncReadAPI(self.app)
+
+        def scope(query, accept):
+            return {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                    'path': f'/wallet/{self.wallet}/events', 'raw_path': b'', 'root_path': '',
+                    'query_string': query.encode(), 'headers': [(b'accept', accept.encode())],
+                    'server': ('testserver', 80), 'client': ('127.0.0.1', 12345)}
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            gone = asyncio.Event()
+            messages = []
+            arrived = asyncio.Event()
+
+            async def receive():
+                await gone.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+                arrived.set()
+
+            def credit(amount):
+                with self.app.app_context():
+                    credit_money(self.wallet, amount)
+
+            # Long poll: answered as soon as the write commits
+            poll = asyncio.ensure_future(asgi(scope('since_version=1&timeout=10', '*/*'), receive, send))
+            await asyncio.sleep(0.1)
+            await loop.run_in_executor(None, credit, 50.0)
+            await asyncio.wait_for(poll, 5)
+            self.assertEqual(json.loads(messages[-1]['body'])['events'][0]['balance'], 250.0)
+
+            # Stream: the current state first, then every change, until the client goes away
+            messages.clear()
+            stream = asyncio.ensure_future(asgi(scope('', 'text/event-stream'), receive, send))
+            while len(messages) < 2:
+                arrived.clear()
+                await asyncio.wait_for(arrived.wait(), 5)
+            await loop.run_in_executor(None, credit, 25.0)
+            while len(messages) < 3:
+                arrived.clear()
+                await asyncio.wait_for(arrived.wait(), 5)
+            gone.set()
+            await asyncio.wait_for(stream, 5)
+            await asgi.engine.dispose()
+            return messages
+
+        messages = asyncio.run(run())
+        self.assertEqual(messages[0]['headers'][0], (b'content-type', b'text/event-stream'))
+        bodies = [message['body'] for message in messages[1:]]
+        self.assertTrue(bodies[0].startswith(b'id: 2\n'))
+        self.assertEqual(json.loads(bodies[1].split(b'data: ')[1])['balance'], 275.0)
+        self.assertEqual(self.app.extensions['events'].subscriber_count(), 0)
@@ -0,0 +1,72 @@
+# tests/test_metrics.py
+import unittest
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.services import create_wallet, create_user
+from app.config import TestingConfig
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        class MetricsConfig(TestingConfig):
+            SLOW_QUERY_THRESHOLD_MS = 0  # log every query
+
+        self.app = create_app(MetricsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_metrics_endpoint(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        self.client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': 200})
+        self.client.get(f'/wallet/balance/{wallet.id}')
+        self.client.get('/wallet/balance/999')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.get_data(as_text=True)
+        self.assertIn('wallet_http_requests_total{endpoint="wallet.api_credit_money",method="POST",status="200"} 1', body)
+        self.assertIn('wallet_http_requests_total{endpoint="wallet.api_get_balance",method="GET",status="400"} 1', body)
+        self.assertIn('wallet_http_request_duration_seconds_count{endpoint="wallet.api_credit_money"} 1', body)
+        self.assertIn('wallet_sql_commits_total{endpoint="wallet.api_credit_money"} 1', body)
+        self.assertIn('wallet_balance_cache_hits_total 1', body)
+
+    def test_queries_are_counted_per_request_and_slow_ones_logged(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        with self.assertLogs('app.sql.slow', level='WARNING') as logs:
+            self.client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': 200})
+        self.assertTrue(any('UPDATE wallet' in line for line in logs.output))
+
+        per_request = self.app.extensions['metrics'].queries_per_request['wallet.api_credit_money']
+        self.assertEqual(per_request.count, 1)
+        self.assertGreaterEqual(per_request.sum, 3)  # read, guarded update, ledger insert(s)
+
+    def test_failed_queries_and_unhandled_errors_are_recorded(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        connection = db.session.connection()
+        with self.assertRaises(OperationalError):
+            connection.exec_driver_sql('SELECT * FROM missing_table')
+        self.assertEqual(connection.info['query_started'], [])
+        db.session.rollback()
+
+        @self.app.route('/boom')
+        def boom():
+            raise RuntimeError('boom')
+        self.app.config['PROPAGATE_EXCEPTIONS'] = False
+        self.assertEqual(self.client.get('/boom').status_code, 500)
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
+        with self.assertRaises(RuntimeError):
+            self.client.get('/boom')
+        self.client.get(f'/wallet/balance/{wallet.id}')
+
+        body = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('wallet_http_requests_total{endpoint="boom",method="GET",status="500"} 2', body)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,340 @@
+# tests/test_routes.py
+import gzip
+import json
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from app import create_app, db
+from app.cache import IdempotencyCache
+from app.models import IdempotencyKey
+from app.services import create_wallet, credit_money, debit_money, get_balance, create_user, apply_batch
+from app.config import TestingConfig
+class TestRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestingConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_batch(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        response = self.client.post('/wallet/batch', json={
+            'mode': 'best_effort',
+            'operations': [
+                {'wallet_id': wallet.id, 'type': 'debit', 'amount': 50},
+                {'wallet_id': wallet.id, 'type': 'debit', 'amount': 60},
+                {'wallet_id': wallet.id, 'type': 'transfer', 'amount': 10},
+            ],
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.json['results']], ['applied', 'rejected', 'rejected'])
+        self.assertEqual(get_balance(wallet.id), 150.0)
+
+    def test_balance_as_of(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        response = self.client.get(f'/wallet/{wallet.id}/balance', query_string={'as_of': '2100-01-01T00:00:00'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json['balance'], response.json['version']), (200.0, 1))
+        self.assertEqual(self.client.get(f'/wallet/{wallet.id}/balance').json['balance'], 200.0)
+        self.assertEqual(self.client.get(f'/wallet/{wallet.id}/balance?as_of=soon').status_code, 400)
+
+    def test_conditional_get(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+
+        balance = self.client.get(f'/wallet/balance/{wallet.id}')
+        etag = balance.headers['ETag']
+        cached = self.client.get(f'/wallet/balance/{wallet.id}', headers={'If-None-Match': etag})
+        self.assertEqual((cached.status_code, cached.data), (304, b''))
+
+        path = f'/wallet/transactions?wallet_id={wallet.id}&start_date=2000-01-01&end_date=2100-01-01'
+        history = self.client.get(path)
+        self.assertEqual(self.client.get(path, headers={'If-None-Match': history.headers['ETag']}).status_code, 304)
+        # Other query parameters make another ETag
+        self.assertNotEqual(self.client.get(path + '&limit=1').headers['ETag'], history.headers['ETag'])
+
+        # Any write bumps the version, debits included
+        debit_money(wallet.id, 50.0)
+        self.assertEqual(self.client.get(f'/wallet/balance/{wallet.id}', headers={'If-None-Match': etag}).status_code, 200)
+        refreshed = self.client.get(path, headers={'If-None-Match': history.headers['ETag']})
+        self.assertEqual(refreshed.status_code, 200)
+        self.assertEqual(len(refreshed.json['history']), 2)
+
+    def test_idempotency_key(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 500.0)
+        body = {'wallet_id': wallet.id, 'amount': 50}
+        headers = {'Idempotency-Key': 'retry-me'}
+
+        first = self.client.post('/wallet/debit', json=body, headers=headers)
+        self.app.extensions['idempotency_cache'] = IdempotencyCache()  # the replay must also work from the table
+        replay = self.client.post('/wallet/debit', json=body, headers=headers)
+        self.assertEqual((first.status_code, first.json), (200, {'new_balance': 450.0}))
+        self.assertEqual((replay.status_code, replay.json), (200, {'new_balance': 450.0}))
+        self.assertEqual(replay.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(get_balance(wallet.id), 450.0)
+
+        # The same request written differently is still a replay
+        equivalents = [{'wallet_id': str(wallet.id), 'amount': 50.0},
+                       {'wallet_id': wallet.id, 'amount': '50', 'minimum_balance': 100.0}]
+        for equivalent in equivalents:
+            replay = self.client.post('/wallet/debit', json=equivalent, headers=headers)
+            self.assertEqual((replay.status_code, replay.json), (200, {'new_balance': 450.0}))
+        self.assertEqual(get_balance(wallet.id), 450.0)
+
+        reused = self.client.post('/wallet/debit', json={'wallet_id': wallet.id, 'amount': 60}, headers=headers)
+        self.assertEqual(reused.status_code, 400)
+        self.assertEqual(get_balance(wallet.id), 450.0)
+
+        # Keys past their TTL are purged in batches
+        db.session.execute(db.update(IdempotencyKey).values(created_at=datetime.now() - timedelta(days=2)))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['purge-idempotency-keys', '--batch-size', '1'])
+        self.assertIn('Deleted 1 idempotency keys', result.output)
+
+    def test_analytics_summary(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        today = datetime.now().date().isoformat()
+        response = self.client.get('/analytics/summary', query_string={'start_date': today, 'end_date': today})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['top_wallets'][0]['wallet_id'], wallet.id)
+        self.assertEqual(response.json['balances']['p99'], 200.0)
+        self.assertEqual(self.client.get('/analytics/summary').status_code, 400)
+        self.assertEqual(self.client.get(f'/analytics/summary?start_date={today}&end_date={today}&top=0').status_code, 400)
+
+        result = self.app.test_cli_runner().invoke(args=['analytics-summary'])
+        self.assertEqual(json.loads(result.output)['totals']['transaction_count'], 1)
+
+    def test_credit_and_debit_validate_amounts(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        response = self.client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': "150"})
+        self.assertEqual((response.status_code, response.json), (200, {'new_balance': 150.0}))
+        for path, amount in [('/wallet/credit', "abc"), ('/wallet/debit', "abc"), ('/wallet/debit', -1000),
+                             ('/wallet/credit', [1])]:
+            response = self.client.post(path, json={'wallet_id': wallet.id, 'amount': amount})
+            self.assertEqual(response.status_code, 400, (path, amount))
+        response = self.client.post('/wallet/debit', json={'wallet_id': wallet.id, 'amount': 10,
+                                                           'minimum_balance': "x"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(get_balance(wallet.id), 150.0)
+
+    def test_transfer(self):
+        source = create_wallet(create_user("1234567890").id)
+        destination = create_wallet(create_user("0987654321").id)
+        credit_money(source.id, 200.0)
+        response = self.client.post('/wallet/transfer', json={
+            'source_wallet_id': source.id, 'destination_wallet_id': destination.id, 'amount': 50})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['source_balance'], 150.0)
+        self.assertEqual(get_balance(destination.id), 50.0)
+
+        response = self.client.post('/wallet/transfer', json={
+            'source_wallet_id': source.id, 'destination_wallet_id': source.id, 'amount': 50})
+        self.assertEqual(response.status_code, 400)
+
+        for amount in ('abc', None, [50], 0, -5):
+            response = self.client.post('/wallet/transfer', json={
+                'source_wallet_id': source.id, 'destination_wallet_id': destination.id, 'amount': amount})
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post('/wallet/transfer', json={
+            'source_wallet_id': source.id, 'destination_wallet_id': destination.id, 'amount': '25'})
+        self.assertEqual(response.json['source_balance'], 125.0)
+
+    def test_multi_wallet_balances(self):
+        wallets = [create_wallet(create_user(f"12345678{i:02d}").id) for i in range(3)]
+        for amount, wallet in zip((100.0, 200.0, 300.0), wallets):
+            credit_money(wallet.id, amount)
+        self.app.extensions['balance_cache'].invalidate(wallets[2].id)
+
+        response = self.client.get(f'/wallet/balances?ids={wallets[0].id},{wallets[2].id},999')
+        self.assertEqual(response.json, {
+            'balances': {str(wallets[0].id): 100.0, str(wallets[2].id): 300.0},
+            'missing': [999],
+        })
+
+        response = self.client.post('/wallet/balances', json={'ids': [w.id for w in wallets]})
+        self.assertEqual(list(response.json['balances'].values()), [100.0, 200.0, 300.0])
+        self.assertEqual(self.client.get('/wallet/balances?ids=1,x').status_code, 400)
+
+    def test_batch_requires_operations(self):
+        response = self.client.post('/wallet/batch', json={'operations': []})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_register_and_wallet_create(self):
+        existing = create_user("1111111111")
+        body = '\n'.join([
+            json.dumps({'phone_number': '2222222222'}),
+            json.dumps({'phone_number': '1111111111'}),
+            'not json',
+            json.dumps({'phone_number': '3333333333'}),
+            json.dumps({'phone_number': '2222222222'}),
+        ])
+        response = self.client.post('/register/bulk', data=body, content_type='application/x-ndjson')
+        users = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([u['status'] for u in users], ['created', 'exists', 'invalid', 'created', 'exists'])
+        self.assertEqual(users[1]['user_id'], existing.id)
+        self.assertEqual(users[0]['user_id'], users[4]['user_id'])
+
+        create_wallet(existing.id)
+        csv_body = f"user_id\n{users[0]['user_id']}\n{existing.id}\n{users[3]['user_id']}\n999\n"
+        response = self.client.post('/wallet/create/bulk', data=csv_body, content_type='text/csv')
+        wallets = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([w['status'] for w in wallets], ['created', 'exists', 'created', 'user_not_found'])
+        self.assertEqual(get_balance(wallets[0]['wallet_id']), 0.0)
+
+    def test_export_transactions(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        debit_money(wallet.id, 50.5)
+
+        response = self.client.get(f'/wallet/{wallet.id}/transactions/export')
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([(r['amount'], r['type']) for r in rows], [(200.0, 'credit'), (50.5, 'debit')])
+
+        response = self.client.get(f'/wallet/{wallet.id}/transactions/export?format=csv',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(response.data).decode().splitlines()
+        self.assertEqual(lines[0], 'id,amount,type,timestamp')
+        self.assertTrue(lines[2].startswith(f"{rows[1]['id']},50.5,debit,"))
+
+        self.assertEqual(self.client.get('/wallet/999/transactions/export').status_code, 400)
+        self.assertEqual(self.client.get(f'/wallet/{wallet.id}/transactions/export?format=xml').status_code, 400)
+
+    def test_credit_and_debit_through_write_pipeline(self):
+        class PipelineConfig(TestingConfig):
+            WRITE_PIPELINE_ENABLED = True
+            WRITE_PIPELINE_SHARDS = 1  # the in-memory database is a single shared connection
+
+        app = create_app(PipelineConfig)
+        with app.app_context():
+            db.create_all()
+            wallet = create_wallet(create_user("1234567890").id)
+            client = app.test_client()
+            pipeline = app.extensions['write_pipeline']
+            try:
+                futures = [pipeline.submit(wallet.id, 'credit', 100) for _ in range(5)]
+                futures.append(pipeline.submit(wallet.id, 'debit', 450))  # would leave 50 < 100
+                futures.append(pipeline.submit(wallet.id, 'debit', 300))
+                self.assertEqual([f.result(5) for f in futures[:5]], [100.0, 200.0, 300.0, 400.0, 500.0])
+                with self.assertRaises(ValueError):
+                    futures[5].result(5)
+                self.assertEqual(futures[6].result(5), 200.0)
+
+                response = client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': 50})
+                self.assertEqual(response.json, {'new_balance': 250.0})
+                self.assertEqual(pipeline.items, 8)
+                self.assertLessEqual(pipeline.batches, 8)
+
+                # Rejected before reaching the pipeline, like a direct write
+                for amount in ('inf', 'nan', True, -5, 'abc'):
+                    response = client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': amount})
+                    self.assertEqual(response.status_code, 400)
+                response = client.post('/wallet/debit', json={'wallet_id': wallet.id, 'amount': 10,
+                                                              'minimum_balance': 'inf'})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(pipeline.items, 8)
+                self.assertEqual(get_balance(wallet.id), 250.0)
+            finally:
+                pipeline.close()
+                db.session.remove()
+                db.drop_all()
+
+    def test_write_pipeline_timeouts(self):
+        class PipelineConfig(TestingConfig):
+            WRITE_PIPELINE_ENABLED = True
+            WRITE_PIPELINE_SHARDS = 1
+            WRITE_PIPELINE_TIMEOUT = 0.2
+
+        app = create_app(PipelineConfig)
+        gate = threading.Event()
+
+        def slow_apply_batch(*args, **kwargs):
+            gate.wait(5)
+            return apply_batch(*args, **kwargs)
+
+        with app.app_context(), patch('app.services.apply_batch', slow_apply_batch):
+            db.create_all()
+            wallet = create_wallet(create_user("1234567890").id)
+            client = app.test_client()
+            pipeline = app.extensions['write_pipeline']
+            try:
+                # Taken by the worker, which is stuck committing it: the outcome is unknown
+                response = client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': 150})
+                self.assertEqual((response.status_code, response.json['outcome']), (504, 'unknown'))
+                # Still queued behind it: withdrawn, so it is safe to retry
+                response = client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': 1000})
+                self.assertEqual(response.status_code, 503)
+                gate.set()
+                self.assertEqual(client.post('/wallet/credit', json={'wallet_id': wallet.id, 'amount': 50}).json,
+                                 {'new_balance': 200.0})
+                self.assertEqual(pipeline.items, 2)
+            finally:
+                gate.set()
+                pipeline.close()
+                db.session.remove()
+                db.drop_all()
+
+    def test_write_pipeline_with_admission_control(self):
+        class PipelineConfig(TestingConfig):
+            WRITE_PIPELINE_ENABLED = True
+            WRITE_PIPELINE_SHARDS = 1
+            ADMISSION_ENABLED = True
+            ADMISSION_MAX_PER_WALLET = 2
+            ADMISSION_QUEUE_TIMEOUT = 0.05
+
+        app = create_app(PipelineConfig)
+        gate = threading.Event()
+
+        def slow_apply_batch(*args, **kwargs):
+            gate.wait(5)
+            return apply_batch(*args, **kwargs)
+
+        with app.app_context(), patch('app.services.apply_batch', slow_apply_batch):
+            db.create_all()
+            wallet_id = create_wallet(create_user("1234567890").id).id
+            pipeline = app.extensions['write_pipeline']
+            admission = app.extensions['admission']
+            statuses = []
+
+            def credit():
+                response = app.test_client().post('/wallet/credit', json={'wallet_id': wallet_id, 'amount': 150})
+                statuses.append(response.status_code)
+
+            threads = [threading.Thread(target=credit) for _ in range(8)]
+            try:
+                for thread in threads:
+                    thread.start()
+                # All eight wait on the pipeline at once, more than the per-wallet limit
+                for _ in range(500):
+                    if admission.stats()['in_flight'] == 8:
+                        break
+                    threading.Event().wait(0.01)
+                self.assertEqual(admission.stats()['in_flight'], 8)
+                gate.set()
+                for thread in threads:
+                    thread.join(5)
+                self.assertEqual(statuses, [200] * 8)
+                self.assertEqual(get_balance(wallet_id), 1200.0)
+                self.assertLessEqual(pipeline.batches, 2)
+            finally:
+                gate.set()
+                pipeline.close()
+                db.session.remove()
+                db.drop_all()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,23 @@
 # tests/test_services.py
+import json
+import os
+import tempfile
 import threading
 import unittest
+from datetime import datetime, timedelta
+import numpy as np
 from app import create_app, db
-from app.models import User, Wallet, WalletTransaction
-from app.services import create_wallet, credit_money, debit_money, get_balance, transaction_history, create_user
+from app.models import User, Wallet, WalletTransaction, WalletTransactionArchive, WalletDailyTotals, WalletShard
+from app.services import create_wallet, credit_money, debit_money, get_balance, transaction_history, create_user, \
+    apply_batch, transaction_totals, balance_cache, transfer_money, export_transactions, rebuild_daily_totals, \
+    balance_as_of, archive_transactions, set_wallet_shards, wallet_version, contention, ledger_summary, \
+    export_ledger_snapshot, bulk_create_wallets
+from app import services
+from app.snapshots import LedgerSnapshot
 from app.config import TestingConfig
+from app.storage import reader_engine
+from unittest.mock import patch
+from sqlalchemy.exc import OperationalError, IntegrityError
 class TestServices(unittest.TestCase):
 
     def setUp(self):
@@ -35,34 +48,122 @@ class TestServices(unittest.TestCase):
 
         self.assertEqual(str(context.exception), 'Balance cannot drop below minimum required balance of 100')
 
+    def test_amounts_are_validated(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 500.0)
+        for amount in (-1000, 0, "abc", None, float('nan'), True):
+            with self.assertRaises(ValueError):
+                debit_money(wallet.id, amount)
+        self.assertEqual(debit_money(wallet.id, "50", minimum_balance="0"), 450.0)
+
+    def test_wallet_ids_are_parsed_before_writing(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        other = create_wallet(create_user("0987654321").id)
+        for wallet_id in (f"{wallet.id}.0", wallet.id + 0.5, True, None, "abc"):
+            with self.assertRaises(ValueError):
+                credit_money(wallet_id, 200.0)
+            with self.assertRaises(ValueError):
+                transfer_money(wallet_id, other.id, 10.0)
+            outcome = apply_batch([{'wallet_id': wallet_id, 'type': 'credit', 'amount': 200}], atomic=False)
+            self.assertEqual(outcome['results'][0]['status'], 'rejected')
+        self.assertEqual(WalletTransaction.query.count(), 0)
+        self.assertEqual(credit_money(str(wallet.id), 200.0), 200.0)
+        self.assertEqual(balance_cache().get(wallet.id)[0], 200.0)
+
+    def test_cache_failures_after_commit_do_not_fail_the_write(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        other = create_wallet(create_user("0987654321").id)
+        with patch.object(type(balance_cache()), 'put', side_effect=RuntimeError('cache down')), \
+                self.assertLogs('app.post_commit', level='ERROR'):
+            self.assertEqual(credit_money(wallet.id, 200.0), 200.0)
+            self.assertEqual(transfer_money(wallet.id, other.id, 50.0)['source_balance'], 150.0)
+            self.assertTrue(apply_batch([{'wallet_id': other.id, 'type': 'credit', 'amount': 100}])['committed'])
+        self.assertEqual((get_balance(wallet.id), get_balance(other.id)), (150.0, 150.0))
+
+    def test_database_failures_are_not_retried_as_conflicts(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        WalletTransaction.__table__.drop(db.engine)
+        before = dict(contention)
+        with self.assertRaises(OperationalError):
+            credit_money(wallet.id, 200.0)
+        self.assertEqual(dict(contention), before)
+        self.assertEqual(get_balance(wallet.id), 0.0)  # rolled back
+        WalletTransaction.__table__.create(db.engine)
+
+    def _run_on_file_database(self, test):
+        # An in-memory database lives on a single shared connection, so race on a real file instead
+        with tempfile.TemporaryDirectory() as directory:
+            class FileConfig(TestingConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'wallet.db')
+
+            app = create_app(FileConfig)
+            with app.app_context():
+                db.create_all()
+                try:
+                    test(app)
+                finally:
+                    db.session.remove()
+                    db.drop_all()
+                    db.engine.dispose()
+                    reader_engine().dispose()
+
+    def test_one_wallet_per_user(self):
+        user = create_user("1234567890")
+        wallet = create_wallet(user.id)
+        db.session.add(Wallet(user_id=user.id, balance=0.0))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        # A wallet created by a concurrent request between the dedupe query and the insert
+        other = create_user("0987654321")
+        insert_returning = services._insert_returning
+        raced = []
+
+        def racing_insert(table, rows, *columns):
+            if not raced:
+                raced.append(Wallet(user_id=other.id, balance=0.0))
+                db.session.add(raced[0])
+                db.session.commit()
+            return insert_returning(table, rows, *columns)
+
+        with patch('app.services._insert_returning', racing_insert):
+            results = list(bulk_create_wallets([user.id, other.id]))
+        self.assertEqual(results, [{'user_id': user.id, 'wallet_id': wallet.id, 'status': 'exists'},
+                                   {'user_id': other.id, 'wallet_id': raced[0].id, 'status': 'exists'}])
+
     #threading.Barrier to ensure all threads start their operation at same time
     def test_race_condition_debit_money(self):
+        self._run_on_file_database(self._race_debit_money)
+
+    def _race_debit_money(self, app):
         user = create_user("1234567890")
         wallet = create_wallet(user.id)
-        credit_money(wallet.id, 200.0)
+        credit_money(wallet.id, 600.0)
         debit_money(wallet.id, 50.0)
-        initial_balance = wallet.balance
+        initial_balance = get_balance(wallet.id)
         num_threads = 5 # Number of threads for concurrent debit operations
         amount_to_debit = 10
+        succeeded = []
+        rejected = []
 
-        def concurrent_debit(barrier, app_context):
-            app_context.push()  # Push the application context into the thread
-            try:
+        def concurrent_debit(barrier):
+            # Every thread gets its own app context and therefore its own scoped session
+            with app.app_context():
                 barrier.wait()  # Wait for all threads to start
-                for _ in range(100):  # Perform multiple debit operations in each thread
-                    # Create a new session for each thread as SQL Alchemy operations aren't thread safe
-                    with db.session_scope() as session:
-                        debit_money(session, wallet.id, amount_to_debit)
-            except Exception as e:
-                print(f"Error in thread: {e}")
-            finally:
-                app_context.pop()  # Pop the application context after the operation
+                for _ in range(20):  # Perform multiple debit operations in each thread
+                    try:
+                        debit_money(wallet.id, amount_to_debit)
+                        succeeded.append(amount_to_debit)
+                    except ValueError as e:
+                        rejected.append(str(e))
+                db.session.remove()
 
         # Create threads for concurrent debit operations
         barrier = threading.Barrier(num_threads)
         threads = []
         for _ in range(num_threads):
-            thread = threading.Thread(target=concurrent_debit, args=(barrier, self.app_context))
+            thread = threading.Thread(target=concurrent_debit, args=(barrier,))
             threads.append(thread)
             thread.start()
 
@@ -70,12 +171,17 @@ class TestServices(unittest.TestCase):
         for thread in threads:
             thread.join()
 
-        # Check the final balance after all debit operations
+        # Drop the objects this session cached before the threads ran
+        db.session.expire_all()
         final_balance = get_balance(wallet.id)
+        ledger = db.session.query(WalletTransaction).filter_by(wallet_id=wallet.id).all()
+        ledger_balance = sum(t.amount if t.type == 'credit' else -t.amount for t in ledger)
 
-        # Adjust the assertion based on your expectations
-        print(final_balance,initial_balance,num_threads * 100 * amount_to_debit)
-        self.assertTrue(final_balance >= initial_balance - (num_threads * 100 * amount_to_debit))
+        # The overdraft guarantee holds and every successful debit is in the ledger exactly once
+        self.assertGreaterEqual(final_balance, 100)
+        self.assertEqual(final_balance, initial_balance - sum(succeeded))
+        self.assertEqual(final_balance, ledger_balance)
+        self.assertEqual(len(succeeded) + len(rejected), num_threads * 20)
 
     def test_transaction_history(self):
         user = create_user("1234567890")
@@ -87,5 +193,461 @@ class TestServices(unittest.TestCase):
         self.assertIn('total_credit', history)
         self.assertIn('total_debit', history)
 
+    def test_history_and_totals_cover_the_same_days(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        debit_money(wallet.id, 50.0)
+        today = datetime.now().date().isoformat()
+        history = transaction_history(wallet.id, today, today)
+        totals = transaction_totals(wallet.id, today, today)
+        self.assertEqual((history['total_credit'], history['total_debit']), (200.0, 50.0))
+        self.assertEqual((totals['total_credit'], totals['total_debit']), (200.0, 50.0))
+        self.assertEqual(len(history['history']), 2)
+
+        # The last instant of end_date is in, midnight after it is out
+        for timestamp in (datetime(2024, 4, 30, 23, 59, 59, 999999), datetime(2024, 5, 1)):
+            db.session.add(WalletTransaction(wallet_id=wallet.id, amount=7.0, type='credit', timestamp=timestamp))
+        db.session.commit()
+        rebuild_daily_totals()
+        history = transaction_history(wallet.id, '2024-04-01', '2024-04-30')
+        self.assertEqual((history['total_credit'], len(history['history'])), (7.0, 1))
+        self.assertEqual(transaction_totals(wallet.id, '2024-04-01', '2024-04-30')['total_credit'], 7.0)
+
+    def test_transaction_history_pagination(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        for amount in (200.0, 10.0, 20.0, 30.0):
+            credit_money(wallet.id, amount)
+        debit_money(wallet.id, 50.0)
+
+        pages, after = [], None
+        while True:
+            page = transaction_history(wallet.id, '2000-01-01', '2100-01-01', limit=2, after=after)
+            pages.append([txn['amount'] for txn in page['history']])
+            after = page['next_cursor']
+            if after is None:
+                break
+
+        self.assertEqual(pages, [[200.0, 10.0], [20.0, 30.0], [50.0]])
+        self.assertEqual(page['total_credit'], 260.0)
+        self.assertEqual(page['total_debit'], 50.0)
+        with self.assertRaises(ValueError):
+            transaction_history(wallet.id, '2000-01-01', '2100-01-01', after='not-a-cursor')
+
+    def test_daily_totals_rollup(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        debit_money(wallet.id, 50.0)
+        apply_batch([{'wallet_id': wallet.id, 'type': 'credit', 'amount': 25}])
+
+        totals = transaction_totals(wallet.id, '2000-01-01', '2100-01-01')
+        self.assertEqual(totals, {'total_credit': 225.0, 'total_debit': 50.0, 'transaction_count': 3})
+
+        # Rebuilding from the ledger produces the same rollup
+        db.session.query(WalletDailyTotals).delete()
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['backfill-daily-totals'])
+        self.assertIn('Wrote 1 daily total rows', result.output)
+        self.assertEqual(transaction_totals(wallet.id, '2000-01-01', '2100-01-01'), totals)
+
+    def test_ledger_archival(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        for amount in (200.0, 10.0, 20.0):
+            credit_money(wallet.id, amount)
+        debit_money(wallet.id, 50.0)
+        # Age the first two rows past the archive horizon
+        old = datetime.now() - timedelta(days=400)
+        for offset, txn in enumerate(WalletTransaction.query.order_by(WalletTransaction.id).limit(2)):
+            txn.timestamp = old + timedelta(seconds=offset)
+        db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['archive-ledger', '--batch-size', '1'])
+        self.assertIn('Archived 2 ledger rows older than 365 days', result.output)
+        self.assertEqual(WalletTransaction.query.count(), 2)
+        self.assertEqual(WalletTransactionArchive.query.count(), 2)
+
+        # Recent ranges never reach the archive; longer ones merge both tables across page boundaries
+        recent = transaction_history(wallet.id, datetime.now() - timedelta(days=1), '2100-01-01')
+        self.assertEqual([txn['amount'] for txn in recent['history']], [20.0, 50.0])
+        pages, after = [], None
+        while True:
+            page = transaction_history(wallet.id, '2000-01-01', '2100-01-01', limit=3, after=after)
+            pages.append([txn['amount'] for txn in page['history']])
+            after = page['next_cursor']
+            if after is None:
+                break
+        self.assertEqual(pages, [[200.0, 10.0, 20.0], [50.0]])
+        self.assertEqual((page['total_credit'], page['total_debit']), (230.0, 50.0))
+
+        self.assertEqual([row.amount for row in export_transactions(wallet.id)], [200.0, 10.0, 20.0, 50.0])
+        rebuild_daily_totals()
+        totals = transaction_totals(wallet.id, '2000-01-01', '2100-01-01')
+        self.assertEqual(totals, {'total_credit': 230.0, 'total_debit': 50.0, 'transaction_count': 4})
+
+    def test_balance_as_of(self):
+        source = create_wallet(create_user("1234567890").id)
+        destination = create_wallet(create_user("0987654321").id)
+        credit_money(source.id, 200.0)
+        transfer_money(source.id, destination.id, 50.0)
+        apply_batch([{'wallet_id': source.id, 'type': 'credit', 'amount': 5},
+                     {'wallet_id': source.id, 'type': 'credit', 'amount': 7}])
+
+        rows = WalletTransaction.query.filter_by(wallet_id=source.id).order_by(WalletTransaction.id).all()
+        self.assertEqual([(row.balance_after, row.version) for row in rows],
+                         [(200.0, 1), (150.0, 2), (155.0, 3), (162.0, 3)])
+        # Spread the rows out in time and archive the first one
+        start = datetime.now() - timedelta(days=400)
+        for offset, row in enumerate(rows):
+            row.timestamp = start + timedelta(days=100 * offset)
+        db.session.commit()
+        archive_transactions(365)
+
+        def as_of(days):
+            return balance_as_of(source.id, (start + timedelta(days=days)).isoformat())['balance']
+        self.assertEqual([as_of(-1), as_of(0), as_of(150), as_of(350)], [0.0, 200.0, 150.0, 162.0])
+        self.assertEqual(balance_as_of(destination.id, datetime.now().isoformat())['balance'], 50.0)
+        with self.assertRaises(ValueError):
+            balance_as_of(source.id, 'yesterday')
+
+    def test_reconcile(self):
+        self._run_on_file_database(self._reconcile)
+
+    def _reconcile(self, app):
+        wallets = [create_wallet(create_user(str(i)).id).id for i in range(5)]
+        for wallet_id in wallets:
+            credit_money(wallet_id, 200.0)
+        # Drift two balances away from their ledgers
+        db.session.execute(db.update(Wallet).where(Wallet.id.in_(wallets[1:3])).values(balance=999.0))
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['reconcile', '--workers', '2', '--range-size', '2'])
+        reported = sorted(json.loads(line)['wallet_id'] for line in result.stdout.splitlines())
+        self.assertEqual(reported, wallets[1:3])
+        self.assertIn('Checked 5 wallets: 2 mismatched, 0 repaired', result.stderr)
+
+        result = runner.invoke(args=['reconcile', '--workers', '2', '--repair'])
+        self.assertIn('2 mismatched, 2 repaired', result.stderr)
+        self.assertEqual(get_balance(wallets[1]), 200.0)
+        result = runner.invoke(args=['reconcile', '--workers', '2'])
+        self.assertIn('0 mismatched', result.stderr)
+
+    def test_idempotency_key_is_written_with_the_ledger_row(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0, idempotency_key='k1')
+        # A duplicate that slipped past the lookup fails on the key and applies nothing
+        with self.assertRaises(ValueError):
+            credit_money(wallet.id, 200.0, idempotency_key='k1')
+        self.assertEqual(get_balance(wallet.id), 200.0)
+        self.assertEqual(WalletTransaction.query.count(), 1)
+
+    def test_sharded_wallet(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        other = create_wallet(create_user("0987654321").id)
+        credit_money(other.id, 500.0)
+        set_wallet_shards(wallet.id, 4)
+        credit_money(wallet.id, 200.0)
+        versions = [wallet_version(wallet.id)]
+        for _ in range(10):
+            credit_money(wallet.id, 10.0)
+            versions.append(wallet_version(wallet.id))
+
+        # The credits sit in the shards, but reads and versions see all of them
+        self.assertEqual(db.session.get(Wallet, wallet.id).balance, 0.0)
+        self.assertEqual(sum(shard.balance for shard in WalletShard.query.filter_by(wallet_id=wallet.id)), 300.0)
+        self.assertEqual(get_balance(wallet.id), 300.0)
+        self.assertEqual(versions, sorted(set(versions)))
+
+        # Debits fold the shards first and check the minimum against the whole balance
+        with self.assertRaises(ValueError):
+            debit_money(wallet.id, 250.0)
+        self.assertEqual(debit_money(wallet.id, 150.0), 150.0)
+        self.assertEqual(db.session.get(Wallet, wallet.id).balance, 150.0)
+        self.assertEqual(WalletShard.query.filter(WalletShard.balance != 0).count(), 0)
+        rows = WalletTransaction.query.filter_by(wallet_id=wallet.id).order_by(WalletTransaction.id).all()
+        self.assertEqual([row.balance_after for row in rows], [200.0 + 10 * i for i in range(11)] + [150.0])
+        self.assertGreater(wallet_version(wallet.id), versions[-1])
+
+        # Transfers and batches fold as well
+        credit_money(wallet.id, 25.0)
+        self.assertEqual(balance_as_of(wallet.id, datetime.now().isoformat())['balance'], 175.0)
+        transfer_money(other.id, wallet.id, 100.0)
+        result = apply_batch([{'wallet_id': wallet.id, 'type': 'debit', 'amount': 75},
+                              {'wallet_id': wallet.id, 'type': 'debit', 'amount': 1000}], atomic=False)
+        self.assertEqual(result['results'][0]['new_balance'], 200.0)
+        self.assertEqual(get_balance(wallet.id), 200.0)
+
+        # Compaction folds idle shards; turning sharding off keeps the balance and the version moving up
+        credit_money(wallet.id, 10.0)
+        runner = self.app.test_cli_runner()
+        self.assertIn('Compacted 1 sharded wallets', runner.invoke(args=['compact-shards']).output)
+        self.assertEqual(db.session.get(Wallet, wallet.id).balance, 210.0)
+        before = wallet_version(wallet.id)
+        self.assertIn('now has 0 shards', runner.invoke(args=['shard-wallet', str(wallet.id), '--shards', '0']).output)
+        self.assertEqual(WalletShard.query.count(), 0)
+        self.assertGreater(wallet_version(wallet.id), before)
+        self.assertEqual(credit_money(wallet.id, 10.0), 220.0)
+        self.assertEqual(transaction_totals(wallet.id, '2000-01-01', '2100-01-01')['total_credit'], 445.0)
+        with self.assertRaises(ValueError):
+            set_wallet_shards(wallet.id, -1)
+
+    def test_sharded_credits_do_not_conflict(self):
+        self._run_on_file_database(self._sharded_credits)
+
+    def _sharded_credits(self, app):
+        wallet = create_wallet(create_user("1234567890").id)
+        set_wallet_shards(wallet.id, 8)
+        conflicts = contention['conflicts']
+        barrier = threading.Barrier(8)
+
+        def credit():
+            with app.app_context():
+                barrier.wait()
+                for _ in range(10):
+                    credit_money(wallet.id, 150.0)
+        threads = [threading.Thread(target=credit) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(get_balance(wallet.id), 8 * 10 * 150.0)
+        self.assertEqual(contention['conflicts'], conflicts)
+
+    def test_sharded_credits_and_debits_run_concurrently(self):
+        self._run_on_file_database(self._sharded_credits_and_debits)
+
+    def _sharded_credits_and_debits(self, app):
+        wallet = create_wallet(create_user("1234567890").id)
+        set_wallet_shards(wallet.id, 4)
+        credit_money(wallet.id, 1000.0)
+        barrier = threading.Barrier(6)
+        errors = []
+
+        def write(operation, amount):
+            with app.app_context():
+                barrier.wait()
+                for _ in range(20):
+                    try:
+                        operation(wallet.id, amount)
+                    except ValueError as e:
+                        errors.append(str(e))
+                db.session.remove()
+        threads = [threading.Thread(target=write, args=(credit_money, 150.0)) for _ in range(4)]
+        threads += [threading.Thread(target=write, args=(debit_money, 10.0)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Folds no longer race the credits, so every debit goes through
+        self.assertEqual(errors, [])
+        db.session.expire_all()
+        self.assertEqual(get_balance(wallet.id), 1000.0 + 4 * 20 * 150.0 - 2 * 20 * 10.0)
+        totals = transaction_totals(wallet.id, '2000-01-01', '2100-01-01')
+        self.assertEqual((totals['total_credit'], totals['total_debit'], totals['transaction_count']),
+                         (1000.0 + 4 * 20 * 150.0, 2 * 20 * 10.0, 121))
+        # Sharded credits add to their shard's rollup row, not the wallet's own row for the day
+        self.assertGreater(WalletDailyTotals.query.filter_by(wallet_id=wallet.id).count(), 1)
+
+    def test_ledger_summary(self):
+        wallets = [create_wallet(create_user(str(i)).id).id for i in range(5)]
+        today = datetime.now().date()
+        for i, wallet_id in enumerate(wallets):
+            credit_money(wallet_id, 100.0 * (i + 1))
+        debit_money(wallets[4], 50.0)
+        # Add activity on earlier days straight into the rollup
+        for days, wallet_id, amount in [(1, wallets[0], 1000.0), (1, wallets[2], 10.0), (3, wallets[1], 5.0)]:
+            db.session.add(WalletDailyTotals(wallet_id=wallet_id, day=today - timedelta(days=days),
+                                             credit_sum=amount, debit_sum=0.0, txn_count=1))
+        db.session.commit()
+        # Tiny chunks, so wallets are split across them
+        self.app.config['ANALYTICS_CHUNK_SIZE'] = 2
+
+        report = ledger_summary((today - timedelta(days=2)).isoformat(), today.isoformat(), top=2)
+        self.assertEqual(report['totals'], {'credit_volume': 2510.0, 'debit_volume': 50.0, 'transaction_count': 8})
+        self.assertEqual([(day['day'], day['credit_volume'], day['transaction_count']) for day in report['days']],
+                         [(str(today - timedelta(days=1)), 1010.0, 2), (str(today), 1500.0, 6)])
+        self.assertEqual([(w['wallet_id'], w['flow']) for w in report['top_wallets']],
+                         [(wallets[0], 1100.0), (wallets[4], 550.0)])
+        balances = report['balances']
+        self.assertEqual((balances['wallets'], balances['total'], balances['min'], balances['max'], balances['p50']),
+                         (5, 1450.0, 100.0, 450.0, 300.0))
+
+        # Served from the cache until it expires
+        credit_money(wallets[0], 100.0)
+        self.assertIs(ledger_summary(str(today - timedelta(days=2)), str(today), top=2), report)
+        with self.assertRaises(ValueError):
+            ledger_summary(str(today), str(today - timedelta(days=1)))
+        with self.assertRaises(ValueError):
+            ledger_summary('2000-01-01', '2100-01-01')
+
+    def test_ledger_snapshot(self):
+        a, b, c = (create_wallet(create_user(str(i)).id).id for i in range(3))
+        rows = [
+            (a, 100.0, 'credit', datetime(2026, 8, 15, 12)),
+            (b, 300.0, 'credit', datetime(2026, 8, 1)),
+            (a, 20.25, 'debit', datetime(2026, 9, 10, 8, 30)),
+            (a, 0.1, 'credit', datetime(2026, 9, 30, 23, 59, 59, 500000)),
+            (a, 1000.0, 'credit', datetime(2026, 10, 1)),  # after the period
+        ]
+        db.session.add_all(WalletTransaction(wallet_id=w, amount=amount, type=t, timestamp=ts) for w, amount, t, ts in rows)
+        db.session.add(WalletTransactionArchive(id=100, wallet_id=a, amount=50.0, type='credit',
+                                                timestamp=datetime(2026, 9, 2)))
+        db.session.commit()
+        rebuild_daily_totals()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, '2026-09.ledger')
+            # Tiny chunks, so a wallet's records span several of them
+            self.assertEqual(export_ledger_snapshot(path, '2026-09-01', '2026-09-30', batch_size=2),
+                             {'records': 3, 'wallets': 3})
+            self.assertEqual(os.listdir(directory), ['2026-09.ledger'])
+            db.drop_all()  # statements come from the file alone
+
+            with LedgerSnapshot(path) as snapshot:
+                self.assertEqual((snapshot.start, snapshot.end), (datetime(2026, 9, 1), datetime(2026, 10, 1)))
+                statement = snapshot.statement(a)
+                self.assertEqual((statement['opening_balance'], statement['total_credit'], statement['total_debit'],
+                                  statement['closing_balance']), (100.0, 50.1, 20.25, 129.85))
+                self.assertEqual([(t['timestamp'], t['type'], t['amount']) for t in statement['transactions']], [
+                    ('2026-09-02T00:00:00.000000', 'credit', 50.0),
+                    ('2026-09-10T08:30:00.000000', 'debit', 20.25),
+                    ('2026-09-30T23:59:59.500000', 'credit', 0.1),
+                ])
+                self.assertTrue(np.shares_memory(snapshot.transactions(a), snapshot.records))
+
+                statements = list(snapshot.statements(transactions=False))
+                self.assertEqual(statements[0], {k: v for k, v in statement.items() if k != 'transactions'})
+                self.assertEqual([(s['wallet_id'], s['closing_balance'], s['transaction_count']) for s in statements],
+                                 [(a, 129.85, 3), (b, 300.0, 0), (c, 0.0, 0)])
+                self.assertEqual(snapshot.totals()['closing'].tolist(), [12985, 30000, 0])
+                with self.assertRaises(ValueError):
+                    snapshot.statement(999)
+
+            result = self.app.test_cli_runner().invoke(args=['snapshot-statements', path, '--wallet-id', str(b),
+                                                              '--totals-only'])
+            self.assertEqual(json.loads(result.output)['closing_balance'], 300.0)
+            with open(os.path.join(directory, 'other'), 'wb') as f:
+                f.write(b'not a snapshot')
+            with self.assertRaises(ValueError):
+                LedgerSnapshot(os.path.join(directory, 'other'))
+
+    def test_balance_cache(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(str(wallet.id), 200.0)  # JSON clients may send ids as strings
+        cache = balance_cache()
+
+        # The write populated the cache, so reads never touch the database
+        self.assertEqual(get_balance(wallet.id), 200.0)
+        self.assertEqual(get_balance(wallet.id), 200.0)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+        debit_money(wallet.id, 50.0)
+        self.assertEqual(get_balance(wallet.id), 150.0)
+
+        # A reader holding an older version cannot overwrite the newer entry
+        cache.put(wallet.id, 200.0, 1)
+        self.assertEqual(get_balance(wallet.id), 150.0)
+
+        cache.invalidate(wallet.id)
+        self.assertEqual(get_balance(wallet.id), 150.0)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_transfer_money(self):
+        source = create_wallet(create_user("1234567890").id)
+        destination = create_wallet(create_user("0987654321").id)
+        credit_money(source.id, 300.0)
+
+        transfer = transfer_money(source.id, destination.id, 150.0)
+        self.assertEqual((transfer['source_balance'], transfer['destination_balance']), (150.0, 150.0))
+        legs = WalletTransaction.query.filter_by(transfer_id=transfer['transfer_id']).all()
+        self.assertEqual(sorted((t.wallet_id, t.type) for t in legs), [(source.id, 'debit'), (destination.id, 'credit')])
+
+        with self.assertRaises(ValueError):
+            transfer_money(source.id, destination.id, 100.0)  # would leave 50 < 100
+        with self.assertRaises(ValueError):
+            transfer_money(source.id, 999, 10.0)
+        self.assertEqual((get_balance(source.id), get_balance(destination.id)), (150.0, 150.0))
+
+    def test_concurrent_bidirectional_transfers(self):
+        self._run_on_file_database(self._bidirectional_transfers)
+
+    def _bidirectional_transfers(self, app):
+        first = create_wallet(create_user("1234567890").id)
+        second = create_wallet(create_user("0987654321").id)
+        credit_money(first.id, 1000.0)
+        credit_money(second.id, 1000.0)
+        first_id, second_id = first.id, second.id
+        barrier = threading.Barrier(4)
+
+        def transfer(source, destination):
+            with app.app_context():
+                barrier.wait()
+                for _ in range(25):
+                    try:
+                        transfer_money(source, destination, 7.0)
+                    except ValueError:
+                        pass
+                db.session.remove()
+
+        threads = [threading.Thread(target=transfer, args=pair)
+                   for pair in [(first_id, second_id), (second_id, first_id)] * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Money is never created or lost, and every transfer wrote both legs
+        self.assertEqual(get_balance(first_id) + get_balance(second_id), 2000.0)
+        legs = WalletTransaction.query.filter(WalletTransaction.transfer_id.isnot(None)).all()
+        self.assertEqual(len(legs) % 2, 0)
+        self.assertEqual(len({t.transfer_id for t in legs}) * 2, len(legs))
+
+    def test_apply_batch_best_effort(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        other = create_wallet(create_user("0987654321").id)
+        outcome = apply_batch([
+            {'wallet_id': wallet.id, 'type': 'credit', 'amount': 300},
+            {'wallet_id': other.id, 'type': 'credit', 'amount': 150},
+            {'wallet_id': wallet.id, 'type': 'debit', 'amount': 250},  # would drop below 100
+            {'wallet_id': wallet.id, 'type': 'debit', 'amount': 50},
+            {'wallet_id': 9999, 'type': 'credit', 'amount': 10},
+        ], atomic=False)
+
+        self.assertTrue(outcome['committed'])
+        self.assertEqual([r['status'] for r in outcome['results']],
+                         ['applied', 'applied', 'rejected', 'applied', 'rejected'])
+        self.assertEqual(outcome['results'][3]['new_balance'], 250.0)
+        self.assertEqual(get_balance(wallet.id), 250.0)
+        self.assertEqual(get_balance(other.id), 150.0)
+        self.assertEqual(WalletTransaction.query.filter_by(wallet_id=wallet.id).count(), 2)
+
+    def test_apply_batch_atomic_rejects_everything(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        outcome = apply_batch([
+            {'wallet_id': wallet.id, 'type': 'credit', 'amount': 100},
+            {'wallet_id': wallet.id, 'type': 'debit', 'amount': 500},
+        ])
+
+        self.assertFalse(outcome['committed'])
+        self.assertEqual([r['status'] for r in outcome['results']], ['skipped', 'rejected'])
+        db.session.expire_all()
+        self.assertEqual(get_balance(wallet.id), 200.0)
+        self.assertEqual(WalletTransaction.query.filter_by(wallet_id=wallet.id).count(), 1)
+
+    def test_apply_batch_validates_amounts(self):
+        wallet = create_wallet(create_user("1234567890").id)
+        credit_money(wallet.id, 200.0)
+        operations = [{'wallet_id': wallet.id, 'type': 'credit', 'amount': amount}
+                      for amount in ('inf', 'nan', float('inf'), True, '-5', 'abc')]
+        operations.append({'wallet_id': wallet.id, 'type': 'debit', 'amount': 10, 'minimum_balance': 'nan'})
+        operations.append({'wallet_id': wallet.id, 'type': 'debit', 'amount': 10, 'minimum_balance': False})
+        operations.append({'wallet_id': wallet.id, 'type': 'credit', 'amount': '25'})
+        outcome = apply_batch(operations, atomic=False)
+
+        self.assertEqual([r['status'] for r in outcome['results']], ['rejected'] * 8 + ['applied'])
+        self.assertEqual(get_balance(wallet.id), 225.0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,88 @@
+# tests/test_storage.py
+import os
+import tempfile
+import unittest
+from sqlalchemy import inspect, text
+from app import create_app, db
+from app.config import TestingConfig, get_config
+from app.storage import reader_engine
+class TestStorage(unittest.TestCase):
+
+    def test_config_database_url_is_honored(self):
+        app = create_app(TestingConfig)
+        with app.app_context():
+            self.assertEqual(db.engine.url.database, ':memory:')
+            self.assertEqual(app.config['STORAGE_PROFILE'], 'sqlite')
+            self.assertIsNone(reader_engine())
+
+    def test_get_config_selects_storage_profile(self):
+        config = get_config('production', storage='server')
+        self.assertEqual(config.STORAGE_PROFILE, 'server')
+        self.assertTrue(config.SQLALCHEMY_ENGINE_OPTIONS['pool_pre_ping'])
+        self.assertFalse(config.DEBUG)
+        with self.assertRaises(ValueError):
+            get_config('production', storage='tape')
+
+    def test_sqlite_profile_uses_wal_and_read_only_reader(self):
+        with tempfile.TemporaryDirectory() as directory:
+            class FileConfig(TestingConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'wallet.db')
+
+            app = create_app(FileConfig)
+            with app.app_context():
+                with db.engine.connect() as connection:
+                    self.assertEqual(connection.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+                    self.assertEqual(connection.execute(text('PRAGMA synchronous')).scalar(), 1)  # NORMAL
+                with reader_engine().connect() as connection:
+                    self.assertEqual(connection.execute(text('PRAGMA query_only')).scalar(), 1)
+                db.engine.dispose()
+                reader_engine().dispose()
+
+    def test_boot_does_not_touch_the_schema(self):
+        with tempfile.TemporaryDirectory() as directory:
+            class FileConfig(TestingConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'wallet.db')
+
+            app = create_app(FileConfig)
+            with app.app_context():
+                self.assertEqual(inspect(db.engine).get_table_names(), [])
+                # Ready means the database answers; the schema comes from `flask init-db`
+                self.assertEqual(app.test_client().get('/ready').json, {'status': 'ready'})
+                db.engine.dispose()
+                reader_engine().dispose()
+
+    def test_init_db_upgrades_an_unversioned_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            class FileConfig(TestingConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'wallet.db')
+
+            app = create_app(FileConfig)
+            with app.app_context():
+                # The tables the first release created with db.create_all(), without alembic_version
+                with db.engine.begin() as connection:
+                    for statement in (
+                        'CREATE TABLE user (id INTEGER PRIMARY KEY, phone_number VARCHAR(20) NOT NULL UNIQUE)',
+                        'CREATE TABLE wallet (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES user (id), '
+                        'balance FLOAT NOT NULL, version INTEGER)',
+                        'CREATE TABLE wallet_transaction (id INTEGER PRIMARY KEY, '
+                        'wallet_id INTEGER NOT NULL REFERENCES wallet (id), amount FLOAT NOT NULL, '
+                        'type VARCHAR(20) NOT NULL, timestamp DATETIME NOT NULL)',
+                        "INSERT INTO user VALUES (1, '1234567890')",
+                        'INSERT INTO wallet VALUES (1, 1, 150.0, 1)',
+                        "INSERT INTO wallet_transaction VALUES (1, 1, 150.0, 'credit', '2026-01-02 03:04:05')",
+                    ):
+                        connection.execute(text(statement))
+
+                result = app.test_cli_runner().invoke(args=['init-db'])
+                self.assertIn('Database upgraded', result.output)
+                tables = inspect(db.engine).get_table_names()
+                self.assertIn('wallet_daily_totals', tables)
+                self.assertIn('shard_count', [column['name'] for column in inspect(db.engine).get_columns('wallet')])
+                self.assertEqual(app.test_client().get('/wallet/balance/1').json['balance'], 150.0)
+                # Running it again only applies what is pending, which is nothing
+                self.assertIn('Database upgraded', app.test_cli_runner().invoke(args=['init-db']).output)
+                db.engine.dispose()
+                reader_engine().dispose()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,6 @@
+import os
+from app import create_app
+from app.config import get_config
+
+# Entry point for production WSGI servers, e.g. `gunicorn -c gunicorn.conf.py wsgi:app`
+app = create_app(get_config(os.environ.get('FLASK_ENV', 'production')))